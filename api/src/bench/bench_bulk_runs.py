@@ -0,0 +1,64 @@
+"""
+bench_bulk_runs.py
+By: Zack Bamford
+
+Benchmark run ingestion: POST /run/bulk_create against one POST /run/create per run.
+Run with `python -m api.src.bench.bench_bulk_runs` from the project root, pass --db-url to use Postgres.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bulk run ingestion")
+    parser.add_argument("--runs", type=int, default=50000)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--single", type=int, default=500, help="Amount of runs created one request at a time")
+    parser.add_argument("--db-url", help="Database to use, defaults to a temporary SQLite file")
+    args = parser.parse_args()
+
+    temp_dir = tempfile.TemporaryDirectory()
+    os.environ["DB_URL"] = args.db_url or f"sqlite:///{os.path.join(temp_dir.name, 'bench.db')}"
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ.setdefault("PASSWORD_HASH_ROUNDS", "4")
+
+    # imported after the env vars are set
+    from fastapi.testclient import TestClient
+    from api.src.main.api.api_base import app
+
+    with TestClient(app) as client:
+        user_id = client.post("/user/create", params={"username": "bench", "email": "bench@example.com",
+                                                      "password": "correct horse battery"}).json()["ID"]
+        plan_id = client.post("/plan/create", params={"name": "bench", "description": "bench",
+                                                      "date": "2024-01-01T00:00:00", "distance": 1,
+                                                      "unit": "km"}).json()["ID"]
+        event_id = client.post("/event/create", params={"plan_id": plan_id, "name": "bench",
+                                                        "date": "2024-01-01T00:00:00", "distance": 1,
+                                                        "unit": "km"}).json()["ID"]
+
+        run = {"event_id": event_id, "usr_id": user_id, "date": "2024-01-01T08:00:00", "status": "done"}
+
+        # one request per run
+        begin = time.perf_counter()
+        for _ in range(args.single):
+            client.post("/run/create", params={"event_id": event_id, "user_id": user_id,
+                                               "date": run["date"], "status": run["status"]})
+        single = args.single / (time.perf_counter() - begin)
+
+        # bulk requests
+        begin = time.perf_counter()
+        for _ in range(args.runs // args.batch):
+            response = client.post("/run/bulk_create", json=[run] * args.batch)
+            assert response.status_code == 200 and response.json()[-1]["ID"]
+        bulk = args.runs // args.batch * args.batch / (time.perf_counter() - begin)
+
+    print(f"{'/run/create':<24}{single:>10.0f} runs/sec")
+    print(f"{'/run/bulk_create':<24}{bulk:>10.0f} runs/sec  (batches of {args.batch})")
+
+    temp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
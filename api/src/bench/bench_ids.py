@@ -0,0 +1,102 @@
+"""
+bench_ids.py
+By: Zack Bamford
+
+Benchmark insert throughput and primary key index size of the runs table with random (uuid4) and time-ordered (uuid7)
+IDs. Run with `python -m api.src.bench.bench_ids --rows 10000000` from the project root, pass --db-url to use Postgres.
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime
+
+import sqlalchemy
+
+from api.src.main.db import generic_db
+from api.src.main.db.plan_db import Run
+
+BATCH_SIZE = 10000
+
+
+def index_size(connection: sqlalchemy.Connection) -> int:
+    """
+    Get the size of the primary key index of the runs table
+
+    :param connection: Connection to the database
+    :return: Size in bytes
+    """
+
+    if connection.dialect.name == "postgresql":
+        return connection.execute(sqlalchemy.text(
+            "SELECT pg_relation_size(i.indexrelid) FROM pg_index i JOIN pg_class c ON c.oid = i.indrelid "
+            "WHERE c.relname = 'runs' AND i.indisprimary")).scalar_one()
+
+    # SQLite keeps a text primary key in an automatic index beside the rowid table
+    return connection.execute(sqlalchemy.text(
+        "SELECT SUM(pgsize) FROM dbstat WHERE name = (SELECT name FROM sqlite_master WHERE type = 'index' "
+        "AND tbl_name = 'runs' AND name LIKE 'sqlite_autoindex%')")).scalar_one()
+
+
+def insert_runs(engine: sqlalchemy.Engine, rows: int, new_uuid) -> tuple[float, float]:
+    """
+    Insert runs in batches, committing each batch like the bulk endpoint does
+
+    :param engine: Engine with an empty runs table
+    :param rows: Amount of runs to insert
+    :param new_uuid: UUID generator for the IDs
+    :return: Tuple of rows per second over the whole fill and over its last tenth
+    """
+
+    start = datetime(2023, 1, 1)
+    begin = time.perf_counter()
+    tail_rows, tail_begin = 0, None
+
+    for i in range(0, rows, BATCH_SIZE):
+        # the last tenth shows the cost once the index is large
+        if tail_begin is None and i >= rows * 9 // 10:
+            tail_begin = time.perf_counter()
+
+        batch = [{"ID": f"RUN_{new_uuid().hex.upper()}", "event_id": f"EVENT_{j % 1000}", "usr_id": f"USER_{j % 10000}",
+                  "date": start, "status": "done"} for j in range(i, min(i + BATCH_SIZE, rows))]
+
+        with engine.begin() as connection:
+            connection.execute(sqlalchemy.insert(Run), batch)
+
+        if tail_begin is not None:
+            tail_rows += len(batch)
+
+    end = time.perf_counter()
+    return rows / (end - begin), tail_rows / (end - tail_begin)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark inserts with random and time-ordered IDs")
+    parser.add_argument("--rows", type=int, default=10000000)
+    parser.add_argument("--db-url", help="Database to use, defaults to a temporary SQLite file")
+    args = parser.parse_args()
+
+    print(f"{'format':<8}{'rows/s':>12}{'last 10% rows/s':>18}{'pk index (MiB)':>16}")
+
+    for name, new_uuid in generic_db.ID_FORMATS.items():
+        temp_dir = tempfile.TemporaryDirectory()
+        engine = sqlalchemy.create_engine(args.db_url or f"sqlite:///{os.path.join(temp_dir.name, 'bench.db')}")
+        generic_db.set_sqlite_pragmas(engine)
+
+        Run.__table__.drop(engine, checkfirst=True)
+        Run.__table__.create(engine)
+
+        throughput, tail_throughput = insert_runs(engine, args.rows, new_uuid)
+
+        with engine.connect() as connection:
+            size = index_size(connection)
+
+        print(f"{name:<8}{throughput:>12.0f}{tail_throughput:>18.0f}{size / 1024 / 1024:>16.1f}")
+
+        Run.__table__.drop(engine)
+        engine.dispose()
+        temp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+bench_indexes.py
+By: Zack Bamford
+
+Benchmark lookup latency on the hot columns before and after migrations.create_indexes.
+Run with `python -m api.src.bench.bench_indexes --users 1000000 --runs 10000000` from the project root.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy
+
+from api.src.main.db import generic_db, migrations
+from api.src.main.db.plan_db import Plan, Event, Run
+from api.src.main.db.user_db import User
+
+BATCH_SIZE = 50000
+
+
+def fill(engine: sqlalchemy.Engine, users: int, runs: int, events: int):
+    """
+    Fill an empty database with generated rows
+
+    :param engine: Engine to fill
+    :param users: Amount of users
+    :param runs: Amount of runs
+    :param events: Amount of events, spread over plans of 100 events each
+    """
+
+    start = datetime(2023, 1, 1)
+
+    with engine.begin() as connection:
+        for i in range(0, users, BATCH_SIZE):
+            connection.execute(sqlalchemy.insert(User), [
+                {"ID": f"USER_{j}", "username": f"user{j}", "email": f"User{j}@example.com", "password": "x"}
+                for j in range(i, min(i + BATCH_SIZE, users))])
+
+        connection.execute(sqlalchemy.insert(Plan), [
+            {"ID": f"PLAN_{j}", "name": "x", "description": "x", "date": start, "distance": 1, "distance_unit": "km",
+             "users": ""} for j in range(events // 100 + 1)])
+
+        connection.execute(sqlalchemy.insert(Event), [
+            {"ID": f"EVENT_{j}", "plan_id": f"PLAN_{j // 100}", "name": "x", "date": start + timedelta(hours=j),
+             "distance": 1, "distance_unit": "km"} for j in range(events)])
+
+        for i in range(0, runs, BATCH_SIZE):
+            connection.execute(sqlalchemy.insert(Run), [
+                {"ID": f"RUN_{j}", "event_id": f"EVENT_{j % events}", "usr_id": f"USER_{j % users}",
+                 "date": start, "status": "done"} for j in range(i, min(i + BATCH_SIZE, runs))])
+
+
+def lookups(users: int, events: int) -> dict:
+    """
+    Build the lookup statements to time
+
+    :param users: Amount of users in the database
+    :param events: Amount of events in the database
+    :return: Dictionary of lookup name to a function creating a random statement
+    """
+
+    start = datetime(2023, 1, 1)
+
+    return {
+        "user by email": lambda: sqlalchemy.select(User.ID).where(
+            sqlalchemy.func.lower(User.email) == f"user{random.randrange(users)}@example.com"),
+        "runs by user": lambda: sqlalchemy.select(Run.ID).where(Run.usr_id == f"USER_{random.randrange(users)}"),
+        "runs by event": lambda: sqlalchemy.select(Run.ID).where(Run.event_id == f"EVENT_{random.randrange(events)}"),
+        "events by plan": lambda: sqlalchemy.select(Event.ID).where(
+            Event.plan_id == f"PLAN_{random.randrange(events // 100 + 1)}"),
+        "events by date": lambda: sqlalchemy.select(Event.ID).where(Event.date.between(
+            start + timedelta(hours=random.randrange(events)), start + timedelta(hours=random.randrange(events) + 48))),
+    }
+
+
+def time_lookups(engine: sqlalchemy.Engine, statements: dict, repeat: int) -> dict:
+    """
+    Time each lookup
+
+    :param engine: Engine to query
+    :param statements: Lookups from lookups()
+    :param repeat: Amount of times to run each lookup
+    :return: Dictionary of lookup name to mean latency in milliseconds
+    """
+
+    results = {}
+
+    with engine.connect() as connection:
+        for name, statement in statements.items():
+            begin = time.perf_counter()
+            for _ in range(repeat):
+                connection.execute(statement()).all()
+            results[name] = (time.perf_counter() - begin) / repeat * 1000
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark lookups before and after creating indexes")
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--runs", type=int, default=10000000)
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--db-url", help="Database to use, defaults to a temporary SQLite file")
+    args = parser.parse_args()
+
+    temp_dir = tempfile.TemporaryDirectory()
+    engine = sqlalchemy.create_engine(args.db_url or f"sqlite:///{os.path.join(temp_dir.name, 'bench.db')}")
+
+    # start from tables without secondary indexes
+    generic_db.Base.metadata.drop_all(engine)
+    generic_db.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for table in generic_db.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(sqlalchemy.schema.DropIndex(index))
+
+    print(f"Filling {args.users} users, {args.events} events and {args.runs} runs")
+    fill(engine, args.users, args.runs, args.events)
+
+    statements = lookups(args.users, args.events)
+    before = time_lookups(engine, statements, args.repeat)
+
+    migrations.create_indexes(engine)
+    after = time_lookups(engine, statements, args.repeat)
+
+    print(f"{'lookup':<16}{'before (ms)':>14}{'after (ms)':>14}")
+    for name in statements:
+        print(f"{name:<16}{before[name]:>14.3f}{after[name]:>14.3f}")
+
+    generic_db.Base.metadata.drop_all(engine)
+    temp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
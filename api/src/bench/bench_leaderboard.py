@@ -0,0 +1,81 @@
+"""
+bench_leaderboard.py
+By: Zack Bamford
+
+Benchmark reading the top of a plan: GET /plan/leaderboard against ranking every member with GET /plan/progress.
+Run with `python -m api.src.bench.bench_leaderboard` from the project root, pass --db-url to use Postgres.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the plan leaderboard")
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--events", type=int, default=50)
+    parser.add_argument("--reads", type=int, default=200)
+    parser.add_argument("--db-url", help="Database to use, defaults to a temporary SQLite file")
+    args = parser.parse_args()
+
+    temp_dir = tempfile.TemporaryDirectory()
+    os.environ["DB_URL"] = args.db_url or f"sqlite:///{os.path.join(temp_dir.name, 'bench.db')}"
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ.setdefault("PASSWORD_HASH_ROUNDS", "4")
+
+    # imported after the env vars are set
+    import sqlalchemy
+    from fastapi.testclient import TestClient
+    from api.src.main.api.api_base import app
+    from api.src.main.db import generic_db
+    from api.src.main.db.plan_db import PlanMember
+    from api.src.main.db.user_db import User
+
+    with TestClient(app) as client:
+        plan_id = client.post("/plan/create", params={"name": "bench", "description": "bench",
+                                                      "date": "2024-01-01T00:00:00", "distance": 100,
+                                                      "unit": "km"}).json()["ID"]
+        event_ids = [client.post("/event/create", params={"plan_id": plan_id, "name": "bench",
+                                                          "date": "2024-01-01T00:00:00", "distance": 5,
+                                                          "unit": "km"}).json()["ID"]
+                     for _ in range(args.events)]
+
+        # members are inserted directly, hashing their passwords is not what is measured
+        user_ids = [generic_db.create_id("USER") for _ in range(args.members)]
+        with generic_db.db_obj.engine.begin() as connection:
+            connection.execute(sqlalchemy.insert(User), [{"ID": user_id, "username": user_id, "email": user_id,
+                                                          "password": ""} for user_id in user_ids])
+            connection.execute(sqlalchemy.insert(PlanMember), [{"plan_id": plan_id, "user_id": user_id}
+                                                               for user_id in user_ids])
+
+        # every member completes a random share of the events
+        random.seed(0)
+        runs = [{"event_id": event_id, "usr_id": user_id, "date": "2024-01-01T08:00:00", "status": "done"}
+                for user_id in user_ids for event_id in random.sample(event_ids, random.randint(0, args.events))]
+        for start in range(0, len(runs), 5000):
+            client.post("/run/bulk_create", json=runs[start:start + 5000])
+
+        # both must agree on the top members
+        top = client.get("/plan/leaderboard", params={"plan_id": plan_id}).json()
+        progress = client.get("/plan/progress", params={"plan_id": plan_id}).json()
+        assert [entry["completed_events"] for entry in top] == \
+            [entry["completed_events"] for entry in progress[:len(top)]]
+
+        results = {}
+        for path in ("/plan/progress", "/plan/leaderboard"):
+            begin = time.perf_counter()
+            for _ in range(args.reads):
+                client.get(path, params={"plan_id": plan_id})
+            results[path] = (time.perf_counter() - begin) / args.reads * 1000
+
+    print(f"{args.members} members, {args.events} events, {len(runs)} completed runs")
+    for path, milliseconds in results.items():
+        print(f"{path:<24}{milliseconds:>10.2f} ms/read")
+
+    temp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+bench_login.py
+By: Zack Bamford
+
+Benchmark POST /token: logins per second, SQL statements per login and the latency of rejected logins.
+Run with `python -m api.src.bench.bench_login` from the project root.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import sqlalchemy
+from sqlalchemy import event
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the login endpoint")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt cost of the stored hashes")
+    parser.add_argument("--db-url", help="Database to use, defaults to a temporary SQLite file")
+    args = parser.parse_args()
+
+    temp_dir = tempfile.TemporaryDirectory()
+    os.environ["DB_URL"] = args.db_url or f"sqlite:///{os.path.join(temp_dir.name, 'bench.db')}"
+    os.environ["PASSWORD_HASH_ROUNDS"] = str(args.rounds)
+    os.environ.setdefault("SECRET_KEY", "bench")
+
+    # imported after the env vars are set
+    from fastapi.testclient import TestClient
+    from api.src.main.api.api_base import app
+
+    statements = []
+    event.listen(sqlalchemy.Engine, "before_cursor_execute", lambda *params: statements.append(params[2]))
+
+    password = "correct horse battery"
+
+    with TestClient(app) as client:
+        client.post("/user/create", params={"username": "bench", "email": "bench@example.com", "password": password})
+
+        def login(email: str, secret: str) -> float:
+            begin = time.perf_counter()
+            client.post("/token", data={"username": email, "password": secret})
+            return time.perf_counter() - begin
+
+        # warm up the pool and the dummy hash
+        login("bench@example.com", password)
+        login("missing@example.com", password)
+
+        statements.clear()
+        begin = time.perf_counter()
+        success = [login("bench@example.com", password) for _ in range(args.logins)]
+        elapsed = time.perf_counter() - begin
+        per_login = len(statements) / args.logins
+
+        wrong_password = [login("bench@example.com", "wrong password") for _ in range(args.logins // 4)]
+        unknown_email = [login("missing@example.com", password) for _ in range(args.logins // 4)]
+
+    print(f"logins/sec          {args.logins / elapsed:>10.1f}")
+    print(f"statements/login    {per_login:>10.1f}")
+    for name, times in (("success", success), ("wrong password", wrong_password), ("unknown email", unknown_email)):
+        print(f"{name + ' (ms)':<20}{statistics.median(times) * 1000:>10.2f}")
+
+    temp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+bench_startup.py
+By: Zack Bamford
+
+Benchmark a cold start of the API: importing the app and running its startup against an existing database.
+Run with `python -m api.src.bench.bench_startup` from the project root.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# runs in a fresh interpreter so every measurement is a cold start
+CHILD = """
+import json, time
+import sqlalchemy
+from sqlalchemy import event
+
+statements = []
+event.listen(sqlalchemy.Engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+start = time.perf_counter()
+from api.src.main.api.api_base import app
+imported = time.perf_counter()
+
+from fastapi.testclient import TestClient
+with TestClient(app) as client:
+    started = time.perf_counter()
+    client.get("/ping")
+
+print(json.dumps({"import_ms": (imported - start) * 1000, "startup_ms": (started - start) * 1000,
+                  "statements": len(statements)}))
+"""
+
+
+def measure(db_url: str) -> dict:
+    """
+    Measure one cold start
+
+    :param db_url: Database to start against
+    :return: Dictionary with the import time, total startup time and amount of SQL statements
+    """
+
+    env = dict(os.environ, DB_URL=db_url, SECRET_KEY=os.environ.get("SECRET_KEY", "bench"))
+    output = subprocess.run([sys.executable, "-c", CHILD], env=env, capture_output=True, text=True, check=True,
+                            cwd=os.getcwd()).stdout
+
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API cold start")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--db-url", help="Database to use, defaults to a temporary SQLite file")
+    args = parser.parse_args()
+
+    temp_dir = tempfile.TemporaryDirectory()
+    db_url = args.db_url or f"sqlite:///{os.path.join(temp_dir.name, 'bench.db')}"
+
+    # first start creates the schema, the rest start against an existing database
+    measure(db_url)
+    results = [measure(db_url) for _ in range(args.runs)]
+
+    for key in ("import_ms", "startup_ms", "statements"):
+        print(f"{key:<12}{statistics.median(result[key] for result in results):>10.1f}")
+
+    temp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,10 @@ By: Zack Bamford
 
 This file contains the base API for the app.
 """
+import logging
 import os
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from typing import Annotated
 import bcrypt
@@ -18,12 +21,37 @@ from jose.exceptions import JWTError
 
 from . import auth
 from .auth import create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES
+from .dependencies import UserCommandsDep, PasswordHasherDep, password_hasher
+from .metrics import MetricsMiddleware
 from .models import TokenData
-from .routers import user_api, plan_api, event_api, run_api
-from ..db import generic_db
-from ..db.user_db import UserCommands
+from .passwords import HasherBusyError
+from .routers import user_api, plan_api, event_api, run_api, ops_api
+from ..db import generic_db, migrations
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create the schema and prepare the password hasher once when the app starts, data migrations and new indexes run
+    through the migrations command
+
+    :param app: App being started
+    """
+
+    start = time.perf_counter()
+    await migrations.create_schema(generic_db.async_db_obj.engine)
+    await password_hasher.start()
+    logging.info(f"Startup finished in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    yield
+
+    password_hasher.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# starts the request scope used for read-your-writes, so it wraps every route
+app.add_middleware(MetricsMiddleware)
 
 # docs metadata
 tags_metadata = [
@@ -42,9 +70,7 @@ app.router.include_router(user_api.router)
 app.router.include_router(plan_api.router)
 app.router.include_router(event_api.router)
 app.router.include_router(run_api.router)
-
-# setup user commands
-uc: UserCommands = UserCommands(generic_db.db_obj)
+app.router.include_router(ops_api.router)
 
 
 @app.get("/ping", tags=["Default"])
@@ -53,9 +79,14 @@ async def test():
 
 
 @app.post("/token", tags=["Auth"])
-async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
-    # get user
-    user = uc.retrieve_user_by_email(form_data.username)
+async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], uc: UserCommandsDep,
+                hasher: PasswordHasherDep):
+    # get user and verify password
+    try:
+        user = await auth.authenticate_user(uc, hasher, form_data.username, form_data.password)
+    except HasherBusyError:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Too many password operations, try again later", headers={"Retry-After": "1"})
 
     # check for success
     if user is None:
@@ -65,14 +96,6 @@ async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    # verify password
-    if not auth.authenticate_user(form_data.username, form_data.password):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect username or password",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-
     # create token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token({"sub": user.ID}, expires_delta=access_token_expires)
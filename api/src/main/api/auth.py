@@ -6,10 +6,10 @@ OAuth2 authentication functions
 """
 
 import os
+from contextlib import nullcontext
 from datetime import timedelta, datetime
 from typing import Annotated
 
-import bcrypt
 from fastapi import status
 from fastapi.exceptions import HTTPException
 from fastapi.params import Depends
@@ -18,12 +18,11 @@ from fastapi.security.oauth2 import OAuth2PasswordBearer
 from jose import jwt
 from jose.exceptions import JWTError
 
+from api.src.main.api.dependencies import UserCommandsDep
 from api.src.main.api.models import TokenData
+from api.src.main.api.passwords import PasswordHasher
 from api.src.main.db import generic_db
-from api.src.main.db.user_db import UserCommands
-
-# db reader setup
-uc: UserCommands = UserCommands(generic_db.db_obj)
+from api.src.main.db.user_db import AsyncUserCommands, User, principal_cache
 
 # token setup
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -33,27 +32,43 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
 
-def authenticate_user(username: str, password: str):
+async def authenticate_user(uc: AsyncUserCommands, hasher: PasswordHasher, username: str,
+                            password: str) -> User | None:
+    """
+    Checks a login with a single user lookup
+
+    :param uc: User commands
+    :param hasher: Password hasher
+    :param username: Email address of the user
+    :param password: Password to check
+    :return: User object if the password matches, None otherwise
+    """
+
     # get user
-    user = uc.retrieve_user_by_email(username)
+    user = await uc.retrieve_user_by_email(username)
 
-    # check for success
+    # check for success, still spending a hash check so unknown emails are not faster to reject
     if user is None:
-        return False
+        await hasher.verify_dummy(password)
+        return None
 
     # check for valid password
-    if not bcrypt.checkpw(password.encode('utf-8'), user.password.encode('utf-8')):
-        return False
+    if not await hasher.verify(password, user.password):
+        return None
+
+    # upgrade hashes made with an old cost while the plain password is known
+    if hasher.needs_rehash(user.password):
+        await uc.modify_user(user.ID, new_password=await hasher.hash(password))
 
-    return True
+    return user
 
 
-def retrieve_user(token: Annotated[str, Depends(oauth2_scheme)]):
+async def retrieve_user(token: Annotated[str, Depends(oauth2_scheme)], uc: UserCommandsDep):
     """
     Retrieves a user
 
-    :param user_id: User_ID
     :param token: OAuth 2 token
+    :param uc: User commands
     :return: User object
     """
 
@@ -74,7 +89,16 @@ def retrieve_user(token: Annotated[str, Depends(oauth2_scheme)]):
     except JWTError:
         raise credentials_exception
 
-    retrieved_user = uc.retrieve_user(token_data.username)
+    # most requests reuse a recently loaded user
+    retrieved_user = principal_cache.get(token_data.username)
+
+    if retrieved_user is None:
+        # a copy from a lagging replica would be used until the TTL, so principals to cache are read from the primary
+        with generic_db.primary_reads() if principal_cache.ttl > 0 else nullcontext():
+            retrieved_user = await uc.retrieve_user(token_data.username)
+
+        if retrieved_user is not None:
+            principal_cache.set(token_data.username, retrieved_user, retrieved_user.version)
 
     # check for success
     if retrieved_user is None:
@@ -0,0 +1,68 @@
+"""
+cached.py
+By: Zack Bamford
+
+Serve single entities from the response cache, filling it on a miss. The Commands invalidate an entity on modify
+and delete, so a hit skips the database and the serialization
+"""
+from contextlib import nullcontext
+from typing import Any, Awaitable, Callable, Optional, Type
+
+from fastapi import HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from api.src.main.api.etags import etag_matches, version_etag, etag_headers, not_modified
+from api.src.main.db import generic_db
+from api.src.main.db.cache import response_cache
+
+
+async def cached_entity(request: Request, kind: str, entity_id: str, model: Type[BaseModel],
+                        load: Callable[[], Awaitable[Optional[Any]]], detail: str,
+                        get_version: Optional[Callable[[], Awaitable[Optional[int]]]] = None) -> Response:
+    """
+    Build the JSON response of an entity, with its version as the ETag
+
+    :param request: Request with the If-None-Match header
+    :param kind: Kind of entity in the cache, such as "event"
+    :param entity_id: ID of the entity
+    :param model: Response model to serialize the entity with
+    :param load: Loads the entity on a miss, None if it does not exist
+    :param detail: Detail of the 404 when the entity does not exist
+    :param get_version: Reads only the version on a miss, to answer a revalidation without loading the entity
+    :return: JSON or Not Modified response
+    """
+
+    if_none_match = request.headers.get("If-None-Match")
+    cached = response_cache.get(kind, entity_id)
+
+    if cached is None:
+        # answer a revalidation from the version alone
+        if if_none_match is not None and get_version is not None:
+            version = await get_version()
+
+            if version is None:
+                raise HTTPException(status_code=404, detail=detail)
+
+            if etag_matches(if_none_match, version_etag(version)):
+                return not_modified(version_etag(version))
+
+        # a copy from a lagging replica would be served until the TTL, so responses to cache are read from the primary
+        with generic_db.primary_reads() if response_cache.ttl(kind) > 0 else nullcontext():
+            entity = await load()
+
+        if entity is None:
+            raise HTTPException(status_code=404, detail=detail)
+
+        # serialized the same way FastAPI serializes a response model
+        cached = (entity.version, JSONResponse(jsonable_encoder(model.from_orm(entity))).body)
+        response_cache.set(kind, entity_id, *cached)
+
+    version, body = cached
+    etag = version_etag(version)
+
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    return Response(body, media_type="application/json", headers=etag_headers(etag))
@@ -0,0 +1,49 @@
+"""
+dependencies.py
+By: Zack Bamford
+
+Database commands shared by every route through FastAPI dependencies
+"""
+from typing import Annotated
+
+from fastapi.params import Depends
+
+from api.src.main.api.passwords import PasswordHasher
+from api.src.main.db import generic_db
+from api.src.main.db.event_db import AsyncEventCommands
+from api.src.main.db.plan_db import AsyncPlanCommands
+from api.src.main.db.run_db import AsyncRunCommands
+from api.src.main.db.user_db import AsyncUserCommands
+
+# one set of commands for the whole app, creating them does not touch the database
+user_commands: AsyncUserCommands = AsyncUserCommands(generic_db.async_db_obj)
+plan_commands: AsyncPlanCommands = AsyncPlanCommands(generic_db.async_db_obj)
+event_commands: AsyncEventCommands = AsyncEventCommands(generic_db.async_db_obj)
+run_commands: AsyncRunCommands = AsyncRunCommands(generic_db.async_db_obj)
+password_hasher: PasswordHasher = PasswordHasher()
+
+
+def get_user_commands() -> AsyncUserCommands:
+    return user_commands
+
+
+def get_plan_commands() -> AsyncPlanCommands:
+    return plan_commands
+
+
+def get_event_commands() -> AsyncEventCommands:
+    return event_commands
+
+
+def get_run_commands() -> AsyncRunCommands:
+    return run_commands
+
+
+def get_password_hasher() -> PasswordHasher:
+    return password_hasher
+
+UserCommandsDep = Annotated[AsyncUserCommands, Depends(get_user_commands)]
+PlanCommandsDep = Annotated[AsyncPlanCommands, Depends(get_plan_commands)]
+EventCommandsDep = Annotated[AsyncEventCommands, Depends(get_event_commands)]
+RunCommandsDep = Annotated[AsyncRunCommands, Depends(get_run_commands)]
+PasswordHasherDep = Annotated[PasswordHasher, Depends(get_password_hasher)]
@@ -0,0 +1,118 @@
+"""
+etags.py
+By: Zack Bamford
+
+ETags for JSON responses, so clients re-fetching unchanged data get an empty 304 Not Modified, and If-Match
+preconditions for modifies
+"""
+import hashlib
+import re
+from typing import Any, Optional
+
+from fastapi import HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+
+def make_etag(body: bytes) -> str:
+    """
+    Build a strong ETag from a response body
+
+    :param body: Encoded response body
+    :return: Quoted ETag
+    """
+
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+def version_etag(version: int) -> str:
+    """
+    Build the ETag of a row from its version column
+
+    :param version: Version of the row
+    :return: Quoted ETag
+    """
+
+    return f'"v{version}"'
+
+
+def etag_headers(etag: str) -> dict:
+    """
+    Headers sent with every response carrying an ETag
+
+    :param etag: Current ETag
+    :return: Dictionary of headers
+    """
+
+    # revalidate on every use, the data can change at any time
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+def not_modified(etag: str) -> Response:
+    """
+    Build an empty 304 Not Modified response
+
+    :param etag: Current ETag
+    :return: Response
+    """
+
+    return Response(status_code=304, headers=etag_headers(etag))
+
+
+def if_match_version(request: Request) -> Optional[int]:
+    """
+    Read the version a modify expects from the If-Match header
+
+    :param request: Request with the If-Match header
+    :return: Expected version, or None if any version is accepted
+    """
+
+    header = request.headers.get("If-Match")
+
+    if header is None or header.strip() == "*":
+        return None
+
+    # If-Match uses the strong comparison, so weak tags never match
+    match = re.fullmatch(r'\s*"v(\d+)"\s*', header)
+
+    if match is None:
+        raise HTTPException(status_code=412, detail="If-Match does not match the current version")
+
+    return int(match.group(1))
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """
+    Check an If-None-Match header against an ETag, using the weak comparison If-None-Match calls for
+
+    :param header: Value of the If-None-Match header
+    :param etag: Current ETag
+    :return: True if the client already has the current version
+    """
+
+    if header is None:
+        return False
+
+    if header.strip() == "*":
+        return True
+
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def etag_response(request: Request, content: Any) -> Response:
+    """
+    Serialize content as JSON with an ETag, or answer 304 Not Modified when the client sent a matching If-None-Match
+
+    :param request: Request with the If-None-Match header
+    :param content: Content to serialize
+    :return: JSON or Not Modified response
+    """
+
+    response = JSONResponse(jsonable_encoder(content))
+    etag = make_etag(response.body)
+
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return not_modified(etag)
+
+    response.headers.update(etag_headers(etag))
+    return response
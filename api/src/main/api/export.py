@@ -0,0 +1,85 @@
+"""
+export.py
+By: Zack Bamford
+
+Serialize streamed row batches as NDJSON or CSV, optionally gzipped, without holding the whole export in memory
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+from typing import AsyncIterator
+
+import sqlalchemy
+
+# media type of each export format
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def _json_default(value):
+    # datetimes in the same ISO format as the JSON responses
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    return str(value)
+
+
+async def ndjson_chunks(batches: AsyncIterator[list[sqlalchemy.Row]]) -> AsyncIterator[bytes]:
+    """
+    Serialize each row as a JSON object on its own line
+
+    :param batches: Row batches
+    :return: Iterator of encoded chunks, one per batch
+    """
+
+    async for batch in batches:
+        yield "".join(json.dumps(row._asdict(), default=_json_default) + "\n" for row in batch).encode()
+
+
+async def csv_chunks(batches: AsyncIterator[list[sqlalchemy.Row]], columns: list[str]) -> AsyncIterator[bytes]:
+    """
+    Serialize rows as CSV with a header line
+
+    :param batches: Row batches
+    :param columns: Column names for the header
+    :return: Iterator of encoded chunks, the header then one per batch
+    """
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(columns)
+
+    async for batch in batches:
+        writer.writerows((value.isoformat() if isinstance(value, datetime) else value for value in row)
+                         for row in batch)
+        yield buffer.getvalue().encode()
+
+        # reuse the buffer for the next batch
+        buffer.seek(0)
+        buffer.truncate()
+
+    # header only export
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Gzip a stream of chunks on the fly
+
+    :param chunks: Uncompressed chunks
+    :return: Iterator of compressed chunks
+    """
+
+    # wbits of 31 writes the gzip header and trailer
+    compressor = zlib.compressobj(wbits=31)
+
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
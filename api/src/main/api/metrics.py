@@ -0,0 +1,251 @@
+"""
+metrics.py
+By: Zack Bamford
+
+Per-route request metrics in the Prometheus text format: latency, status codes, requests in flight, and the amount of
+statements and time each request spends in the database.
+Metrics are updated without locks. Every update runs on the event loop thread, so no increment is lost.
+"""
+import bisect
+import time
+from typing import Optional
+
+from api.src.main.db import generic_db, tracing
+
+# latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# buckets of statements per request
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+
+def _escape(value) -> str:
+    # backslashes, quotes and line breaks are escaped in label values
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _number(value: float) -> str:
+    return "+Inf" if value == float("inf") else str(value)
+
+
+class Metric:
+    """
+    Named metric with a value per label set
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = ()):
+        """
+        :param name: Metric name
+        :param description: HELP text
+        :param label_names: Names of the labels, values are passed in the same order
+        """
+
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.values: dict[tuple, object] = {}
+
+    def samples(self) -> list[str]:
+        """
+        Render the sample lines of the metric
+
+        :return: Lines without HELP and TYPE
+        """
+
+        return [f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+                for labels, value in list(self.values.items())]
+
+    def render(self) -> str:
+        """
+        Render the metric in the Prometheus text format
+
+        :return: HELP, TYPE and sample lines
+        """
+
+        return "\n".join([f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}",
+                          *self.samples()])
+
+
+class Counter(Metric):
+    """
+    Value that only goes up
+    """
+
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down
+    """
+
+    kind = "gauge"
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values over fixed buckets
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        """
+        :param name: Metric name
+        :param description: HELP text
+        :param label_names: Names of the labels, values are passed in the same order
+        :param buckets: Upper bounds of the buckets, in increasing order
+        """
+
+        super().__init__(name, description, label_names)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        """
+        Record a value
+
+        :param value: Observed value
+        :param labels: Label values
+        """
+
+        # count per bucket, then the sum and the amount of values
+        counts = self.values.get(labels)
+
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        names = self.label_names + ("le",)
+
+        for labels, counts in list(self.values.items()):
+            cumulative = 0
+
+            # buckets are cumulative in the text format
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (_number(bound),))} {cumulative}")
+
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {_number(counts[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {counts[-1]}")
+
+        return lines
+
+
+class RequestMetrics:
+    """
+    The metrics recorded for every request
+    """
+
+    def __init__(self):
+        self.requests = Counter("http_requests_total", "Requests by route and status code",
+                                ("method", "route", "status"))
+        self.latency = Histogram("http_request_duration_seconds", "Time until the response was sent",
+                                 ("method", "route"))
+        self.in_flight = Gauge("http_requests_in_flight", "Requests being handled")
+        self.queries = Histogram("http_request_db_queries", "Database statements executed per request",
+                                 ("method", "route"), QUERY_BUCKETS)
+        self.query_time = Histogram("http_request_db_seconds", "Time spent executing database statements per request",
+                                    ("method", "route"))
+        self.in_flight.values[()] = 0
+
+    def record(self, method: str, route: str, status: int, seconds: float, scope: generic_db.RequestScope):
+        """
+        Record a finished request
+
+        :param method: HTTP method
+        :param route: Path template of the route
+        :param status: Status code of the response
+        :param seconds: Time until the response was sent
+        :param scope: Request scope holding the database statistics
+        """
+
+        self.requests.inc(method, route, status)
+        self.latency.observe(seconds, method, route)
+        self.queries.observe(scope.queries, method, route)
+        self.query_time.observe(scope.query_seconds, method, route)
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text format
+
+        :return: Exposition text
+        """
+
+        return "\n".join(metric.render() for metric in (self.requests, self.latency, self.in_flight, self.queries,
+                                                         self.query_time)) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware starting the request scope and recording the metrics of every HTTP request
+    """
+
+    def __init__(self, app, metrics: Optional[RequestMetrics] = None):
+        """
+        :param app: ASGI app to wrap
+        :param metrics: Metrics to record into, defaults to the shared request_metrics
+        """
+
+        self.app = app
+        self.metrics = metrics or request_metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        # read-your-writes and the database statistics of the request
+        request_scope = generic_db.start_request()
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+            await send(message)
+
+        self.metrics.in_flight.inc()
+        start = time.perf_counter()
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            self.metrics.in_flight.dec()
+
+            # the path template keeps the amount of label values bounded, unknown paths share one
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            self.metrics.record(scope["method"], path, status, time.perf_counter() - start, request_scope)
+
+            # flag N+1 queries when DB_TRACE_QUERIES is set
+            if request_scope.trace is not None:
+                tracing.report_repeats(request_scope.trace, f"{scope['method']} {path}")
+
+
+# metrics of the app, exposed on GET /metrics
+request_metrics: RequestMetrics = RequestMetrics()
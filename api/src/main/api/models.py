@@ -4,10 +4,10 @@ By: Zack Bamford
 
 Pydantic models
 """
-from datetime import datetime
+from datetime import datetime, date as Date
 from typing import Annotated
 
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, validator
 from pydantic.fields import Field
 
 
@@ -67,5 +67,103 @@ class RunCreate(RunBase):
 class Run(RunBase):
     ID: str
 
+    # runs from before dates were required can have none
+    date: datetime | None
+
+    class Config:
+        orm_mode = True
+
+
+class BulkRunResult(BaseModel):
+    ID: str | None = None
+    error: str | None = None
+
+
+class ScheduleEvent(BaseModel):
+    name: str
+    # schedules are usually written with dates only, those start at midnight
+    date: datetime | Date
+    distance: float = Field(ge=0)
+    distance_unit: str
+
+    @validator("date")
+    def start_of_day(cls, value: datetime | Date) -> datetime:
+        return value if isinstance(value, datetime) else datetime.combine(value, datetime.min.time())
+
+
+class ImportRowError(BaseModel):
+    row: int
+    error: str
+
+
+class ScheduleImportResult(BaseModel):
+    created: list[str]
+    errors: list[ImportRowError]
+
+
+class PlanProgress(BaseModel):
+    user_id: str
+    username: str
+    completed_events: int
+    total_events: int
+    completed_distance: float
+    plan_distance: float | None
+    percent_complete: float | None
+
+    class Config:
+        orm_mode = True
+
+
+class LeaderboardEntry(BaseModel):
+    user_id: str
+    username: str
+    completed_events: int
+    completed_distance: float
+
+    class Config:
+        orm_mode = True
+
+
+class CalendarEvent(BaseModel):
+    ID: str
+    plan_id: str
+    plan_name: str
+    name: str
+    date: datetime
+    distance: float
+    distance_unit: str
+
     class Config:
         orm_mode = True
+
+
+class EventTree(BaseModel):
+    ID: str
+    name: str
+    date: datetime
+    distance: float
+    distance_unit: str
+    runs: list[Run] | None = Field(alias="run")
+
+    class Config:
+        orm_mode = True
+        allow_population_by_field_name = True
+
+
+class PlanTree(BaseModel):
+    ID: str
+    name: str
+    description: str
+    date: datetime
+    distance: float
+    distance_unit: str
+    events: list[EventTree] | None = Field(alias="child_events")
+
+    class Config:
+        orm_mode = True
+        allow_population_by_field_name = True
+
+
+class Dashboard(BaseModel):
+    user: User
+    plans: list[PlanTree]
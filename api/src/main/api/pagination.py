@@ -0,0 +1,44 @@
+"""
+pagination.py
+By: Zack Bamford
+
+Page size limits and cursors for keyset paginated endpoints
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException
+
+# largest page a client can request from a listing endpoint
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(date: Optional[datetime], object_id: str) -> str:
+    """
+    Encode the sort key of the last row of a page into an opaque cursor
+
+    :param date: Date of the last row, or None if it has no date
+    :param object_id: ID of the last row
+    :return: URL safe cursor
+    """
+
+    return base64.urlsafe_b64encode(json.dumps([date.isoformat() if date is not None else None,
+                                                object_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[Optional[datetime], str]:
+    """
+    Decode a cursor made by encode_cursor
+
+    :param cursor: Cursor given by the client
+    :return: Date and ID of the last row of the previous page, the date is None if that row had no date
+    """
+
+    try:
+        date, object_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(date) if date is not None else None, str(object_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
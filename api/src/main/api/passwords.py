@@ -0,0 +1,222 @@
+"""
+passwords.py
+By: Zack Bamford
+
+Password hashing and verification, run in a bounded process pool so bcrypt never blocks the API workers
+"""
+import asyncio
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+import bcrypt
+
+# bcrypt cost used when PASSWORD_HASH_ROUNDS is not set
+DEFAULT_ROUNDS = 12
+
+
+def _hash(password: bytes, rounds: int) -> bytes:
+    # runs in a worker process
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _verify(password: bytes, hashed: bytes) -> bool:
+    # runs in a worker process, a malformed stored hash matches nothing
+    try:
+        return bcrypt.checkpw(password, hashed)
+    except ValueError:
+        return False
+
+
+class HasherBusyError(Exception):
+    """
+    Raised when the hashing queue is full, the caller should try again later
+    """
+
+
+def hash_rounds(hashed: str) -> Optional[int]:
+    """
+    Read the cost out of a bcrypt hash, formatted as $2b$<cost>$<salt and hash>
+
+    :param hashed: Stored hash
+    :return: Cost of the hash, or None if it is not a bcrypt hash
+    """
+
+    try:
+        return int(hashed.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class HashStats:
+    """
+    Latency and queue depth of the hashing pool
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {"hash": [0, 0.0, 0.0], "verify": [0, 0.0, 0.0]}
+        self.queued = 0
+        self.max_queued = 0
+        self.rejected = 0
+
+    def record(self, operation: str, seconds: float):
+        """
+        Record a finished operation
+
+        :param operation: "hash" or "verify"
+        :param seconds: Time from submitting to the result, including the wait in the queue
+        """
+
+        with self.lock:
+            counts = self.operations[operation]
+            counts[0] += 1
+            counts[1] += seconds
+            counts[2] = max(counts[2], seconds)
+
+    def as_dict(self) -> dict:
+        """
+        Snapshot of the statistics
+
+        :return: Dictionary of queue depth and per operation latency
+        """
+
+        with self.lock:
+            result = {"queued": self.queued, "max_queued": self.max_queued, "rejected": self.rejected}
+
+            for operation, (count, total, maximum) in self.operations.items():
+                result[operation] = {"count": count, "avg_ms": total / count * 1000 if count else 0.0,
+                                     "max_ms": maximum * 1000}
+
+        return result
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords in a process pool, rejecting work once the queue is full
+    """
+
+    def __init__(self, rounds: Optional[int] = None, workers: Optional[int] = None, max_queue: Optional[int] = None):
+        """
+        Settings default to the PASSWORD_HASH_ROUNDS, PASSWORD_HASH_WORKERS and PASSWORD_HASH_QUEUE env vars
+
+        :param rounds: Target bcrypt cost
+        :param workers: Amount of worker processes
+        :param max_queue: Maximum amount of queued and running operations
+        """
+
+        self.rounds = rounds or int(os.environ.get("PASSWORD_HASH_ROUNDS", DEFAULT_ROUNDS))
+        self.workers = workers or int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+        self.max_queue = max_queue or int(os.environ.get("PASSWORD_HASH_QUEUE", self.workers * 4))
+        self.stats = HashStats()
+        self._executor = None
+        self._lock = threading.Lock()
+        self._dummy_hash = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        # start the worker processes on first use
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        return self._executor
+
+    async def _run(self, operation: str, function: Callable, *args):
+        """
+        Run a function in the pool
+
+        :param operation: Name of the operation for the statistics
+        :param function: Function to run
+        :param args: Arguments of the function
+        :return: Result of the function
+        :raises HasherBusyError: If max_queue operations are already queued or running
+        """
+
+        # reject instead of letting the queue grow without bound
+        with self.stats.lock:
+            if self.stats.queued >= self.max_queue:
+                self.stats.rejected += 1
+                raise HasherBusyError(f"{self.stats.queued} password operations already queued")
+
+            self.stats.queued += 1
+            self.stats.max_queued = max(self.stats.max_queued, self.stats.queued)
+
+        start = time.perf_counter()
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            with self.stats.lock:
+                self.stats.queued -= 1
+            self.stats.record(operation, time.perf_counter() - start)
+
+    async def hash(self, password: str) -> str:
+        """
+        Hash a password with the target cost
+
+        :param password: Plain text password
+        :return: bcrypt hash
+        """
+
+        hashed = await self._run("hash", _hash, password.encode('utf-8'), self.rounds)
+        return hashed.decode('utf-8')
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        """
+        Check a password against a stored hash
+
+        :param password: Plain text password
+        :param hashed: Stored bcrypt hash
+        :return: True if the password matches
+        """
+
+        return await self._run("verify", _verify, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    async def start(self):
+        """
+        Start the worker processes and make the dummy hash, run once when the app starts so no login pays for either
+        """
+
+        # the password behind it is never kept
+        self._dummy_hash = await self.hash(secrets.token_urlsafe(32))
+
+    async def verify_dummy(self, password: str) -> bool:
+        """
+        Check a password against a throwaway hash with the target cost, so unknown accounts take as long as known ones
+
+        :param password: Plain text password
+        :return: Always False
+        """
+
+        if self._dummy_hash is None:
+            raise RuntimeError("PasswordHasher.start() must run before verify_dummy")
+
+        await self.verify(password, self._dummy_hash)
+        return False
+
+    def needs_rehash(self, hashed: str) -> bool:
+        """
+        Check if a stored hash was made with a lower cost than the target. Stronger hashes are kept, so lowering
+        PASSWORD_HASH_ROUNDS does not weaken existing passwords
+
+        :param hashed: Stored bcrypt hash
+        :return: True if the hash should be replaced, False for hashes that are not bcrypt
+        """
+
+        rounds = hash_rounds(hashed)
+        return rounds is not None and rounds < self.rounds
+
+    def shutdown(self):
+        """
+        Stop the worker processes
+        """
+
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
@@ -5,30 +5,38 @@ By: Zack Bamford
 Event API operations
 """
 
-from datetime import datetime
-from typing import Annotated
+from datetime import datetime, timedelta
+from typing import Annotated, Optional, Literal
 
-from fastapi import HTTPException, APIRouter
+from fastapi import HTTPException, APIRouter, Query, Request, Response
 from fastapi.params import Depends
+from pydantic import ValidationError
 
 from api.src.main.api import models
 from api.src.main.api.auth import oauth2_scheme, retrieve_user
-from api.src.main.db import generic_db
-from api.src.main.db.event_db import EventCommands, Event
-from api.src.main.db.plan_db import PlanCommands
-from api.src.main.db.run_db import RunCommands
+from api.src.main.api.cached import cached_entity
+from api.src.main.api.dependencies import EventCommandsDep, PlanCommandsDep
+from api.src.main.api.etags import etag_response, version_etag, etag_headers, if_match_version
+from api.src.main.api.pagination import MAX_PAGE_SIZE, encode_cursor, decode_cursor
+from api.src.main.api.schedule import PARSERS, MAX_RECORD_SIZE, RecordTooLargeError, RowError
+from api.src.main.db.generic_db import StaleVersionError
+from api.src.main.db.plan_db import Event
+from api.src.main.db.user_db import User
 
 # setup
 router = APIRouter()
-Event.metadata.create_all(bind=generic_db.db_obj.engine)
-pc: PlanCommands = PlanCommands(generic_db.db_obj)
-ec: EventCommands = EventCommands(generic_db.db_obj)
-rc: RunCommands = RunCommands(generic_db.db_obj)
+
+# largest amount of events in one schedule upload
+MAX_IMPORT_ROWS = 5000
+
+# longest calendar window
+MAX_CALENDAR_WINDOW = timedelta(days=366)
 
 
 # TODO: Restrict access to event creation to plan owners
 @router.post("/event/create", tags=["Event"], response_model=models.Event)
-def create_event(plan_id: str, name: str, date: datetime, distance: float, unit: str):
+async def create_event(plan_id: str, name: str, date: datetime, distance: float, unit: str, pc: PlanCommandsDep,
+                       ec: EventCommandsDep):
     """
     Creates an event
 
@@ -41,11 +49,11 @@ def create_event(plan_id: str, name: str, date: datetime, distance: float, unit:
     """
 
     # check for valid plan
-    if pc.retrieve_plan(plan_id) is None:
+    if await pc.retrieve_plan(plan_id) is None:
         raise HTTPException(status_code=404, detail="Plan not found.")
 
     # create event
-    created_event = ec.add_event(name, date, distance, unit, plan_id)
+    created_event = await ec.add_event(name, date, distance, unit, plan_id)
 
     # check for success
     if created_event is None:
@@ -54,29 +62,75 @@ def create_event(plan_id: str, name: str, date: datetime, distance: float, unit:
     return created_event
 
 
+# TODO: Restrict access to event creation to plan owners
+@router.post("/event/import", tags=["Event"])
+async def import_schedule(plan_id: str, request: Request, pc: PlanCommandsDep, ec: EventCommandsDep,
+                          file_format: Literal["csv", "json", "ndjson"] = Query(default="csv", alias="format")) -> \
+        models.ScheduleImportResult:
+    """
+    Imports a training schedule into a plan. The request body is a CSV with a name,date,distance,distance_unit header,
+    a JSON array of objects with those fields, or NDJSON. Rows that fail validation are reported and the rest are
+    created
+
+    :param plan_id: Valid plan ID
+    :param file_format: csv, json or ndjson
+    :return: Created event IDs and the errors of rejected rows, numbered from 1 without the CSV header
+    """
+
+    # check for valid plan before reading the body
+    if await pc.retrieve_plan(plan_id) is None:
+        raise HTTPException(status_code=404, detail="Plan not found.")
+
+    events = []
+    errors = []
+
+    # records are parsed and validated as the body arrives
+    row = 0
+    try:
+        async for record in PARSERS[file_format](request.stream()):
+            row += 1
+
+            if row > MAX_IMPORT_ROWS:
+                raise HTTPException(status_code=413, detail=f"At most {MAX_IMPORT_ROWS} events per import")
+
+            # unparsable row
+            if isinstance(record, RowError):
+                errors.append(models.ImportRowError(row=row, error=record.message))
+                continue
+
+            try:
+                events.append(models.ScheduleEvent.parse_obj(record).dict())
+            except ValidationError as e:
+                errors.append(models.ImportRowError(row=row, error="; ".join(
+                    f"{'.'.join(str(loc) for loc in error['loc'])}: {error['msg']}" for error in e.errors())))
+    except RecordTooLargeError:
+        raise HTTPException(status_code=413, detail=f"Rows are at most {MAX_RECORD_SIZE} characters")
+
+    # create every valid event in one transaction
+    created = await ec.add_events(plan_id, events)
+
+    return models.ScheduleImportResult(created=created, errors=errors)
+
+
 @router.get("/event/get", tags=["Event"], response_model=models.Event)
-def get_event(event_id: str):
+async def get_event(event_id: str, request: Request, ec: EventCommandsDep):
     """
-    Gets an event
+    Gets an event, served from the response cache when possible. The ETag follows the event version, a matching
+    If-None-Match gets an empty 304
 
     :param event_id: Valid event ID
     :return:
     """
 
-    # get event
-    event = ec.retrieve_event(event_id)
-
-    # check for success
-    if event is None:
-        raise HTTPException(status_code=404, detail="Event not found")
-
-    return event
+    return await cached_entity(request, "event", event_id, models.Event, lambda: ec.retrieve_event(event_id),
+                               "Event not found", lambda: ec.get_version(Event, event_id))
 
 
 @router.post("/event/modify", tags=["Event"], response_model=models.Event)
-def modify_event(event_id: str, name: str, date: datetime, distance: float, unit: str):
+async def modify_event(event_id: str, name: str, date: datetime, distance: float, unit: str, request: Request,
+                       response: Response, ec: EventCommandsDep):
     """
-    Modifies an event
+    Modifies an event. Send the ETag of /event/get in If-Match to only modify the version that was read
 
     :param event_id: Event to modify
     :param name: New name
@@ -86,47 +140,78 @@ def modify_event(event_id: str, name: str, date: datetime, distance: float, unit
     :return:
     """
 
-    # check for valid event
-    if ec.retrieve_event(event_id) is None:
-        raise HTTPException(status_code=404, detail="Event not found.")
+    # modify event, nothing is updated if the event does not exist
+    try:
+        modified_event = await ec.modify_event(event_id, name, date, distance, unit, if_match_version(request))
+    except StaleVersionError:
+        raise HTTPException(status_code=412, detail="Event was modified since it was read")
 
-    # modify event
-    modified_event = ec.modify_event(event_id, name, date, distance, unit)
-
-    # check for success
     if modified_event is None:
-        raise HTTPException(status_code=500, detail="Failed to modify event")
+        raise HTTPException(status_code=404, detail="Event not found.")
+
+    response.headers.update(etag_headers(version_etag(modified_event.version)))
 
     return modified_event
 
 
 @router.get("/event/runs", tags=["Event"])
-def get_all_runs_from_event(event_id: str) -> list[models.Run]:
+async def get_all_runs_from_event(event_id: str, response: Response, ec: EventCommandsDep,
+                                  limit: int = Query(default=100, gt=0, le=MAX_PAGE_SIZE),
+                                  after: Optional[str] = None, status: Optional[str] = None,
+                                  user_id: Optional[str] = None) -> list[models.Run]:
     """
-    Get all run objects from an event
+    Get a page of the runs of an event, ordered by date then ID. When more runs may follow, the X-Next-Cursor
+    header holds the cursor of the next page
 
     :param event_id: Event to check
+    :param limit: Maximum amount of runs to return
+    :param after: Cursor from the X-Next-Cursor header of the previous page
+    :param status: Only return runs with this status
+    :param user_id: Only return runs of this user
     :return: List of runs
     """
 
+    # get a page of runs, checking the event in the same session
+    runs = await ec.get_runs(event_id, limit, decode_cursor(after) if after is not None else None, status, user_id)
+
     # check for valid event object
-    if ec.retrieve_event(event_id) is None:
+    if runs is None:
         raise HTTPException(status_code=404, detail="Event not found.")
 
-    # get all runs from event
-    runs = ec.get_all_run_ids(event_id)
+    # a full page may have more runs after it
+    if len(runs) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(runs[-1].date, runs[-1].ID)
 
-    # check for success getting ids
-    if runs is None:
-        raise HTTPException(status_code=500, detail="Failed to get runs from event")
+    return runs
 
-    # retrieve run objects from ids
 
-    return runs
+@router.get("/event/calendar", tags=["Event"], response_model=list[models.CalendarEvent])
+async def get_calendar(start: datetime, end: datetime, request: Request, user: Annotated[User, Depends(retrieve_user)],
+                       ec: EventCommandsDep):
+    """
+    Gets the events of every plan the user belongs to between two dates, ordered by date. The response has an ETag,
+    send it back in If-None-Match to get an empty 304 when the window has not changed
+
+    :param start: Start of the window, inclusive
+    :param end: End of the window, exclusive
+    :param user: User of the OAuth 2 token
+    :return: List of events with their plan name
+    """
+
+    # check for a valid window
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+
+    if end - start > MAX_CALENDAR_WINDOW:
+        raise HTTPException(status_code=400, detail=f"Window cannot be longer than {MAX_CALENDAR_WINDOW.days} days")
+
+    events = await ec.get_calendar(user.ID, start, end)
+
+    return etag_response(request, [models.CalendarEvent.from_orm(event) for event in events])
 
 
 @router.delete("/event/delete", tags=["Event"])
-def delete_event(event_id: str):
+async def delete_event(event_id: str, ec: EventCommandsDep):
     """
     Deletes an event
 
@@ -135,11 +220,11 @@ def delete_event(event_id: str):
     """
 
     # check for valid event
-    if ec.retrieve_event(event_id) is None:
+    if await ec.retrieve_event(event_id) is None:
         raise HTTPException(status_code=404, detail="Event not found.")
 
     # delete event
-    deleted_event = ec.delete_event(event_id)
+    deleted_event = await ec.delete_event(event_id)
 
     # check for success
     if deleted_event is False:
@@ -0,0 +1,101 @@
+"""
+ops_api.py
+By: Zack Bamford
+
+Operations API: metrics and statistics of the pools and caches, only served with the OPS_TOKEN
+"""
+import os
+import secrets
+from typing import Annotated, Optional
+
+from fastapi import APIRouter, Header, HTTPException, status
+from fastapi.params import Depends
+from fastapi.responses import PlainTextResponse
+
+from api.src.main.api.dependencies import PasswordHasherDep
+from api.src.main.api.metrics import request_metrics
+from api.src.main.db import generic_db, user_db
+from api.src.main.db.cache import response_cache
+
+# bearer token of the monitoring, the routes are not served when unset
+OPS_TOKEN = os.environ.get("OPS_TOKEN", "")
+
+
+async def verify_ops_token(authorization: Annotated[Optional[str], Header()] = None):
+    """
+    Checks the request carries the OPS_TOKEN as a bearer token
+
+    :param authorization: Authorization header
+    :return:
+    """
+
+    # hide the routes when they are not configured
+    if not OPS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+
+    scheme, _, token = (authorization or "").partition(" ")
+
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode(), OPS_TOKEN.encode()):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+
+# setup
+router = APIRouter(tags=["Ops"], dependencies=[Depends(verify_ops_token)])
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Per-route latency, status codes, requests in flight and database statements per request, in the Prometheus text
+    format
+
+    :return: Exposition text
+    """
+    return PlainTextResponse(request_metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/db/pool")
+async def pool_stats():
+    """
+    Connection pool checkout and wait statistics, used to size DB_POOL_SIZE and DB_MAX_OVERFLOW, and the reads sent
+    to each DB_READ_URL replica
+
+    :return: Statistics of the sync and async pools and replicas
+    """
+    stats = {"sync": generic_db.db_obj.pool_stats(), "async": generic_db.async_db_obj.pool_stats()}
+
+    if generic_db.async_db_obj.replicas is not None:
+        stats["read_replicas"] = generic_db.async_db_obj.replicas.as_dict()
+
+    return stats
+
+
+@router.get("/auth/hashing")
+async def hashing_stats(hasher: PasswordHasherDep):
+    """
+    Password hashing latency and queue depth, used to size PASSWORD_HASH_WORKERS and PASSWORD_HASH_QUEUE
+
+    :return: Statistics of the hashing pool
+    """
+    return hasher.stats.as_dict()
+
+
+@router.get("/auth/cache")
+async def principal_cache_stats():
+    """
+    Hit rate of the authenticated user cache, used to size AUTH_CACHE_SIZE and AUTH_CACHE_TTL
+
+    :return: Statistics of the cache
+    """
+    return user_db.principal_cache.as_dict()
+
+
+@router.get("/cache/responses")
+async def response_cache_stats():
+    """
+    Hit rate and memory use of the response cache, used to size RESPONSE_CACHE_MAX_BYTES and the TTLs
+
+    :return: Statistics of the cache
+    """
+    return response_cache.as_dict()
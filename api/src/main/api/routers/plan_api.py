@@ -6,21 +6,23 @@ User API operations
 """
 from datetime import datetime
 
-from fastapi import HTTPException, APIRouter
+from typing import Optional, Literal
 
-from api.src.main.db import generic_db
-from api.src.main.db.plan_db import Plan, PlanCommands
-from api.src.main.db.user_db import UserCommands
+from fastapi import HTTPException, APIRouter, Query
+from fastapi.responses import StreamingResponse
+
+from api.src.main.api import models
+from api.src.main.api.dependencies import PlanCommandsDep, UserCommandsDep
+from api.src.main.api.export import MEDIA_TYPES, ndjson_chunks, csv_chunks, gzip_chunks
+from api.src.main.api.pagination import MAX_PAGE_SIZE
+from api.src.main.db.plan_db import plan_activity_query, UNIT_METERS
 
 # setup
 router = APIRouter()
-Plan.metadata.create_all(bind=generic_db.db_obj.engine)
-pc: PlanCommands = PlanCommands(generic_db.db_obj)
-uc: UserCommands = UserCommands(generic_db.db_obj)
 
 
 @router.post("/plan/create", tags=["Plan"])
-def create_plan(name: str, description: str, date: datetime, distance: float, unit: str):
+async def create_plan(name: str, description: str, date: datetime, distance: float, unit: str, pc: PlanCommandsDep):
     """
     Creates a plan
 
@@ -33,7 +35,7 @@ def create_plan(name: str, description: str, date: datetime, distance: float, un
     """
 
     # create plan
-    created_plan = pc.create_plan(name, description, date, distance, unit)
+    created_plan = await pc.create_plan(name, description, date, distance, unit)
 
     # check for success
     if created_plan is None:
@@ -43,7 +45,7 @@ def create_plan(name: str, description: str, date: datetime, distance: float, un
 
 
 @router.post("/plan/add_users", tags=["Plan"])
-def add_users(plan_id: str, users: list[str]):
+async def add_users(plan_id: str, users: list[str], pc: PlanCommandsDep, uc: UserCommandsDep):
     """
     Adds users to a plan
 
@@ -53,16 +55,15 @@ def add_users(plan_id: str, users: list[str]):
     """
 
     # check that plan exists
-    if pc.retrieve_plan(plan_id) is None:
+    if await pc.retrieve_plan(plan_id) is None:
         raise HTTPException(status_code=404, detail="Plan not found.")
 
     # check that all users are valid
-    for user in users:
-        if uc.retrieve_user(user) is None:
-            raise HTTPException(status_code=404, detail="One or more users not found.")
+    if len(await uc.retrieve_users(users)) != len(set(users)):
+        raise HTTPException(status_code=404, detail="One or more users not found.")
 
     # add users
-    updated_plan = pc.add_users_to_plan(plan_id, users)
+    updated_plan = await pc.add_users_to_plan(plan_id, users)
 
     # check for success
     if updated_plan is None:
@@ -70,4 +71,136 @@ def add_users(plan_id: str, users: list[str]):
 
     return updated_plan
 
+
+@router.get("/plan/members", tags=["Plan"])
+async def get_members(plan_id: str, pc: PlanCommandsDep, limit: int = Query(default=100, gt=0, le=MAX_PAGE_SIZE),
+                      after: Optional[str] = None) -> list[models.User]:
+    """
+    Lists the members of a plan, ordered by user ID
+
+    :param plan_id: ID of the plan
+    :param limit: Maximum amount of users to return
+    :param after: Last user ID of the previous page
+    :return: List of users
+    """
+
+    members = await pc.get_plan_members(plan_id, limit, after)
+
+    # check that plan exists
+    if members is None:
+        raise HTTPException(status_code=404, detail="Plan not found.")
+
+    return members
+
+
+@router.get("/plan/detail", response_model=models.PlanTree, response_model_by_alias=False, tags=["Plan"])
+async def get_plan_detail(plan_id: str, pc: PlanCommandsDep, depth: int = Query(default=2, ge=0, le=2)):
+    """
+    Gets a plan with its events and their runs in one request, loaded with at most three queries
+
+    :param plan_id: ID of the plan
+    :param depth: 0 for the plan only, 1 to add its events, 2 to add the runs of each event
+    :return: Plan tree, levels past the depth are null
+    """
+
+    plan = await pc.get_plan_tree(plan_id, depth)
+
+    # check that plan exists
+    if plan is None:
+        raise HTTPException(status_code=404, detail="Plan not found.")
+
+    tree = models.PlanTree.from_orm(plan)
+
+    # mark the levels that were not loaded
+    if depth < 1:
+        tree.events = None
+    elif depth < 2:
+        for event in tree.events:
+            event.runs = None
+
+    return tree
+
+
+@router.get("/plan/progress", tags=["Plan"])
+async def get_progress(plan_id: str, pc: PlanCommandsDep, unit: str = "km") -> list[models.PlanProgress]:
+    """
+    Gets how far each member of a plan has gone, furthest first. Distances of every event are converted to the
+    requested unit in the database
+
+    :param plan_id: ID of the plan
+    :param unit: Unit of the returned distances, such as km, mi or m
+    :return: Completed events, completed distance and percentage of the plan distance per member
+    """
+
+    # check for a known unit
+    if unit.lower() not in UNIT_METERS:
+        raise HTTPException(status_code=400, detail=f"Unknown unit, expected one of: {', '.join(UNIT_METERS)}")
+
+    progress = await pc.get_plan_progress(plan_id, unit.lower())
+
+    # check that plan exists
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Plan not found.")
+
+    return progress
+
+
+@router.get("/plan/leaderboard", tags=["Plan"])
+async def get_leaderboard(plan_id: str, pc: PlanCommandsDep, limit: int = Query(default=10, gt=0, le=MAX_PAGE_SIZE),
+                          unit: str = "km") -> list[models.LeaderboardEntry]:
+    """
+    Gets the members of a plan who have gone the furthest, read from a leaderboard kept up to date as runs change
+
+    :param plan_id: ID of the plan
+    :param limit: Amount of members to return
+    :param unit: Unit of the returned distances, such as km, mi or m
+    :return: Completed events and completed distance of the top members
+    """
+
+    # check for a known unit
+    if unit.lower() not in UNIT_METERS:
+        raise HTTPException(status_code=400, detail=f"Unknown unit, expected one of: {', '.join(UNIT_METERS)}")
+
+    leaderboard = await pc.get_leaderboard(plan_id, limit, unit.lower())
+
+    # check that plan exists
+    if leaderboard is None:
+        raise HTTPException(status_code=404, detail="Plan not found.")
+
+    return leaderboard
+
+
+@router.get("/plan/export", tags=["Plan"])
+async def export_plan(plan_id: str, pc: PlanCommandsDep,
+                      file_format: Literal["ndjson", "csv"] = Query(default="ndjson", alias="format"),
+                      gzip: bool = False):
+    """
+    Streams every event of a plan joined to its runs, one row per run, for bulk exports
+
+    :param plan_id: ID of the plan
+    :param file_format: ndjson or csv
+    :param gzip: Compress the stream with gzip
+    :return: Streamed rows
+    """
+
+    # check that plan exists before the stream starts
+    if await pc.retrieve_plan(plan_id) is None:
+        raise HTTPException(status_code=404, detail="Plan not found.")
+
+    # rows are read and serialized one batch at a time while the response is sent
+    batches = pc.stream_plan_activity(plan_id)
+
+    if file_format == "csv":
+        chunks = csv_chunks(batches, list(plan_activity_query(plan_id).selected_columns.keys()))
+    else:
+        chunks = ndjson_chunks(batches)
+
+    headers = {"Content-Disposition": f'attachment; filename="{plan_id}.{file_format}"'}
+
+    if gzip:
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+
+    return StreamingResponse(chunks, media_type=MEDIA_TYPES[file_format], headers=headers)
+
 # TODO: Add more when admin system gets written
@@ -6,24 +6,23 @@ Run API operations
 """
 from datetime import datetime
 
-from fastapi import HTTPException, APIRouter
+from fastapi import HTTPException, APIRouter, Request
 
-from api.src.main.db import generic_db
 import api.src.main.api.models as models
-from api.src.main.db.event_db import EventCommands
-from api.src.main.db.run_db import RunCommands, Run
-from api.src.main.db.user_db import UserCommands
+from api.src.main.api.cached import cached_entity
+from api.src.main.api.dependencies import EventCommandsDep, RunCommandsDep, UserCommandsDep
+from api.src.main.db.plan_db import Run
 
 # setup
 router = APIRouter()
-Run.metadata.create_all(bind=generic_db.db_obj.engine)
-ec: EventCommands = EventCommands(generic_db.db_obj)
-rc: RunCommands = RunCommands(generic_db.db_obj)
-uc: UserCommands = UserCommands(generic_db.db_obj)
+
+# largest amount of runs in one bulk request
+MAX_BULK_SIZE = 10000
 
 
 @router.post("/run/create", tags=["Run"], response_model=models.Run)
-def create_run(event_id: str, user_id: str, date: datetime, status: str):
+async def create_run(event_id: str, user_id: str, date: datetime, status: str, ec: EventCommandsDep,
+                     rc: RunCommandsDep, uc: UserCommandsDep):
     """
     Creates a run
 
@@ -35,19 +34,19 @@ def create_run(event_id: str, user_id: str, date: datetime, status: str):
     """
 
     # check for valid event_id
-    event_check = ec.retrieve_event(event_id)
+    event_check = await ec.retrieve_event(event_id)
 
     if event_check is None:
         raise HTTPException(status_code=404, detail="Event not found")
 
     # check for valid parent user
-    user_check = uc.retrieve_user(user_id)
+    user_check = await uc.retrieve_user(user_id)
 
     if user_check is None:
         raise HTTPException(status_code=404, detail="User not found")
 
     # create run
-    created_run = rc.create_run(event_id, user_id, date, status)
+    created_run = await rc.create_run(event_id, user_id, date, status)
 
     # check for success
     if created_run is None:
@@ -56,27 +55,58 @@ def create_run(event_id: str, user_id: str, date: datetime, status: str):
     return created_run
 
 
+@router.post("/run/bulk_create", tags=["Run"])
+async def bulk_create_runs(runs: list[models.RunCreate], ec: EventCommandsDep, rc: RunCommandsDep,
+                           uc: UserCommandsDep) -> list[models.BulkRunResult]:
+    """
+    Creates many runs at once, such as a device syncing after being offline. Runs with an unknown event or user are
+    skipped and the rest are created
+
+    :param runs: Runs to create
+    :return: Result per run in the same order, with the created ID or an error
+    """
+
+    if len(runs) > MAX_BULK_SIZE:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_SIZE} runs per request")
+
+    # check every referenced event and user at once
+    event_ids = await ec.get_existing_event_ids([run.event_id for run in runs])
+    user_ids = await uc.get_existing_user_ids([run.usr_id for run in runs])
+
+    results: list[models.BulkRunResult | None] = []
+    valid_runs = []
+
+    for run in runs:
+        if run.event_id not in event_ids:
+            results.append(models.BulkRunResult(error="Event not found"))
+        elif run.usr_id not in user_ids:
+            results.append(models.BulkRunResult(error="User not found"))
+        else:
+            results.append(None)
+            valid_runs.append(run.dict())
+
+    # create the valid runs in one transaction
+    created_ids = iter(await rc.create_runs(valid_runs))
+
+    return [result or models.BulkRunResult(ID=next(created_ids)) for result in results]
+
+
 @router.get("/run/info", tags=["Run"], response_model=models.Run)
-def get_run(run_id: str):
+async def get_run(run_id: str, request: Request, rc: RunCommandsDep):
     """
-    Retrieves a run
+    Retrieves a run, served from the response cache when possible. The ETag follows the run version, a matching
+    If-None-Match gets an empty 304
 
     :param run_id: Valid run_id
     :return: Run object
     """
 
-    # get run
-    run = rc.get_run(run_id)
-
-    # check for success
-    if run is None:
-        raise HTTPException(status_code=404, detail="Run not found")
-
-    return run
+    return await cached_entity(request, "run", run_id, models.Run, lambda: rc.get_run(run_id), "Run not found",
+                               lambda: rc.get_version(Run, run_id))
 
 
 @router.delete("/run/delete", tags=["Run"])
-def delete_run(run_id: str):
+async def delete_run(run_id: str, rc: RunCommandsDep):
     """
     Deletes a run
 
@@ -85,7 +115,7 @@ def delete_run(run_id: str):
     """
 
     # delete run
-    deleted_run = rc.delete_run(run_id)
+    deleted_run = await rc.delete_run(run_id)
 
     # check for success
     if not deleted_run:
@@ -4,26 +4,28 @@ By: Zack Bamford
 
 User API operations
 """
+from datetime import datetime, timedelta
 from typing import Annotated
 
-import bcrypt
-from fastapi import HTTPException, APIRouter
+from fastapi import HTTPException, APIRouter, Query, Request, Response
 from fastapi.params import Depends
 from pydantic import EmailStr
 
 from api.src.main.api import models
-from api.src.main.api.auth import oauth2_scheme, retrieve_user
-from api.src.main.db import generic_db
-from api.src.main.db.user_db import UserCommands, User
+from api.src.main.api.auth import retrieve_user
+from api.src.main.api.cached import cached_entity
+from api.src.main.api.dependencies import UserCommandsDep, PasswordHasherDep, PlanCommandsDep
+from api.src.main.api.etags import version_etag, etag_headers, if_match_version
+from api.src.main.api.passwords import HasherBusyError
+from api.src.main.db.generic_db import StaleVersionError
+from api.src.main.db.user_db import User
 
 router = APIRouter()
 
-User.metadata.create_all(bind=generic_db.db_obj.engine)
-uc: UserCommands = UserCommands(generic_db.db_obj)
-
 
 @router.post("/user/create", tags=["User"])
-def create_user(username: str, email: EmailStr, password: str):
+async def create_user(username: str, email: EmailStr, password: str, uc: UserCommandsDep,
+                      hasher: PasswordHasherDep):
     """
     Creates a user
 
@@ -34,13 +36,18 @@ def create_user(username: str, email: EmailStr, password: str):
     """
 
     # Check if email is already used
-    user_check = uc.retrieve_user_by_email(email)
+    user_check = await uc.retrieve_user_by_email(email)
 
     if user_check is not None:
         raise HTTPException(status_code=409, detail="Email already in use")
 
-    created_user = uc.create_user(username, email,
-                                  bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(15)).decode('utf-8'))
+    try:
+        hashed_password = await hasher.hash(password)
+    except HasherBusyError:
+        raise HTTPException(status_code=503, detail="Too many password operations, try again later",
+                            headers={"Retry-After": "1"})
+
+    created_user = await uc.create_user(username, email, hashed_password)
 
     # check for success
     if created_user is None:
@@ -50,68 +57,69 @@ def create_user(username: str, email: EmailStr, password: str):
 
 
 @router.get("/user/info", response_model=models.User, tags=["User"])
-def get_user(token: Annotated[str, Depends(oauth2_scheme)]):
+async def get_user(user: Annotated[User, Depends(retrieve_user)], uc: UserCommandsDep, request: Request):
     """
-    Retrieves a user
+    Retrieves a user, served from the response cache when possible. The ETag follows the user version, a matching
+    If-None-Match gets an empty 304
 
-    :param token: OAuth 2 token
+    :param user: User of the OAuth 2 token
     :return: User object
     """
-    # get user
-    user = retrieve_user(token)
 
-    # check for success
-    if user is None:
-        raise HTTPException(status_code=404, detail="User not found")
+    # the user of the token may be an older cached copy, so the response is loaded from the database
+    return await cached_entity(request, "user", user.ID, models.User, lambda: uc.retrieve_user(user.ID),
+                               "User not found", lambda: uc.get_version(User, user.ID))
 
-    return user
 
-
-@router.post("/user/modify", response_model=models.User, tags=["User"])
-def modify_user(token: Annotated[str, Depends(oauth2_scheme)],
-                username: str | None = None, email: EmailStr | None = None, ):
+@router.get("/user/dashboard", response_model=models.Dashboard, response_model_by_alias=False, tags=["User"])
+async def get_dashboard(user: Annotated[User, Depends(retrieve_user)], pc: PlanCommandsDep,
+                        days: int = Query(default=30, gt=0, le=366)):
     """
-    Modify a user
+    Retrieves everything the landing page shows in one request: the user, their plans, the upcoming events of each
+    plan and the user's own runs of those events
 
-    :param user_id: User ID to modify
-    :param token: OAuth 2 token
-    :param username: New name
-    :param email: New email
-    :return: Updated user
+    :param user: User of the OAuth 2 token
+    :param days: Amount of days ahead to include events from
+    :return: Dashboard object
     """
 
-    # get user
-    retrieved_user = retrieve_user(token)
+    now = datetime.now()
+    plans = await pc.get_dashboard_plans(user.ID, now, now + timedelta(days=days))
 
-    # check for success
-    if retrieved_user is None:
-        raise HTTPException(status_code=404, detail="User not found")
+    return models.Dashboard(user=user, plans=plans)
 
-    # overwrite optional fields
-    if username is not None:
-        retrieved_user.username = username
 
-    if email is not None:
-        retrieved_user.email = email
+@router.post("/user/modify", response_model=models.User, tags=["User"])
+async def modify_user(retrieved_user: Annotated[User, Depends(retrieve_user)], uc: UserCommandsDep, request: Request,
+                      response: Response, username: str | None = None, email: EmailStr | None = None, ):
+    """
+    Modify a user. Send the ETag of /user/info in If-Match to only modify the version that was read
 
-    # commit changes
-    modified_user = uc.modify_user(retrieved_user.ID, retrieved_user.username, retrieved_user.email,
-                                   retrieved_user.password)
+    :param retrieved_user: User of the OAuth 2 token
+    :param username: New name, or None to keep it
+    :param email: New email, or None to keep it
+    :return: Updated user
+    """
 
-    return modified_user
+    # only the given fields are written, the retrieved user may be an older cached copy
+    try:
+        modified_user = await uc.modify_user(retrieved_user.ID, username, email,
+                                             expected_version=if_match_version(request))
+    except StaleVersionError:
+        raise HTTPException(status_code=412, detail="User was modified since it was read")
 
+    # the user of the token exists, so nothing being updated means the email is taken
+    if modified_user is None:
+        raise HTTPException(status_code=409, detail="Email already in use")
 
-@router.delete("/user/delete", response_model=models.User, tags=["User"])
-def delete_user(token: Annotated[str, Depends(oauth2_scheme)]):
-    # get user
-    retrieved_user = retrieve_user(token)
+    response.headers.update(etag_headers(version_etag(modified_user.version)))
+    return modified_user
 
-    # check for success
-    if retrieved_user is None:
-        raise HTTPException(status_code=404, detail="User not found")
 
+@router.delete("/user/delete", response_model=models.User, tags=["User"])
+async def delete_user(retrieved_user: Annotated[User, Depends(retrieve_user)], uc: UserCommandsDep):
     # delete user
-    deleted = uc.delete_user(retrieved_user.ID)
+    deleted = await uc.delete_user(retrieved_user.ID)
 
     # see if operation succeeded
     if deleted is False:
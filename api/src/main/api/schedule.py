@@ -0,0 +1,200 @@
+"""
+schedule.py
+By: Zack Bamford
+
+Streaming parsers for uploaded training schedules, yielding one record at a time as the request body arrives
+"""
+import codecs
+import csv
+import json
+from typing import Any, AsyncIterator
+
+# JSON values in an array are separated by commas and whitespace
+_JSON_SEPARATORS = " \t\r\n,"
+
+# longest line or JSON value held while waiting for the rest of it, in characters
+MAX_RECORD_SIZE = 64 * 1024
+
+
+class RecordTooLargeError(Exception):
+    """
+    Raised when a line or JSON value is longer than MAX_RECORD_SIZE, so an unterminated record cannot fill memory
+    """
+
+
+class RowError:
+    """
+    Error of a row that could not be parsed, yielded in place of its record
+    """
+
+    def __init__(self, message: str):
+        """
+        :param message: Why the row could not be parsed, without the row's content
+        """
+
+        self.message = message
+
+    def __eq__(self, other):
+        return isinstance(other, RowError) and self.message == other.message
+
+    def __repr__(self):
+        return f"RowError: {self.message}"
+
+
+# records yielded by the parsers: a dictionary of fields, any other JSON value (rejected by validation), or the
+# RowError of a row that could not be parsed
+Record = Any
+
+
+async def text_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """
+    Decode UTF-8 chunks and split them into lines, a line may span many chunks
+
+    :param chunks: Raw body chunks
+    :return: Iterator of lines without their line ending
+    :raises RecordTooLargeError: If a line is longer than MAX_RECORD_SIZE
+    """
+
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+
+        for line in lines:
+            if len(line) > MAX_RECORD_SIZE:
+                raise RecordTooLargeError(f"Line longer than {MAX_RECORD_SIZE} characters")
+
+            yield line.rstrip("\r")
+
+        if len(pending) > MAX_RECORD_SIZE:
+            raise RecordTooLargeError(f"Line longer than {MAX_RECORD_SIZE} characters")
+
+    pending += decoder.decode(b"", final=True)
+
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def csv_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Record]:
+    """
+    Parse a CSV with a header line, quoted fields cannot contain line breaks
+
+    :param chunks: Raw body chunks
+    :return: Iterator of records keyed by the header
+    """
+
+    header = None
+
+    async for line in text_lines(chunks):
+        # skip blank lines
+        if not line.strip():
+            continue
+
+        values = next(csv.reader([line]))
+
+        if header is None:
+            header = [value.strip() for value in values]
+        elif len(values) != len(header):
+            yield RowError(f"Expected {len(header)} fields, got {len(values)}")
+        else:
+            yield dict(zip(header, values))
+
+
+async def ndjson_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Record]:
+    """
+    Parse one JSON object per line
+
+    :param chunks: Raw body chunks
+    :return: Iterator of records
+    """
+
+    async for line in text_lines(chunks):
+        if not line.strip():
+            continue
+
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            yield RowError(f"Invalid JSON: {e.msg}")
+
+
+async def json_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Record]:
+    """
+    Parse a JSON array of objects, decoding each object as soon as it is complete
+
+    :param chunks: Raw body chunks
+    :return: Iterator of records, or a single error if the array itself is malformed
+    :raises RecordTooLargeError: If a value is longer than MAX_RECORD_SIZE
+    """
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    position = 0
+    started = False
+    finished = False
+
+    async def parse(final: bool):
+        nonlocal buffer, position, started, finished
+
+        while not finished:
+            # skip to the next value
+            while position < len(buffer) and buffer[position] in _JSON_SEPARATORS:
+                position += 1
+
+            if position == len(buffer):
+                break
+
+            if not started:
+                if buffer[position] != "[":
+                    yield RowError("Expected a JSON array")
+                    finished = True
+                    return
+
+                started = True
+                position += 1
+                continue
+
+            if buffer[position] == "]":
+                finished = True
+                return
+
+            try:
+                value, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                # the value may continue in the next chunk
+                if not final:
+                    break
+
+                yield RowError(f"Invalid JSON: {e.msg}")
+                finished = True
+                return
+
+            yield value
+
+        # drop the parsed text
+        buffer, position = buffer[position:], 0
+
+    async for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+
+        async for record in parse(False):
+            yield record
+
+        # only the value still being received is left in the buffer
+        if len(buffer) > MAX_RECORD_SIZE:
+            raise RecordTooLargeError(f"JSON value longer than {MAX_RECORD_SIZE} characters")
+
+    buffer += text_decoder.decode(b"", final=True)
+
+    async for record in parse(True):
+        yield record
+
+    if not finished:
+        yield RowError("Unterminated JSON array")
+
+
+# parser of each upload format
+PARSERS = {"csv": csv_records, "json": json_records, "ndjson": ndjson_records}
@@ -0,0 +1,518 @@
+"""
+cache.py
+By: Zack Bamford
+
+In-process caches for objects read on every request, and the response cache with pluggable storage
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after a fixed time.
+    Entries can carry the version of the value, invalidating leaves a marker of the new version so a value loaded
+    before the change and set after it is not cached over it
+    """
+
+    # marker version of a deleted value, no value passes it
+    DELETED = sys.maxsize
+
+    # value of an invalidation marker, read as a miss
+    _MARKER = object()
+
+    def __init__(self, max_size: int, ttl: float):
+        """
+        :param max_size: Maximum amount of entries, the least recently used entry is evicted past this
+        :param ttl: Seconds an entry stays valid, 0 disables the cache
+        """
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[Hashable, tuple[float, Any, Optional[int]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Get an entry
+
+        :param key: Key of the entry
+        :return: Cached value, or None if missing, expired or invalidated
+        """
+
+        with self.lock:
+            entry = self._live(key)
+
+            if entry is None or entry[1] is self._MARKER:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, version: Optional[int] = None):
+        """
+        Add or replace an entry, unless a newer version was set or invalidated meanwhile
+
+        :param key: Key of the entry
+        :param value: Value to cache
+        :param version: Version of the value, or None if it is not versioned
+        """
+
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+
+        with self.lock:
+            entry = self._live(key)
+
+            if entry is not None and entry[2] is not None and (version is None or version < entry[2]):
+                return
+
+            self._store(key, value, version)
+
+    def invalidate(self, key: Hashable, version: Optional[int] = None):
+        """
+        Replace an entry with a marker of the version it changed to, values of older versions are not cached until the
+        marker expires
+
+        :param key: Key of the entry
+        :param version: Version written by the change, or None if the value was deleted
+        """
+
+        version = self.DELETED if version is None else version
+
+        with self.lock:
+            if self.ttl <= 0 or self.max_size <= 0:
+                self.entries.pop(key, None)
+                return
+
+            entry = self._live(key)
+
+            # a newer value is already cached
+            if entry is not None and entry[2] is not None and entry[2] >= version:
+                return
+
+            self._store(key, self._MARKER, version)
+
+    def _live(self, key: Hashable) -> Optional[tuple[float, Any, Optional[int]]]:
+        # drop expired entries on read, the lock is held by the caller
+        entry = self.entries.get(key)
+
+        if entry is not None and entry[0] <= time.monotonic():
+            del self.entries[key]
+            return None
+
+        return entry
+
+    def _store(self, key: Hashable, value: Any, version: Optional[int]):
+        # the lock is held by the caller
+        self.entries[key] = (time.monotonic() + self.ttl, value, version)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Remove every entry
+        """
+
+        with self.lock:
+            self.entries.clear()
+
+    def as_dict(self) -> dict:
+        """
+        Snapshot of the hit rate counters
+
+        :return: Dictionary of hits, misses, hit rate, evictions and size
+        """
+
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions, "size": len(self.entries)}
+
+
+class CacheBackend(ABC):
+    """
+    Storage behind a ResponseCache, keyed by string with byte values. Subclass it to share entries between workers
+    """
+
+    def __init__(self):
+        self.evictions = 0
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Get an entry
+
+        :param key: Key of the entry
+        :return: Stored bytes, or None if missing or expired
+        """
+
+    @abstractmethod
+    def set(self, key: str, value: bytes, ttl: float, condition: Optional[Callable[[bytes], bool]] = None):
+        """
+        Add or replace an entry, evicting the least recently used entries past the memory budget
+
+        :param key: Key of the entry
+        :param value: Bytes to store
+        :param ttl: Seconds the entry stays valid
+        :param condition: Called with the stored bytes in the same atomic step, the entry is only replaced if it
+            returns True
+        """
+
+    @abstractmethod
+    def delete(self, key: str):
+        """
+        Remove an entry if it exists
+
+        :param key: Key of the entry
+        """
+
+    @abstractmethod
+    def clear(self):
+        """
+        Remove every entry
+        """
+
+    @abstractmethod
+    def usage(self) -> tuple[int, int]:
+        """
+        Amount of stored entries and bytes
+
+        :return: Tuple of entries and bytes
+        """
+
+
+class MemoryBackend(CacheBackend):
+    """
+    In-process LRU storage bounded by the total size of its values
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        :param max_bytes: Memory budget of the stored keys and values
+        """
+
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.bytes = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return None
+
+            # drop expired entries on read
+            if entry[0] <= time.monotonic():
+                self._remove(key)
+                return None
+
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: bytes, ttl: float, condition: Optional[Callable[[bytes], bool]] = None):
+        # an entry larger than the budget would evict everything else
+        if len(key) + len(value) > self.max_bytes:
+            return
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if condition is not None and entry is not None and entry[0] > time.monotonic() and \
+                    not condition(entry[1]):
+                return
+
+            self._remove(key)
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.bytes += len(key) + len(value)
+
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def delete(self, key: str):
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def usage(self) -> tuple[int, int]:
+        with self.lock:
+            return len(self.entries), self.bytes
+
+    def _remove(self, key: str):
+        # caller holds the lock
+        entry = self.entries.pop(key, None)
+
+        if entry is not None:
+            self.bytes -= len(key) + len(entry[1])
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Storage in a local SQLite file shared by every worker on the machine, put it on /dev/shm to keep it in memory
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        """
+        :param path: Path of the cache database, created on first use
+        :param max_bytes: Budget of the stored values
+        """
+
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # open the file on first use
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                               "expires REAL NOT NULL, accessed REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_entries_accessed ON entries (accessed)")
+            self._connection = connection
+
+        return self._connection
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+
+        with self.lock:
+            row = self.connection.execute("SELECT value, expires FROM entries WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                return None
+
+            if row[1] <= now:
+                self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+
+            self.connection.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, value: bytes, ttl: float, condition: Optional[Callable[[bytes], bool]] = None):
+        if len(value) > self.max_bytes:
+            return
+
+        now = time.time()
+
+        with self.lock:
+            connection = self.connection
+            connection.execute("BEGIN IMMEDIATE")
+
+            try:
+                # the write lock is held, so no other worker changes the entry between the check and the write
+                if condition is not None:
+                    row = connection.execute("SELECT value FROM entries WHERE key = ? AND expires > ?",
+                                             (key, now)).fetchone()
+
+                    if row is not None and not condition(row[0]):
+                        connection.execute("COMMIT")
+                        return
+
+                connection.execute("INSERT OR REPLACE INTO entries (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+                                   (key, value, now + ttl, now))
+
+                # evict the least recently used entries past the budget, expired ones first
+                connection.execute("DELETE FROM entries WHERE expires <= ?", (now,))
+                total = connection.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM entries").fetchone()[0]
+
+                if total > self.max_bytes:
+                    evicted = 0
+
+                    for old_key, size in connection.execute("SELECT key, LENGTH(value) FROM entries WHERE key != ? "
+                                                            "ORDER BY accessed", (key,)).fetchall():
+                        if total <= self.max_bytes:
+                            break
+
+                        connection.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+                        total -= size
+                        evicted += 1
+
+                    self.evictions += evicted
+
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def delete(self, key: str):
+        with self.lock:
+            self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM entries")
+
+    def usage(self) -> tuple[int, int]:
+        with self.lock:
+            entries, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) "
+                                                    "FROM entries").fetchone()
+            return entries, size
+
+
+def _stored_version(value: bytes) -> int:
+    # entries start with the version, invalidation markers are only the version
+    return int(value.split(b"\n", 1)[0])
+
+
+class ResponseCache:
+    """
+    Serialized JSON responses per entity, with the version for the ETag. Entries are invalidated by the Commands that
+    modify or delete the entity and expire after the TTL of their kind.
+    Invalidating leaves a marker with the new version, so a response loaded before the change and cached after it is
+    not stored over it
+    """
+
+    # marker version of a deleted entity, no response passes it
+    DELETED = sys.maxsize
+
+    def __init__(self, backend: CacheBackend, ttls: dict[str, float], default_ttl: float):
+        """
+        :param backend: Storage of the entries
+        :param ttls: Seconds an entry stays valid per kind, such as "event"
+        :param default_ttl: Seconds for kinds without a TTL, 0 disables the cache
+        """
+
+        self.backend = backend
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.lock = threading.Lock()
+        self.hits: dict[str, int] = {}
+        self.misses: dict[str, int] = {}
+
+    def ttl(self, kind: str) -> float:
+        return self.ttls.get(kind, self.default_ttl)
+
+    def get(self, kind: str, entity_id: str) -> Optional[tuple[int, bytes]]:
+        """
+        Get a cached response
+
+        :param kind: Kind of entity, such as "event"
+        :param entity_id: ID of the entity
+        :return: Tuple of the entity version and the JSON body, or None if not cached
+        """
+
+        value = self.backend.get(f"{kind}:{entity_id}") if self.ttl(kind) > 0 else None
+
+        # an invalidation marker is a miss
+        if value is not None and b"\n" not in value:
+            value = None
+
+        with self.lock:
+            counts = self.misses if value is None else self.hits
+            counts[kind] = counts.get(kind, 0) + 1
+
+        if value is None:
+            return None
+
+        # stored as the version, a newline, then the body
+        version, body = value.split(b"\n", 1)
+        return int(version), body
+
+    def set(self, kind: str, entity_id: str, version: int, body: bytes):
+        """
+        Cache a response, unless a newer version was cached or invalidated meanwhile
+
+        :param kind: Kind of entity, such as "event"
+        :param entity_id: ID of the entity
+        :param version: Version of the entity
+        :param body: Serialized JSON body
+        """
+
+        if self.ttl(kind) > 0:
+            self.backend.set(f"{kind}:{entity_id}", b"%d\n%s" % (version, body), self.ttl(kind),
+                             lambda stored: _stored_version(stored) <= version)
+
+    def invalidate(self, kind: str, entity_id: str, version: Optional[int] = None):
+        """
+        Replace a cached response with a marker of the version it changed to, responses of older versions are not
+        cached until the marker expires
+
+        :param kind: Kind of entity, such as "event"
+        :param entity_id: ID of the entity
+        :param version: Version written by the modify, or None if the entity was deleted
+        """
+
+        version = self.DELETED if version is None else version
+
+        if self.ttl(kind) > 0:
+            self.backend.set(f"{kind}:{entity_id}", b"%d" % version, self.ttl(kind),
+                             lambda stored: _stored_version(stored) < version)
+        else:
+            self.backend.delete(f"{kind}:{entity_id}")
+
+    def clear(self):
+        """
+        Remove every cached response
+        """
+
+        self.backend.clear()
+
+    def as_dict(self) -> dict:
+        """
+        Snapshot of the hit rate counters and memory use
+
+        :return: Dictionary of hits and misses per kind, evictions, entries and bytes
+        """
+
+        entries, size = self.backend.usage()
+
+        with self.lock:
+            hits, misses = sum(self.hits.values()), sum(self.misses.values())
+            return {"hits": dict(self.hits), "misses": dict(self.misses),
+                    "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                    "evictions": self.backend.evictions, "entries": entries, "bytes": size}
+
+
+def response_cache_from_env() -> ResponseCache:
+    """
+    Create the response cache from the RESPONSE_CACHE_* env vars
+
+    :return: Response cache
+    """
+
+    max_bytes = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+    if os.environ.get("RESPONSE_CACHE_BACKEND", "memory") == "sqlite":
+        backend = SQLiteBackend(os.environ.get("RESPONSE_CACHE_PATH", os.path.join(tempfile.gettempdir(),
+                                                                                   "run_response_cache.db")),
+                                max_bytes)
+    else:
+        backend = MemoryBackend(max_bytes)
+
+    # RESPONSE_CACHE_TTL_EVENT and so on override the default per kind
+    ttls = {name.removeprefix("RESPONSE_CACHE_TTL_").lower(): float(value) for name, value in os.environ.items()
+            if name.startswith("RESPONSE_CACHE_TTL_")}
+
+    return ResponseCache(backend, ttls, float(os.environ.get("RESPONSE_CACHE_TTL", 30)))
+
+
+# serialized responses of single entities, shared by the Commands that invalidate them and the routers that fill them
+response_cache = response_cache_from_env()
@@ -8,34 +8,22 @@ from datetime import datetime
 from typing import Optional
 
 import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session, relationship
 from sqlalchemy.orm import Mapped
 
 from api.src.main.db import generic_db
-from api.src.main.db.plan_db import PlanCommands, Plan, Run
-from api.src.main.db.user_db import User
+from api.src.main.db.cache import response_cache
+from api.src.main.db.plan_db import Plan, Run, event_runs_query, leaderboard_event_update, meters, calendar_query, \
+    leaderboard_distance_update
 from api.src.main.db.plan_db import Event
 
 
-class EventCommands:
+class EventCommands(generic_db.DBCommands):
     """
     Class to manage events within the database
     """
 
-    def __init__(self, db_obj: generic_db.DBModificationObject):
-        """
-        Create a new EventCommands object
-
-        :param db_obj: DBModificationObject to use
-        """
-
-        # add to db
-        Event.metadata.create_all(db_obj.engine)
-
-        self.engine: sqlalchemy.Engine = db_obj.engine
-
-        self.pc: PlanCommands = PlanCommands(db_obj)
-
     def add_event(self, name: str, date: datetime, distance: float, distance_unit: str, plan_id: str) -> \
             Optional[Event]:
         """
@@ -67,6 +55,25 @@ class EventCommands:
 
             return session.get(Event, event.ID)
 
+    def add_events(self, plan_id: str, events: list[dict]) -> list[str]:
+        """
+        Insert many events into a plan with a single executemany in one transaction, the plan is not checked
+
+        :param plan_id: Plan ID to add the events to
+        :param events: Dictionaries with the name, date, distance and distance_unit of each event
+        :return: Created event IDs, in the same order as the events
+        """
+
+        rows = [dict(event, ID=generic_db.create_id("EVENT"), plan_id=plan_id) for event in events]
+
+        if rows:
+            with Session(self.engine) as session:
+                session.execute(sqlalchemy.insert(Event), rows)
+                session.commit()
+
+        return [row["ID"] for row in rows]
+
+    @generic_db.replica_read
     def retrieve_event(self, event_id: str) -> Optional[Event]:
         """
         Retrieve an event from the database
@@ -75,29 +82,82 @@ class EventCommands:
         :return: Retrieved event
         """
 
-        with Session(self.engine) as session:
+        with Session(self.read_engine) as session:
             return session.get(Event, event_id)
 
-    def get_all_run_ids(self, event_id: str) -> Optional[list[Run]]:
+    def get_existing_event_ids(self, event_ids: list[str]) -> set[str]:
         """
-        Get all event IDs
+        Check which event IDs exist with set-based queries, selecting only the ID column
 
-        :param event_id: Event ID to get all run IDs for
-        :return: List of event IDs, or none if error
+        :param event_ids: Event IDs to check
+        :return: Set of the event IDs that exist
         """
 
+        existing = set()
+
         with Session(self.engine) as session:
+            # one query per chunk to respect the bind parameter limit
+            for chunk in generic_db.chunks(list(dict.fromkeys(event_ids))):
+                existing.update(session.scalars(sqlalchemy.select(Event.ID).where(Event.ID.in_(chunk))))
+
+        return existing
+
+    @generic_db.replica_read
+    def get_all_run_ids(self, event_id: str) -> Optional[list[Run]]:
+        """
+        Get all runs of an event
+
+        :param event_id: Event ID to get all runs for
+        :return: List of runs ordered by date then ID, or none if error
+        """
+
+        with Session(self.read_engine) as session:
             # check for valid event
             event: Optional[Event] = session.get(Event, event_id)
 
             if event is None:
                 return []
 
-            return event.run
+            # query the runs directly instead of returning a collection tied to the closing session
+            return list(session.scalars(sqlalchemy.select(Run).where(Run.event_id == event_id)
+                                        .order_by(Run.date, Run.ID)))
 
+    def get_runs(self, event_id: str, limit: Optional[int] = None,
+                 after: Optional[tuple[Optional[datetime], str]] = None, status: Optional[str] = None,
+                 user_id: Optional[str] = None) -> Optional[list[sqlalchemy.Row]]:
+        """
+        Get a page of the runs of an event, selecting only the ID, date and status columns
+
+        :param event_id: Event ID to get runs for
+        :param limit: Maximum amount of runs, or None for all
+        :param after: Only get runs after this (date, run ID) pair, the date is None after a run without a date
+        :param status: Only get runs with this status
+        :param user_id: Only get runs of this user
+        :return: Rows ordered by date then ID, runs without a date last, or None if the event does not exist
+        """
 
-    def modify_event(self, event_id: str, name: str, date: datetime, distance: float, distance_unit: str) -> \
-            Optional[Event]:
+        with Session(self.engine) as session:
+            # check for valid event
+            if session.scalar(sqlalchemy.select(Event.ID).where(Event.ID == event_id)) is None:
+                return None
+
+            return list(session.execute(event_runs_query(event_id, limit, after, status, user_id)))
+
+    def get_calendar(self, user_id: str, start: datetime, end: datetime) -> list[sqlalchemy.Row]:
+        """
+        Get the events of every plan a user belongs to within a date window
+
+        :param user_id: User ID
+        :param start: Start of the window, inclusive
+        :param end: End of the window, exclusive
+        :return: Rows of calendar_query ordered by date then ID
+        """
+
+        with Session(self.engine) as session:
+            return list(session.execute(calendar_query(user_id, start, end)))
+
+    def modify_event(self, event_id: str, name: str, date: datetime, distance: float, distance_unit: str,
+                     expected_version: Optional[int] = None) -> Optional[Event]:
         """
         Modify an event in the database
 
@@ -106,25 +166,26 @@ class EventCommands:
         :param date: New event due date
         :param distance: New event distance
         :param distance_unit: New event distance unit
+        :param expected_version: Only modify if the event is still at this version, from If-Match
+        :raises StaleVersionError: If the event was modified since expected_version
         :return: Modified event
         """
 
-        with Session(self.engine) as session:
-            # check for valid event
-            event: Optional[Event] = session.get(Event, event_id)
+        with Session(self.engine, expire_on_commit=False) as session:
+            # move the distance of every user who completed the event, reading the old distance in the same statement
+            session.execute(leaderboard_distance_update(event_id, meters(distance, distance_unit)))
+
+            # modify event in one statement, no row means no event
+            event: Optional[Event] = generic_db.update_returning(session, Event, event_id, {
+                "name": name, "date": date, "distance": distance, "distance_unit": distance_unit}, expected_version)
 
             if event is None:
                 return None
 
-            # modify event
-            event.name = name
-            event.date = date
-            event.distance = distance
-            event.distance_unit = distance_unit
-
             session.commit()
+            response_cache.invalidate("event", event_id, event.version)
 
-            return session.get(Event, event.ID)
+            return event
 
     def delete_event(self, event_id: str) -> bool:
         """
@@ -141,9 +202,223 @@ class EventCommands:
             if event is None:
                 return False
 
+            # remove the event from the leaderboard before its runs are deleted
+            session.execute(leaderboard_event_update(event, -1, -meters(event.distance, event.distance_unit)))
+
+            # the runs are deleted with the event
+            run_ids = session.scalars(sqlalchemy.select(Run.ID).where(Run.event_id == event_id)).all()
+
             # delete event
             session.delete(event)
 
             session.commit()
 
-            return True
\ No newline at end of file
+            response_cache.invalidate("event", event_id)
+
+            for run_id in run_ids:
+                response_cache.invalidate("run", run_id)
+
+            return True
+
+
+class AsyncEventCommands(generic_db.AsyncDBCommands):
+    """
+    Async class to manage events within the database, mirroring EventCommands
+    """
+
+    async def add_event(self, name: str, date: datetime, distance: float, distance_unit: str, plan_id: str) -> \
+            Optional[Event]:
+        """
+        Add an event to the database
+
+        :param name: Event name
+        :param date: Event due date
+        :param distance: Distance of event
+        :param distance_unit: Distance unit of event
+        :param plan_id: Plan ID to add event to
+        :return: Created event
+        """
+
+        async with AsyncSession(self.engine) as session:
+            # check for valid plan
+            plan: Optional[Plan] = await session.get(Plan, plan_id)
+
+            if plan is None:
+                return None
+
+            # create event, setting the foreign key directly as the child_events collection cannot lazy load here
+            event_id = generic_db.create_id("EVENT")
+            event: Event = Event(ID=event_id, plan_id=plan_id, name=name, date=date, distance=distance,
+                                 distance_unit=distance_unit)
+
+            # add to db
+            session.add(event)
+
+            await session.commit()
+
+            return await session.get(Event, event_id)
+
+    async def add_events(self, plan_id: str, events: list[dict]) -> list[str]:
+        """
+        Insert many events into a plan with a single executemany in one transaction, the plan is not checked
+
+        :param plan_id: Plan ID to add the events to
+        :param events: Dictionaries with the name, date, distance and distance_unit of each event
+        :return: Created event IDs, in the same order as the events
+        """
+
+        rows = [dict(event, ID=generic_db.create_id("EVENT"), plan_id=plan_id) for event in events]
+
+        if rows:
+            async with AsyncSession(self.engine) as session:
+                await session.execute(sqlalchemy.insert(Event), rows)
+                await session.commit()
+
+        return [row["ID"] for row in rows]
+
+    @generic_db.replica_read
+    async def retrieve_event(self, event_id: str) -> Optional[Event]:
+        """
+        Retrieve an event from the database
+
+        :param event_id: Event ID to retrieve
+        :return: Retrieved event
+        """
+
+        async with AsyncSession(self.read_engine) as session:
+            return await session.get(Event, event_id)
+
+    async def get_existing_event_ids(self, event_ids: list[str]) -> set[str]:
+        """
+        Check which event IDs exist with set-based queries, selecting only the ID column
+
+        :param event_ids: Event IDs to check
+        :return: Set of the event IDs that exist
+        """
+
+        existing = set()
+
+        async with AsyncSession(self.engine) as session:
+            # one query per chunk to respect the bind parameter limit
+            for chunk in generic_db.chunks(list(dict.fromkeys(event_ids))):
+                existing.update(await session.scalars(sqlalchemy.select(Event.ID).where(Event.ID.in_(chunk))))
+
+        return existing
+
+    @generic_db.replica_read
+    async def get_all_run_ids(self, event_id: str) -> Optional[list[Run]]:
+        """
+        Get all runs of an event
+
+        :param event_id: Event ID to get all runs for
+        :return: List of runs ordered by date then ID, or none if error
+        """
+
+        async with AsyncSession(self.read_engine) as session:
+            # check for valid event
+            event: Optional[Event] = await session.get(Event, event_id)
+
+            if event is None:
+                return []
+
+            # query the runs directly, the relationship cannot lazy load in async code
+            return list(await session.scalars(sqlalchemy.select(Run).where(Run.event_id == event_id)
+                                              .order_by(Run.date, Run.ID)))
+
+    async def get_runs(self, event_id: str, limit: Optional[int] = None,
+                       after: Optional[tuple[Optional[datetime], str]] = None, status: Optional[str] = None,
+                       user_id: Optional[str] = None) -> Optional[list[sqlalchemy.Row]]:
+        """
+        Get a page of the runs of an event, selecting only the ID, date and status columns
+
+        :param event_id: Event ID to get runs for
+        :param limit: Maximum amount of runs, or None for all
+        :param after: Only get runs after this (date, run ID) pair, the date is None after a run without a date
+        :param status: Only get runs with this status
+        :param user_id: Only get runs of this user
+        :return: Rows ordered by date then ID, runs without a date last, or None if the event does not exist
+        """
+
+        async with AsyncSession(self.engine) as session:
+            # check for valid event
+            if await session.scalar(sqlalchemy.select(Event.ID).where(Event.ID == event_id)) is None:
+                return None
+
+            return list(await session.execute(event_runs_query(event_id, limit, after, status, user_id)))
+
+    async def get_calendar(self, user_id: str, start: datetime, end: datetime) -> list[sqlalchemy.Row]:
+        """
+        Get the events of every plan a user belongs to within a date window
+
+        :param user_id: User ID
+        :param start: Start of the window, inclusive
+        :param end: End of the window, exclusive
+        :return: Rows of calendar_query ordered by date then ID
+        """
+
+        async with AsyncSession(self.engine) as session:
+            return list(await session.execute(calendar_query(user_id, start, end)))
+
+    async def modify_event(self, event_id: str, name: str, date: datetime, distance: float, distance_unit: str,
+                           expected_version: Optional[int] = None) -> Optional[Event]:
+        """
+        Modify an event in the database
+
+        :param event_id: Event ID to modify
+        :param name: New event name
+        :param date: New event due date
+        :param distance: New event distance
+        :param distance_unit: New event distance unit
+        :param expected_version: Only modify if the event is still at this version, from If-Match
+        :raises StaleVersionError: If the event was modified since expected_version
+        :return: Modified event
+        """
+
+        async with AsyncSession(self.engine, expire_on_commit=False) as session:
+            # move the distance of every user who completed the event, reading the old distance in the same statement
+            await session.execute(leaderboard_distance_update(event_id, meters(distance, distance_unit)))
+
+            # modify event in one statement, no row means no event
+            event: Optional[Event] = await generic_db.async_update_returning(session, Event, event_id, {
+                "name": name, "date": date, "distance": distance, "distance_unit": distance_unit}, expected_version)
+
+            if event is None:
+                return None
+
+            await session.commit()
+            response_cache.invalidate("event", event_id, event.version)
+
+            return event
+
+    async def delete_event(self, event_id: str) -> bool:
+        """
+        Delete an event from the database
+
+        :param event_id: Event ID to delete
+        :return: If the event was deleted
+        """
+
+        async with AsyncSession(self.engine) as session:
+            # check for valid event
+            event: Optional[Event] = await session.get(Event, event_id)
+
+            if event is None:
+                return False
+
+            # remove the event from the leaderboard before its runs are deleted
+            await session.execute(leaderboard_event_update(event, -1, -meters(event.distance, event.distance_unit)))
+
+            # the runs are deleted with the event
+            run_ids = (await session.scalars(sqlalchemy.select(Run.ID).where(Run.event_id == event_id))).all()
+
+            # delete event
+            await session.delete(event)
+
+            await session.commit()
+
+            response_cache.invalidate("event", event_id)
+
+            for run_id in run_ids:
+                response_cache.invalidate("run", run_id)
+
+            return True
@@ -4,48 +4,862 @@ By: Zack Bamford
 
 File to manage basic database items
 """
+import asyncio
+import functools
 import os
+import threading
+import time
 import uuid
 import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Generic, Iterator, Optional, Sequence, TypeVar
 
 import sqlalchemy
-from sqlalchemy import create_engine
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.orm import DeclarativeBase, Session
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+from api.src.main.db import tracing
+
+
+# named shared-cache memory database, so the sync and async debug engines see the same data
+DEBUG_DB = "file:run_debug?mode=memory&cache=shared&uri=true"
+
+# async drivers to use when deriving DB_ASYNC_URL from DB_URL
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+# keep IN lists well below the bind parameter limits of SQLite (999 on old builds) and Postgres
+MAX_BIND_PARAMS = 500
+
+T = TypeVar("T")
+B = TypeVar("B", bound="Base")
+E = TypeVar("E", sqlalchemy.Engine, AsyncEngine)
+
+
+class StaleVersionError(Exception):
+    """
+    Raised when a modify expected a version of a row that has since changed
+    """
+
+
+class RequestScope:
+    """
+    State of one API request, shared with the greenlets the async engine runs in
+    """
+
+    def __init__(self):
+        self.wrote = False
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.trace: Optional[tracing.QueryTrace] = tracing.QueryTrace() if tracing.TRACE_QUERIES else None
+
+
+# scope of the current request, None outside of requests
+_request_scope: ContextVar[Optional[RequestScope]] = ContextVar("request_scope", default=None)
+
+# set while retrying a failed replica read on the primary
+_primary_reads: ContextVar[bool] = ContextVar("primary_reads", default=False)
 
 
 class Base(DeclarativeBase):
     pass
 
 
+class PoolStats:
+    """
+    Checkout counters for a connection pool, used to size the pool against real traffic
+    """
+
+    def __init__(self):
+        """
+        Create a new, empty, PoolStats object
+        """
+
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record_checkout(self, wait_seconds: float, timed_out: bool = False):
+        """
+        Record a checkout attempt
+
+        :param wait_seconds: Time spent waiting for a connection
+        :param timed_out: If the checkout hit the pool timeout
+        """
+
+        with self.lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+    def as_dict(self, pool: Optional[sqlalchemy.Pool]) -> dict:
+        """
+        Get the counters along with the current state of the pool
+
+        :param pool: Pool the counters belong to, or None if the engine was not created yet
+        :return: Dictionary of statistics
+        """
+
+        with self.lock:
+            stats = {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": self.wait_seconds / self.checkouts * 1000 if self.checkouts else 0.0,
+                "max_wait_ms": self.max_wait_seconds * 1000,
+            }
+
+        # only queue pools have a size, memory databases use a single shared connection
+        if isinstance(pool, QueuePool):
+            stats.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow())
+
+        return stats
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that records how long each checkout waited for a connection, including opening new ones
+    """
+
+    stats: PoolStats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+
+        try:
+            connection = super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            self.stats.record_checkout(time.perf_counter() - start, timed_out=True)
+            raise
+
+        self.stats.record_checkout(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        # keep counting into the same stats when the engine is disposed
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+class TimedAsyncAdaptedQueuePool(TimedQueuePool, AsyncAdaptedQueuePool):
+    """
+    AsyncAdaptedQueuePool that records how long each checkout waited for a connection, including opening new ones
+    """
+
+
+class ReplicaSet(Generic[E]):
+    """
+    Read replicas chosen round-robin. A replica whose connection fails is ejected for DB_READ_EJECT_SECONDS, and
+    reads go to the primary while every replica is ejected
+    """
+
+    def __init__(self, urls: list[str], create: Callable[[str], E], eject_seconds: float):
+        """
+        :param urls: URLs of the replicas
+        :param create: Creates the engine of a URL, each engine is created on first use
+        :param eject_seconds: Seconds a failed replica receives no reads
+        """
+
+        self.urls = urls
+        self.create = create
+        self.eject_seconds = eject_seconds
+        self.lock = threading.Lock()
+        self.engines: list[Optional[E]] = [None] * len(urls)
+        self.ejected_until = [0.0] * len(urls)
+        self.reads = [0] * len(urls)
+        self.ejections = [0] * len(urls)
+        self.primary_reads = 0
+        self.next = 0
+
+    def choose(self) -> Optional[int]:
+        """
+        Choose the replica for a read
+
+        :return: Index of the next healthy replica, or None to read from the primary
+        """
+
+        with self.lock:
+            now = time.monotonic()
+
+            for offset in range(len(self.urls)):
+                index = (self.next + offset) % len(self.urls)
+
+                if self.ejected_until[index] <= now:
+                    self.next = index + 1
+                    self.reads[index] += 1
+                    return index
+
+            self.primary_reads += 1
+            return None
+
+    def engine(self, index: int) -> E:
+        """
+        Get the engine of a replica, creating it on first use
+
+        :param index: Index of the replica
+        :return: Engine
+        """
+
+        if self.engines[index] is None:
+            with self.lock:
+                if self.engines[index] is None:
+                    engine = self.create(self.urls[index])
+                    track_queries(getattr(engine, "sync_engine", engine))
+
+                    # eject on connection errors, including failures to connect
+                    @event.listens_for(getattr(engine, "sync_engine", engine), "handle_error")
+                    def on_error(context):
+                        if context.is_disconnect or isinstance(context.sqlalchemy_exception,
+                                                               sqlalchemy.exc.OperationalError):
+                            self.eject(index)
+
+                    self.engines[index] = engine
+
+        return self.engines[index]
+
+    def eject(self, index: int):
+        """
+        Stop reading from a replica for eject_seconds
+
+        :param index: Index of the replica
+        """
+
+        with self.lock:
+            self.ejected_until[index] = time.monotonic() + self.eject_seconds
+            self.ejections[index] += 1
+
+        logging.warning(f"Ejected read replica {index} for {self.eject_seconds} seconds")
+
+    def as_dict(self) -> dict:
+        """
+        Snapshot of the reads per replica
+
+        :return: Dictionary of reads sent to the primary and the reads and ejections of each replica
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            return {"primary_reads": self.primary_reads,
+                    "replicas": [{"reads": self.reads[i], "ejections": self.ejections[i],
+                                  "ejected": self.ejected_until[i] > now} for i in range(len(self.urls))]}
+
+
 class DBModificationObject:
     """
-    Superclass designed to create an SQLAlchemy engine for DB modification libraries
+    Superclass designed to create an SQLAlchemy engine for DB modification libraries.
+    The engine is created on first use, so importing the DB libraries does not touch the database.
+    """
+
+    def __init__(self):
+        """
+        Create the object.
+        """
+
+        self._engine: Optional[sqlalchemy.Engine] = None
+        self.lock = threading.Lock()
+        self.stats: PoolStats = PoolStats()
+        self.replicas: Optional[ReplicaSet[sqlalchemy.Engine]] = replica_set(
+            lambda url: create_engine(url, **engine_options(QueuePool)))
+
+    @property
+    def engine(self) -> sqlalchemy.Engine:
+        """
+        Get the engine, creating it on first use.
+        Function will use DB_URL env var, or wil set to debug mode if that does not exist.
+        Pooling is configured through the DB_POOL_* env vars, see engine_options.
+        """
+
+        if self._engine is None:
+            with self.lock:
+                if self._engine is None:
+                    try:
+                        engine = create_engine(os.environ["DB_URL"], **engine_options(TimedQueuePool))
+                    except KeyError:
+                        logging.info("No DB_URL environmental variable set, using debug in memory database.")
+                        engine = create_engine(f"sqlite+pysqlite:///{DEBUG_DB}", echo=env_flag("DB_ECHO"))
+
+                        # the debug database starts out empty
+                        create_debug_schema(engine)
+
+                    track_pool(engine, self.stats)
+                    set_sqlite_pragmas(engine)
+                    track_writes(engine)
+                    track_queries(engine)
+                    self._engine = engine
+
+        return self._engine
+
+    @property
+    def read_engine(self) -> sqlalchemy.Engine:
+        """
+        Get the engine for a read that may lag behind the primary, a replica from DB_READ_URL if one is healthy
+        """
+
+        index = self.replicas.choose() if self.replicas is not None and replica_reads_allowed() else None
+        return self.engine if index is None else self.replicas.engine(index)
+
+    def pool_stats(self) -> dict:
+        """
+        Get the connection pool statistics
+
+        :return: Dictionary of statistics
+        """
+
+        return self.stats.as_dict(self._engine.pool if self._engine is not None else None)
+
+
+class AsyncDBModificationObject:
+    """
+    Variant of DBModificationObject that creates an asyncio SQLAlchemy engine for the async DB modification libraries.
+    The engine is created on first use, so importing the DB libraries does not touch the database.
     """
-    engine: sqlalchemy.Engine
 
     def __init__(self):
         """
         Create the object.
-        Function will use DB_URL env var, or wil set to debug mode if that does not exist
         """
+
+        self._engine: Optional[AsyncEngine] = None
+        self.lock = threading.Lock()
+        self.stats: PoolStats = PoolStats()
+        self.replicas: Optional[ReplicaSet[AsyncEngine]] = replica_set(
+            lambda url: create_async_engine(async_url(url), **engine_options(AsyncAdaptedQueuePool)))
+
+    @property
+    def engine(self) -> AsyncEngine:
+        """
+        Get the engine, creating it on first use.
+        Function will use DB_ASYNC_URL env var, or derive it from DB_URL by swapping in the async driver.
+        Uses the debug in memory database if neither exist.
+        """
+
+        if self._engine is None:
+            with self.lock:
+                if self._engine is None:
+                    try:
+                        engine = create_async_engine(async_url(), **engine_options(TimedAsyncAdaptedQueuePool))
+                    except KeyError:
+                        logging.info("No DB_URL environmental variable set, using debug in memory database.")
+                        engine = create_async_engine(f"sqlite+aiosqlite:///{DEBUG_DB}", echo=env_flag("DB_ECHO"))
+
+                        # the sync debug engine creates the schema, and its connection keeps the memory database open
+                        _ = db_obj.engine
+
+                    track_pool(engine.sync_engine, self.stats)
+                    set_sqlite_pragmas(engine.sync_engine)
+                    track_writes(engine.sync_engine)
+                    track_queries(engine.sync_engine)
+                    self._engine = engine
+
+        return self._engine
+
+    @property
+    def read_engine(self) -> AsyncEngine:
+        """
+        Get the engine for a read that may lag behind the primary, a replica from DB_READ_URL if one is healthy
+        """
+
+        index = self.replicas.choose() if self.replicas is not None and replica_reads_allowed() else None
+        return self.engine if index is None else self.replicas.engine(index)
+
+    def pool_stats(self) -> dict:
+        """
+        Get the connection pool statistics
+
+        :return: Dictionary of statistics
+        """
+
+        return self.stats.as_dict(self._engine.sync_engine.pool if self._engine is not None else None)
+
+
+class DBCommands:
+    """
+    Superclass for the DB modification libraries, giving access to the engine of a DBModificationObject
+    """
+
+    def __init__(self, db_obj: DBModificationObject):
+        """
+        Create a new commands object, the engine is only created once a command runs
+
+        :param db_obj: DBModificationObject to use
+        """
+
+        self.db_obj: DBModificationObject = db_obj
+
+    @property
+    def engine(self) -> sqlalchemy.Engine:
+        return self.db_obj.engine
+
+    @property
+    def read_engine(self) -> sqlalchemy.Engine:
+        return self.db_obj.read_engine
+
+    def get_version(self, model: type["Base"], row_id: str) -> Optional[int]:
+        """
+        Get the version of a row with a primary key lookup, without loading the row
+
+        :param model: Model class with ID and version columns
+        :param row_id: ID of the row
+        :return: Version, or None if no row has the ID
+        """
+
+        with Session(self.engine) as session:
+            return session.scalar(version_query(model, row_id))
+
+
+class AsyncDBCommands:
+    """
+    Superclass for the async DB modification libraries, giving access to the engine of an AsyncDBModificationObject
+    """
+
+    def __init__(self, db_obj: AsyncDBModificationObject):
+        """
+        Create a new async commands object, the engine is only created once a command runs
+
+        :param db_obj: AsyncDBModificationObject to use
+        """
+
+        self.db_obj: AsyncDBModificationObject = db_obj
+
+    @property
+    def engine(self) -> AsyncEngine:
+        return self.db_obj.engine
+
+    @property
+    def read_engine(self) -> AsyncEngine:
+        return self.db_obj.read_engine
+
+    async def get_version(self, model: type["Base"], row_id: str) -> Optional[int]:
+        """
+        Get the version of a row with a primary key lookup, without loading the row
+
+        :param model: Model class with ID and version columns
+        :param row_id: ID of the row
+        :return: Version, or None if no row has the ID
+        """
+
+        async with AsyncSession(self.engine) as session:
+            return await session.scalar(version_query(model, row_id))
+
+
+def create_debug_schema(engine: sqlalchemy.Engine):
+    """
+    Create every table in the debug database
+
+    :param engine: Debug engine
+    """
+
+    # imported here so every model is registered on Base, these modules depend on this one
+    from api.src.main.db import user_db, plan_db
+
+    Base.metadata.create_all(engine)
+
+
+def env_flag(name: str) -> bool:
+    """
+    Read a true/false env var
+
+    :param name: Name of the env var
+    :return: If the env var is set to a true value
+    """
+
+    return os.environ.get(name, "").lower() in ("1", "true", "yes")
+
+
+def engine_options(poolclass: type[QueuePool]) -> dict:
+    """
+    Get the engine options for a database set through DB_URL.
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (seconds), DB_POOL_RECYCLE (seconds, -1 to disable),
+    DB_POOL_PRE_PING and DB_ECHO env vars override the defaults.
+
+    :param poolclass: Pool class to use
+    :return: Keyword arguments for create_engine/create_async_engine
+    """
+
+    return {
+        "poolclass": poolclass,
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", -1)),
+        "pool_pre_ping": env_flag("DB_POOL_PRE_PING"),
+        "echo": env_flag("DB_ECHO"),
+    }
+
+
+def track_pool(engine: sqlalchemy.Engine, stats: PoolStats):
+    """
+    Record an engine's checkouts into the given statistics
+
+    :param engine: Engine to track
+    :param stats: Statistics to record into
+    """
+
+    if isinstance(engine.pool, TimedQueuePool):
+        engine.pool.stats = stats
+
+
+def set_sqlite_pragmas(engine: sqlalchemy.Engine):
+    """
+    Apply performance pragmas to every new connection of an SQLite file database.
+    Uses WAL journaling with synchronous=NORMAL, and the DB_SQLITE_MMAP_SIZE (bytes, default 256 MiB) and
+    DB_SQLITE_CACHE_SIZE (SQLite cache_size value, default -65536 which is 64 MiB) env vars.
+
+    :param engine: Engine to apply the pragmas to, use engine.sync_engine for async engines
+    """
+
+    # memory databases have no journal or file to map
+    if engine.dialect.name != "sqlite" or engine.url.database in (None, "", ":memory:") or \
+            engine.url.query.get("mode") == "memory":
+        return
+
+    mmap_size = int(os.environ.get("DB_SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+    cache_size = int(os.environ.get("DB_SQLITE_CACHE_SIZE", -64 * 1024))
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA mmap_size={mmap_size}")
+        cursor.execute(f"PRAGMA cache_size={cache_size}")
+        cursor.close()
+
+
+def async_url(url: Optional[str] = None) -> str:
+    """
+    Get the URL for the async engine
+
+    :param url: URL to swap the driver of, defaults to the primary database
+    :return: DB_ASYNC_URL, or the URL with its driver swapped for the async one
+    """
+
+    if url is None and "DB_ASYNC_URL" in os.environ:
+        return os.environ["DB_ASYNC_URL"]
+
+    url = sqlalchemy.make_url(url or os.environ["DB_URL"])
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))\
+        .render_as_string(hide_password=False)
+
+
+def replica_set(create: Callable[[str], E]) -> Optional[ReplicaSet[E]]:
+    """
+    Get the read replicas from the comma separated DB_READ_URL env var, DB_READ_EJECT_SECONDS (default 30) sets how
+    long a failed replica is skipped
+
+    :param create: Creates the engine of a URL
+    :return: Replica set, or None if no replicas are set or the debug database is used
+    """
+
+    urls = [url.strip() for url in os.environ.get("DB_READ_URL", "").split(",") if url.strip()]
+
+    if not urls or "DB_URL" not in os.environ:
+        return None
+
+    return ReplicaSet(urls, create, float(os.environ.get("DB_READ_EJECT_SECONDS", 30)))
+
+
+def track_writes(engine: sqlalchemy.Engine):
+    """
+    Mark the current request as a writer when it commits on the primary, so its later reads see its own writes
+
+    :param engine: Primary engine, use engine.sync_engine for async engines
+    """
+
+    @event.listens_for(engine, "commit")
+    def on_commit(connection):
+        scope = _request_scope.get()
+
+        if scope is not None:
+            scope.wrote = True
+
+
+def track_queries(engine: sqlalchemy.Engine):
+    """
+    Count the statements of the current request and the time spent executing them, tracing them when
+    DB_TRACE_QUERIES is set and logging the ones slower than DB_SLOW_QUERY_MS
+
+    :param engine: Engine to track, use engine.sync_engine for async engines
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_execute(connection, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_execute(connection, cursor, statement, parameters, context, executemany):
+        if context is None:
+            return
+
+        seconds = time.perf_counter() - context.query_start
+        tracing.log_slow_query(statement, parameters, seconds)
+        scope = _request_scope.get()
+
+        if scope is not None:
+            scope.queries += 1
+            scope.query_seconds += seconds
+
+            if scope.trace is not None:
+                scope.trace.record(statement, seconds)
+
+
+def start_request() -> RequestScope:
+    """
+    Start the scope of an API request, reads go to the replicas until the request commits on the primary
+
+    :return: Scope of the request
+    """
+
+    scope = RequestScope()
+    _request_scope.set(scope)
+    return scope
+
+
+def replica_reads_allowed() -> bool:
+    """
+    Check if a read in the current context may go to a replica
+
+    :return: False if the request wrote, or a failed replica read is being retried
+    """
+
+    scope = _request_scope.get()
+    return not _primary_reads.get() and (scope is None or not scope.wrote)
+
+
+@contextmanager
+def primary_reads():
+    """
+    Send every read inside the context to the primary
+    """
+
+    token = _primary_reads.set(True)
+
+    try:
+        yield
+    finally:
+        _primary_reads.reset(token)
+
+
+def replica_read(method: Callable) -> Callable:
+    """
+    Decorate a Commands method reading through read_engine, retrying it on the primary if a replica connection fails
+
+    :param method: Sync or async method
+    :return: Wrapped method
+    """
+
+    def retry(self, e: sqlalchemy.exc.DBAPIError) -> bool:
+        # only connection failures while replicas are in use are retried
+        return self.db_obj.replicas is not None and not _primary_reads.get() and \
+            (e.connection_invalidated or isinstance(e, sqlalchemy.exc.OperationalError))
+
+    if asyncio.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_wrapper(self, *args, **kwargs):
+            try:
+                return await method(self, *args, **kwargs)
+            except sqlalchemy.exc.DBAPIError as e:
+                if not retry(self, e):
+                    raise
+
+            with primary_reads():
+                return await method(self, *args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
         try:
-            self.engine = create_engine(os.environ["DB_URL"], echo=False)
-        except KeyError:
-            logging.info("No DB_URL environmental variable set, using debug in memory database.")
-            self.engine = create_engine("sqlite+pysqlite:///:memory:", echo=True)
+            return method(self, *args, **kwargs)
+        except sqlalchemy.exc.DBAPIError as e:
+            if not retry(self, e):
+                raise
 
-        # create tables
-        Base.metadata.create_all(self.engine)
+        with primary_reads():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class UUID7Generator:
+    """
+    Time-ordered UUIDs in the UUIDv7 layout: 48 bits of Unix milliseconds, then a 42 bit counter started at a random
+    value each millisecond and 32 random bits. IDs made by one process sort in creation order, so inserts append to
+    the right edge of the primary key index instead of landing on a random page
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_ms = 0
+        self.counter = 0
+
+    def __call__(self) -> uuid.UUID:
+        random_bits = int.from_bytes(os.urandom(10), "big")
+
+        with self.lock:
+            ms = time.time_ns() // 1_000_000
+
+            if ms > self.last_ms:
+                # leave headroom below the top bit so the counter rarely overflows within a millisecond
+                self.last_ms, self.counter = ms, random_bits >> 39
+            else:
+                # same millisecond, or the clock went back: keep counting on the last timestamp
+                self.counter += 1
+
+                if self.counter >> 42:
+                    self.last_ms, self.counter = self.last_ms + 1, 0
+
+            ms, counter = self.last_ms, self.counter
+
+        # version 7 in front of the top 12 counter bits, variant 10 in front of the rest
+        value = (ms << 80) | (0x7 << 76) | (counter >> 30 << 64) | (0b10 << 62) | \
+            ((counter & (1 << 30) - 1) << 32) | (random_bits & 0xFFFFFFFF)
+        return uuid.UUID(int=value)
+
+
+# UUID generators selectable with the DB_ID_FORMAT env var
+ID_FORMATS = {
+    "uuid4": uuid.uuid4,
+    "uuid7": UUID7Generator(),
+}
+
+
+def id_generator() -> Callable[[], uuid.UUID]:
+    """
+    Get the UUID generator set by DB_ID_FORMAT, uuid4 (default) for random IDs or uuid7 for time-ordered ones
+
+    :return: Function returning a new UUID
+    """
+
+    id_format = os.environ.get("DB_ID_FORMAT", "uuid4")
+
+    if id_format not in ID_FORMATS:
+        raise ValueError(f"DB_ID_FORMAT must be one of {', '.join(ID_FORMATS)}, got {id_format}")
+
+    return ID_FORMATS[id_format]
+
+
+# read once, create_id runs for every inserted row
+_new_uuid: Callable[[], uuid.UUID] = id_generator()
 
 
 def create_id(object_name: str) -> str:
     """
-    Create a random job ID using uuid4
+    Create a unique ID with the generator set by DB_ID_FORMAT
     :param object_name: The object code to append to the ID
-    :return: Random ID in the format of OBJECTNAME_UUID
+    :return: ID in the format of OBJECTNAME_UUID, as 32 upper case hex digits
+    """
+    return f"{object_name}_{_new_uuid().hex.upper()}"
+
+
+def chunks(items: Sequence[T], size: int = MAX_BIND_PARAMS) -> Iterator[Sequence[T]]:
+    """
+    Split a sequence into chunks, used to keep IN lists under the bind parameter limit
+
+    :param items: Items to split
+    :param size: Maximum size of each chunk
+    :return: Iterator over the chunks
     """
-    return f"{object_name}_{str(uuid.uuid4()).replace('-', '').upper()}"
 
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
-# create and store the DB modification object
+
+# create and store the DB modification objects
 db_obj: DBModificationObject = DBModificationObject()
+async_db_obj: AsyncDBModificationObject = AsyncDBModificationObject()
+
+
+def version_query(model: type["Base"], row_id: str) -> sqlalchemy.Select:
+    """
+    Build a primary key lookup of the version of a row
+
+    :param model: Model class with ID and version columns
+    :param row_id: ID of the row
+    :return: Select statement of the version
+    """
+
+    return sqlalchemy.select(model.version).where(model.ID == row_id)
+
+
+def _update_statement(model: type[B], row_id: str, values: dict, expected_version: Optional[int]) -> \
+        sqlalchemy.Update:
+    # every modify bumps the version, the session is not synchronized as modify methods work in a fresh session
+    statement = sqlalchemy.update(model).where(model.ID == row_id).values(**values, version=model.version + 1)\
+        .execution_options(synchronize_session=False)
+
+    if expected_version is not None:
+        statement = statement.where(model.version == expected_version)
+
+    return statement
+
+
+def update_returning(session: Session, model: type[B], row_id: str, values: dict,
+                     expected_version: Optional[int] = None) -> Optional[B]:
+    """
+    Update one row by ID with a single UPDATE ... RETURNING, or an UPDATE then a SELECT on backends without RETURNING.
+    Commit with expire_on_commit=False to use the returned object after the session closes
+
+    :param session: Session to update in
+    :param model: Model class with ID and version columns
+    :param row_id: ID of the row
+    :param values: New column values
+    :param expected_version: Only update if the row still has this version
+    :raises StaleVersionError: If the row exists with another version
+    :return: Updated object, or None if no row has the ID
+    """
+
+    statement = _update_statement(model, row_id, values, expected_version)
+
+    if session.bind.dialect.update_returning:
+        updated = session.scalar(statement.returning(model))
+    elif session.execute(statement).rowcount:
+        updated = session.get(model, row_id)
+    else:
+        updated = None
+
+    # tell a changed row apart from a missing one
+    if updated is None and expected_version is not None and session.scalar(version_query(model, row_id)) is not None:
+        raise StaleVersionError(f"{model.__name__} {row_id} is no longer at version {expected_version}")
+
+    return updated
+
+
+async def async_update_returning(session: AsyncSession, model: type[B], row_id: str, values: dict,
+                                 expected_version: Optional[int] = None) -> Optional[B]:
+    """
+    Async version of update_returning
+
+    :param session: Session to update in
+    :param model: Model class with ID and version columns
+    :param row_id: ID of the row
+    :param values: New column values
+    :param expected_version: Only update if the row still has this version
+    :raises StaleVersionError: If the row exists with another version
+    :return: Updated object, or None if no row has the ID
+    """
+
+    statement = _update_statement(model, row_id, values, expected_version)
+
+    if session.bind.dialect.update_returning:
+        updated = await session.scalar(statement.returning(model))
+    elif (await session.execute(statement)).rowcount:
+        updated = await session.get(model, row_id)
+    else:
+        updated = None
+
+    # tell a changed row apart from a missing one
+    if updated is None and expected_version is not None and \
+            await session.scalar(version_query(model, row_id)) is not None:
+        raise StaleVersionError(f"{model.__name__} {row_id} is no longer at version {expected_version}")
+
+    return updated
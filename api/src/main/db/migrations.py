@@ -0,0 +1,191 @@
+"""
+migrations.py
+By: Zack Bamford
+
+Schema and data migrations for existing databases.
+Run with `python -m api.src.main.db.migrations` from the project root.
+"""
+import argparse
+import logging
+import math
+from typing import Optional
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import Session
+
+from api.src.main.db import generic_db
+from api.src.main.db.plan_db import Plan, PlanMember, PlanLeaderboard, sep_users, leaderboard_source_query
+from api.src.main.db.user_db import User
+
+
+def migrate_plan_users(engine: sqlalchemy.Engine) -> int:
+    """
+    Move the legacy "#"-joined Plan.users strings into the plan_members table
+
+    :param engine: Engine of the database to migrate
+    :return: Amount of memberships created
+    """
+
+    with Session(engine) as session:
+        # only plans that still hold a legacy user string
+        legacy_plans = session.execute(sqlalchemy.select(Plan.ID, Plan.users).where(Plan.users != "")).all()
+        plan_users = {plan_id: list(dict.fromkeys(sep_users(users))) for plan_id, users in legacy_plans}
+        plan_ids = list(plan_users)
+
+        # legacy strings can name deleted users, which would break the foreign key
+        user_ids = list({user_id for users in plan_users.values() for user_id in users})
+        known_users = {user_id for chunk in generic_db.chunks(user_ids)
+                       for user_id in session.scalars(sqlalchemy.select(User.ID).where(User.ID.in_(chunk)))}
+
+        # skip memberships that were already migrated
+        existing = {(row.plan_id, row.user_id) for chunk in generic_db.chunks(plan_ids)
+                    for row in session.execute(sqlalchemy.select(PlanMember.plan_id, PlanMember.user_id)
+                                               .where(PlanMember.plan_id.in_(chunk)))}
+
+        new_rows = [{"plan_id": plan_id, "user_id": user_id} for plan_id, users in plan_users.items()
+                    for user_id in users if user_id in known_users and (plan_id, user_id) not in existing]
+        skipped = sum(1 for users in plan_users.values() for user_id in users if user_id not in known_users)
+
+        if new_rows:
+            session.execute(sqlalchemy.insert(PlanMember), new_rows)
+
+        # clear the migrated strings
+        for chunk in generic_db.chunks(plan_ids):
+            session.execute(sqlalchemy.update(Plan).where(Plan.ID.in_(chunk)).values(users=""))
+
+        session.commit()
+
+    created = len(new_rows)
+
+    logging.info(f"Migrated {len(legacy_plans)} legacy plan user lists into {created} memberships, skipped "
+                 f"{skipped} unknown users")
+    return created
+
+
+def add_version_columns(engine: sqlalchemy.Engine) -> list[str]:
+    """
+    Add the version column to tables created before it existed, as create_all skips columns of existing tables
+
+    :param engine: Engine of the database to migrate
+    :return: Names of the tables that were changed
+    """
+
+    changed = []
+    inspector = sqlalchemy.inspect(engine)
+
+    for table in generic_db.Base.metadata.sorted_tables:
+        if "version" not in table.c or not inspector.has_table(table.name):
+            continue
+
+        if "version" not in {column["name"] for column in inspector.get_columns(table.name)}:
+            # existing rows start at version 1
+            with engine.begin() as connection:
+                connection.execute(sqlalchemy.text(f"ALTER TABLE {table.name} ADD COLUMN version INTEGER NOT NULL "
+                                                   f"DEFAULT 1"))
+            changed.append(table.name)
+
+    logging.info(f"Added version columns to: {', '.join(changed) or 'none'}")
+    return changed
+
+
+def create_indexes(engine: sqlalchemy.Engine):
+    """
+    Create the declared indexes that are missing, as create_all skips indexes on tables that already exist
+
+    :param engine: Engine of the database to migrate
+    """
+
+    for table in generic_db.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            # IF NOT EXISTS, as expression indexes such as lower(email) cannot be reflected on every backend
+            try:
+                with engine.begin() as connection:
+                    connection.execute(sqlalchemy.schema.CreateIndex(index, if_not_exists=True))
+            except sqlalchemy.exc.IntegrityError as e:
+                # a unique index fails if the table already holds duplicates, which needs manual cleanup
+                logging.error(f"Could not create index {index.name}, resolve the duplicate rows first: {e}")
+
+    logging.info("Created missing indexes")
+
+
+def rebuild_leaderboard(engine: sqlalchemy.Engine, plan_id: Optional[str] = None) -> int:
+    """
+    Recompute the leaderboard from the runs and replace the stored rows, to fill it for existing data or repair drift
+
+    :param engine: Engine of the database to migrate
+    :param plan_id: Plan ID to rebuild, or None for every plan
+    :return: Amount of stored entries that did not match the runs
+    """
+
+    with Session(engine) as session:
+        expected = {(row.plan_id, row.user_id): (row.completed_events, row.completed_meters)
+                    for row in session.execute(leaderboard_source_query(plan_id))}
+
+        stored_query = sqlalchemy.select(PlanLeaderboard.plan_id, PlanLeaderboard.user_id,
+                                         PlanLeaderboard.completed_events, PlanLeaderboard.completed_meters)
+        if plan_id is not None:
+            stored_query = stored_query.where(PlanLeaderboard.plan_id == plan_id)
+
+        # entries that went back to nothing count as missing
+        stored = {(row.plan_id, row.user_id): (row.completed_events, row.completed_meters)
+                  for row in session.execute(stored_query) if row.completed_events or row.completed_meters}
+
+        mismatched = sum(1 for key in expected.keys() | stored.keys()
+                         if key not in expected or key not in stored or expected[key][0] != stored[key][0]
+                         or not math.isclose(expected[key][1], stored[key][1], rel_tol=1e-9, abs_tol=1e-6))
+
+        # replace the rows in one transaction
+        delete = sqlalchemy.delete(PlanLeaderboard)
+        if plan_id is not None:
+            delete = delete.where(PlanLeaderboard.plan_id == plan_id)
+
+        session.execute(delete)
+        if expected:
+            session.execute(sqlalchemy.insert(PlanLeaderboard), [
+                {"plan_id": key[0], "user_id": key[1], "completed_events": events, "completed_meters": distance}
+                for key, (events, distance) in expected.items()])
+        session.commit()
+
+    logging.info(f"Rebuilt {len(expected)} leaderboard entries, {mismatched} did not match the runs")
+    return mismatched
+
+
+async def create_schema(engine: AsyncEngine):
+    """
+    Create any missing tables, run once when the API starts
+
+    :param engine: Async engine of the database
+    """
+
+    async with engine.begin() as connection:
+        await connection.run_sync(generic_db.Base.metadata.create_all)
+
+
+def run_migrations(engine: sqlalchemy.Engine):
+    """
+    Create any missing tables and run every migration step
+
+    :param engine: Engine of the database to migrate
+    """
+
+    generic_db.Base.metadata.create_all(engine)
+    add_version_columns(engine)
+    migrate_plan_users(engine)
+    create_indexes(engine)
+    rebuild_leaderboard(engine)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate the database")
+    parser.add_argument("--rebuild-leaderboard", action="store_true",
+                        help="only recompute the leaderboard from the runs")
+    parser.add_argument("--plan-id", help="plan to rebuild the leaderboard of, every plan if not given")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.rebuild_leaderboard:
+        rebuild_leaderboard(generic_db.db_obj.engine, args.plan_id)
+    else:
+        run_migrations(generic_db.db_obj.engine)
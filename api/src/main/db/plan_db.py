@@ -7,16 +7,33 @@ Functions to modify and create plans within the database
 
 import logging
 from datetime import datetime
-from typing import Optional, Union, List
+from typing import Optional, Union, List, Iterator, AsyncIterator
 
 import sqlalchemy
-from sqlalchemy.orm import Session, relationship
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, relationship, selectinload, noload, aliased
 from sqlalchemy.orm import Mapped
 
 from api.src.main.db import generic_db
+from api.src.main.db.cache import response_cache
 from api.src.main.db.user_db import User
 
 
+# meters per distance unit, units are matched case-insensitively
+UNIT_METERS = {
+    "m": 1.0, "meter": 1.0, "meters": 1.0,
+    "km": 1000.0, "kilometer": 1000.0, "kilometers": 1000.0,
+    "mi": 1609.344, "mile": 1609.344, "miles": 1609.344,
+    "ft": 0.3048, "foot": 0.3048, "feet": 0.3048,
+    "yd": 0.9144, "yard": 0.9144, "yards": 0.9144,
+    "in": 0.0254, "inch": 0.0254, "inches": 0.0254,
+}
+
+# run statuses that count as completing an event
+COMPLETED_STATUSES = ("done", "complete", "completed")
+
+
 def sep_users(users: str) -> list[str]:
     """
     Separate users string into a list of users
@@ -54,14 +71,19 @@ class Plan(generic_db.Base):
     date: Mapped[datetime] = sqlalchemy.Column(sqlalchemy.DateTime)
     distance: Mapped[float] = sqlalchemy.Column(sqlalchemy.Float)
     distance_unit: Mapped[str] = sqlalchemy.Column(sqlalchemy.String)
-    users: Mapped[str] = sqlalchemy.Column(sqlalchemy.String)  # user ID separated by "#"
+
+    # bumped by every modify, sent as the ETag
+    version: Mapped[int] = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=1, server_default="1")
+
+    # legacy user IDs separated by "#", superseded by PlanMember and emptied by migrations.migrate_plan_users
+    users: Mapped[str] = sqlalchemy.Column(sqlalchemy.String)
 
     # relationship with child event
-    child_events: Mapped[List["Event"]] = relationship(back_populates="plan", cascade="all, delete-orphan")
+    child_events: Mapped[List["Event"]] = relationship(back_populates="plan", cascade="all, delete-orphan",
+                                                       order_by=lambda: [Event.date, Event.ID])
 
     def __repr__(self):
-        return f"Plan: {self.ID} {self.name} {self.description} {self.date} {self.distance} {self.distance_unit} " \
-               f"{sep_users(self.users)}"
+        return f"Plan: {self.ID} {self.name} {self.description} {self.date} {self.distance} {self.distance_unit}"
 
     def __eq__(self, other):
         # check for same type
@@ -88,6 +110,100 @@ class Plan(generic_db.Base):
             self.distance == other.distance and self.distance_unit == other.distance_unit
 
 
+class PlanMember(generic_db.Base):
+    """
+    Association table linking users to the plans they are a member of
+    """
+
+    __tablename__ = "plan_members"
+
+    # the composite primary key doubles as the (plan, user) index
+    plan_id: Mapped[str] = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey("plans.ID", ondelete="CASCADE"),
+                                             primary_key=True)
+    user_id: Mapped[str] = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey("users.ID", ondelete="CASCADE"),
+                                             primary_key=True)
+
+    # reverse index for "which plans is this user in"
+    __table_args__ = (sqlalchemy.Index("ix_plan_members_user_plan", "user_id", "plan_id"),)
+
+    def __repr__(self):
+        return f"PlanMember: {self.plan_id} {self.user_id}"
+
+
+def format_user_ids(users: Union[list[User], list[str]]) -> list[str]:
+    """
+    Format a list of users or user IDs as a list of unique user IDs, keeping the original order
+
+    :param users: Users or user IDs
+    :return: List of user IDs
+    """
+
+    user_ids = [user.ID if isinstance(user, User) else user for user in users]
+
+    # remove duplicates
+    return list(dict.fromkeys(user_ids))
+
+
+def member_id_query(plan_id: str, limit: Optional[int] = None, after: Optional[str] = None) -> sqlalchemy.Select:
+    """
+    Build a query walking the (plan, user) index for the user IDs in a plan, ordered by user ID
+
+    :param plan_id: Plan ID to get user IDs from
+    :param limit: Maximum amount of rows, or None for all
+    :param after: Only select user IDs after this one
+    :return: Select statement
+    """
+
+    query = sqlalchemy.select(PlanMember.user_id).where(PlanMember.plan_id == plan_id)
+
+    if after is not None:
+        query = query.where(PlanMember.user_id > after)
+
+    return query.order_by(PlanMember.user_id).limit(limit)
+
+
+def user_plans_query(user_id: str, limit: Optional[int] = None, after: Optional[str] = None) -> sqlalchemy.Select:
+    """
+    Build a query walking the (user, plan) index for the plans a user is in, ordered by plan ID
+
+    :param user_id: User ID to look up
+    :param limit: Maximum amount of rows, or None for all
+    :param after: Only select plans after this plan ID
+    :return: Select statement
+    """
+
+    query = sqlalchemy.select(Plan).join(PlanMember, PlanMember.plan_id == Plan.ID).where(PlanMember.user_id == user_id)
+
+    if after is not None:
+        query = query.where(PlanMember.plan_id > after)
+
+    return query.order_by(PlanMember.plan_id).limit(limit)
+
+
+def member_query(plan_id: str, columns, limit: Optional[int] = None, after: Optional[str] = None) -> \
+        sqlalchemy.Select:
+    """
+    Build a query joining the members of a plan to their user rows, ordered by user ID
+
+    :param plan_id: Plan ID to get users from
+    :param columns: User entity or user columns to select
+    :param limit: Maximum amount of rows, or None for all
+    :param after: Only select users after this user ID
+    :return: Select statement
+    """
+
+    if not isinstance(columns, tuple):
+        columns = (columns,)
+
+    query = sqlalchemy.select(*columns).join(PlanMember, PlanMember.user_id == User.ID)\
+        .where(PlanMember.plan_id == plan_id)
+
+    if after is not None:
+        query = query.where(PlanMember.user_id > after)
+
+    return query.order_by(PlanMember.user_id).limit(limit)
+
+
 class Event(generic_db.Base):
     """
     SQLAlchemy Class for event object
@@ -98,12 +214,18 @@ class Event(generic_db.Base):
     ID: Mapped[str] = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
     plan_id: Mapped[str] = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey("plans.ID"))
     name: Mapped[str] = sqlalchemy.Column(sqlalchemy.String)
-    date: Mapped[datetime] = sqlalchemy.Column(sqlalchemy.DateTime)
+    date: Mapped[datetime] = sqlalchemy.Column(sqlalchemy.DateTime, index=True)
     distance: Mapped[float] = sqlalchemy.Column(sqlalchemy.Float)
     distance_unit: Mapped[str] = sqlalchemy.Column(sqlalchemy.String)
 
+    # bumped by every modify, sent as the ETag
+    version: Mapped[int] = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=1, server_default="1")
+
+    # date ranges within a plan, also serves lookups by plan_id
+    __table_args__ = (sqlalchemy.Index("ix_events_plan_date", plan_id, date),)
+
     plan: Mapped["Plan"] = relationship(back_populates="child_events")
-    run: Mapped[List["Run"]] = relationship("Run", cascade="all, delete-orphan")
+    run: Mapped[List["Run"]] = relationship("Run", cascade="all, delete-orphan", order_by=lambda: [Run.date, Run.ID])
 
     class Config:
         orm_mode = True
@@ -149,12 +271,18 @@ class Run(generic_db.Base):
 
     ID: Mapped[str] = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
     event_id: Mapped[str] = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey("events.ID"))
-    usr_id: Mapped[str] = sqlalchemy.Column(sqlalchemy.String)
+    usr_id: Mapped[str] = sqlalchemy.Column(sqlalchemy.String, index=True)
     date: Mapped[datetime] = sqlalchemy.Column(sqlalchemy.DateTime)
     status: Mapped[str] = sqlalchemy.Column(sqlalchemy.String)
 
+    # bumped by every modify, sent as the ETag
+    version: Mapped[int] = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=1, server_default="1")
+
     event: Mapped["Event"] = relationship("Event", back_populates="run")
 
+    # runs of an event are paged in (date, ID) order, this also serves plain lookups by event
+    __table_args__ = (sqlalchemy.Index("ix_runs_event_date_id", event_id, date, ID),)
+
     class Config:
         orm_mode = True
 
@@ -188,20 +316,416 @@ class Run(generic_db.Base):
         return self.date == other.date and self.status == other.status
 
 
-class PlanCommands:
-    """Database commands for a plan object"""
+class PlanLeaderboard(generic_db.Base):
+    """
+    Completed events and distance of each user in a plan, kept up to date by the run and event commands so the
+    leaderboard is read in index order instead of being recomputed from the runs
+    """
 
-    def __init__(self, db_obj: generic_db.DBModificationObject):
-        """
-        Create a new PlanCommands object
+    __tablename__ = "plan_leaderboard"
 
-        :param db_obj: DBModificationObject to use
-        """
+    plan_id: Mapped[str] = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey("plans.ID", ondelete="CASCADE"),
+                                             primary_key=True)
+    user_id: Mapped[str] = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey("users.ID", ondelete="CASCADE"),
+                                             primary_key=True)
+    completed_events: Mapped[int] = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+    completed_meters: Mapped[float] = sqlalchemy.Column(sqlalchemy.Float, nullable=False, default=0.0)
 
-        # add to db
-        Plan.metadata.create_all(db_obj.engine)
+    # top-K of a plan is a scan of this index
+    __table_args__ = (sqlalchemy.Index("ix_plan_leaderboard_rank", plan_id, completed_meters, user_id),)
+
+    def __repr__(self):
+        return f"PlanLeaderboard: {self.plan_id} {self.user_id} {self.completed_events} {self.completed_meters}"
+
+
+def run_completed() -> sqlalchemy.ColumnElement:
+    """
+    Build the SQL condition of a run counting as completed
+
+    :return: Condition on Run.status
+    """
+
+    return sqlalchemy.func.lower(Run.status).in_(COMPLETED_STATUSES)
+
+
+def is_completed(status: Optional[str]) -> bool:
+    """
+    Check if a run status counts as completed, the Python side of run_completed
+
+    :param status: Run status
+    :return: True if completed
+    """
+
+    return status is not None and status.lower() in COMPLETED_STATUSES
+
+
+def meters(distance: Optional[float], unit: Optional[str]) -> float:
+    """
+    Convert a distance to meters, the Python side of distance_in_meters with unknown units counting as 0
+
+    :param distance: Distance
+    :param unit: Unit of the distance
+    :return: Distance in meters
+    """
+
+    factor = UNIT_METERS.get((unit or "").strip().lower())
+
+    if factor is None or distance is None:
+        return 0.0
+
+    return distance * factor
+
+
+def leaderboard_lock(dialect_name: str) -> sqlalchemy.Insert:
+    """
+    Build an upsert locking the leaderboard entry of a user in the plan of an event, executed with event_id and user_id
+    parameters before the entry is counted or recomputed. A concurrent run change of the same plan and user waits for
+    the lock, so it reads the runs committed here instead of counting from the same snapshot
 
-        self.engine: sqlalchemy.Engine = db_obj.engine
+    :param dialect_name: Name of the database dialect, sqlite or postgresql
+    :return: Insert statement
+    """
+
+    # the table rather than the entity, so a list of parameters runs as a plain executemany, not an ORM bulk insert
+    statement = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}[dialect_name](PlanLeaderboard.__table__)\
+        .from_select(["plan_id", "user_id", "completed_events", "completed_meters"], sqlalchemy.select(
+            Event.plan_id, sqlalchemy.bindparam("user_id", type_=sqlalchemy.String), sqlalchemy.literal(0),
+            sqlalchemy.literal(0.0)).where(Event.ID == sqlalchemy.bindparam("event_id")))
+
+    # setting a column to itself still takes the row lock
+    return statement.on_conflict_do_update(index_elements=[PlanLeaderboard.plan_id, PlanLeaderboard.user_id], set_={
+        "completed_events": PlanLeaderboard.completed_events,
+    })
+
+
+def leaderboard_row(event: "Event", user_id: str, change: int) -> dict:
+    """
+    Build the leaderboard change of a user completing, or no longer completing, an event
+
+    :param event: Event that was completed
+    :param user_id: User ID
+    :param change: 1 when completed, -1 when no longer completed
+    :return: Parameters for leaderboard_upsert
+    """
+
+    return {"plan_id": event.plan_id, "user_id": user_id, "completed_events": change,
+            "completed_meters": change * meters(event.distance, event.distance_unit)}
+
+
+def leaderboard_upsert(dialect_name: str) -> sqlalchemy.Insert:
+    """
+    Build an insert adding its values onto an existing leaderboard row, executed with rows from leaderboard_row
+
+    :param dialect_name: Name of the database dialect, sqlite or postgresql
+    :return: Insert statement
+    """
+
+    statement = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}[dialect_name](PlanLeaderboard)
+
+    return statement.on_conflict_do_update(index_elements=[PlanLeaderboard.plan_id, PlanLeaderboard.user_id], set_={
+        "completed_events": PlanLeaderboard.completed_events + statement.excluded.completed_events,
+        "completed_meters": PlanLeaderboard.completed_meters + statement.excluded.completed_meters,
+    })
+
+
+def leaderboard_event_update(event: "Event", event_change: int, meters_change: float) -> sqlalchemy.Update:
+    """
+    Build an update of every user who completed an event, used when the event distance changes or it is deleted
+
+    :param event: Event being changed
+    :param event_change: Change to the completed events
+    :param meters_change: Change to the completed meters
+    :return: Update statement
+    """
+
+    completed_users = sqlalchemy.select(Run.usr_id).where(Run.event_id == event.ID, run_completed())
+
+    return sqlalchemy.update(PlanLeaderboard)\
+        .where(PlanLeaderboard.plan_id == event.plan_id, PlanLeaderboard.user_id.in_(completed_users))\
+        .values(completed_events=PlanLeaderboard.completed_events + event_change,
+                completed_meters=PlanLeaderboard.completed_meters + meters_change)
+
+
+def leaderboard_distance_update(event_id: str, new_meters: float) -> sqlalchemy.Update:
+    """
+    Build an update moving the distance of every user who completed an event to its new distance, run before the
+    event itself changes as the old distance is read in the same statement
+
+    :param event_id: Event ID being changed
+    :param new_meters: New distance of the event in meters
+    :return: Update statement
+    """
+
+    event_plan = sqlalchemy.select(Event.plan_id).where(Event.ID == event_id).scalar_subquery()
+    old_meters = sqlalchemy.select(sqlalchemy.func.coalesce(distance_in_meters(Event.distance, Event.distance_unit),
+                                                            0.0)).where(Event.ID == event_id).scalar_subquery()
+    completed_users = sqlalchemy.select(Run.usr_id).where(Run.event_id == event_id, run_completed())
+
+    return sqlalchemy.update(PlanLeaderboard)\
+        .where(PlanLeaderboard.plan_id == event_plan, PlanLeaderboard.user_id.in_(completed_users),
+               old_meters != new_meters)\
+        .values(completed_meters=PlanLeaderboard.completed_meters + new_meters - old_meters)\
+        .execution_options(synchronize_session=False)
+
+
+def leaderboard_refresh(dialect_name: str, event_id: str, user_id: str) -> sqlalchemy.Insert:
+    """
+    Build an upsert recomputing the leaderboard entry of a user in the plan of an event from their runs, used when the
+    previous state of a run is not known
+
+    :param dialect_name: Name of the database dialect, sqlite or postgresql
+    :param event_id: Event ID in the plan
+    :param user_id: User ID
+    :return: Insert statement
+    """
+
+    target = aliased(Event)
+
+    # distinct events of the plan the user completed
+    completed = sqlalchemy.and_(Event.plan_id == target.plan_id, Event.ID.in_(
+        sqlalchemy.select(Run.event_id).where(Run.usr_id == user_id, run_completed())))
+
+    statement = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}[dialect_name](PlanLeaderboard)\
+        .from_select(["plan_id", "user_id", "completed_events", "completed_meters"], sqlalchemy.select(
+            target.plan_id, sqlalchemy.literal(user_id),
+            sqlalchemy.select(sqlalchemy.func.count(Event.ID)).where(completed).scalar_subquery(),
+            sqlalchemy.select(sqlalchemy.func.coalesce(
+                sqlalchemy.func.sum(distance_in_meters(Event.distance, Event.distance_unit)), 0.0))
+            .where(completed).scalar_subquery())
+            .where(target.ID == event_id))
+
+    return statement.on_conflict_do_update(index_elements=[PlanLeaderboard.plan_id, PlanLeaderboard.user_id], set_={
+        "completed_events": statement.excluded.completed_events,
+        "completed_meters": statement.excluded.completed_meters,
+    })
+
+
+def leaderboard_source_query(plan_id: Optional[str] = None) -> sqlalchemy.Select:
+    """
+    Build a query computing the leaderboard from the runs, used to rebuild the table. Runs of users that no longer
+    exist are left out, as entries reference the users table
+
+    :param plan_id: Plan ID to compute, or None for every plan
+    :return: Select statement with the PlanLeaderboard columns
+    """
+
+    # distinct events each existing user completed
+    completed = sqlalchemy.select(Run.usr_id.label("user_id"), Run.event_id).join(User, User.ID == Run.usr_id)\
+        .where(run_completed()).distinct().subquery()
+
+    query = sqlalchemy.select(Event.plan_id, completed.c.user_id,
+                              sqlalchemy.func.count(Event.ID).label("completed_events"),
+                              sqlalchemy.func.coalesce(sqlalchemy.func.sum(
+                                  distance_in_meters(Event.distance, Event.distance_unit)), 0.0)
+                              .label("completed_meters"))\
+        .join(Event, Event.ID == completed.c.event_id)\
+        .group_by(Event.plan_id, completed.c.user_id)
+
+    if plan_id is not None:
+        query = query.where(Event.plan_id == plan_id)
+
+    return query
+
+
+def leaderboard_query(plan_id: str, limit: int, unit: str = "km") -> sqlalchemy.Select:
+    """
+    Build a query of the top members of a plan, read in order from the leaderboard index
+
+    :param plan_id: Plan ID
+    :param limit: Amount of members to return
+    :param unit: Unit of the returned distance, a key of UNIT_METERS
+    :return: Select statement
+    """
+
+    return sqlalchemy.select(User.ID.label("user_id"), User.username, PlanLeaderboard.completed_events,
+                             (PlanLeaderboard.completed_meters / UNIT_METERS[unit]).label("completed_distance"))\
+        .join(User, User.ID == PlanLeaderboard.user_id)\
+        .join(PlanMember, sqlalchemy.and_(PlanMember.plan_id == PlanLeaderboard.plan_id,
+                                          PlanMember.user_id == PlanLeaderboard.user_id))\
+        .where(PlanLeaderboard.plan_id == plan_id)\
+        .order_by(PlanLeaderboard.completed_meters.desc(), PlanLeaderboard.user_id.desc())\
+        .limit(limit)
+
+
+def calendar_query(user_id: str, start: datetime, end: datetime) -> sqlalchemy.Select:
+    """
+    Build a query of the events of every plan a user belongs to within a date window, read per plan from the
+    (plan_id, date) index
+
+    :param user_id: User ID
+    :param start: Start of the window, inclusive
+    :param end: End of the window, exclusive
+    :return: Select statement ordered by date then ID
+    """
+
+    return sqlalchemy.select(Event.ID, Event.plan_id, Plan.name.label("plan_name"), Event.name, Event.date,
+                             Event.distance, Event.distance_unit)\
+        .join(PlanMember, PlanMember.plan_id == Event.plan_id)\
+        .join(Plan, Plan.ID == Event.plan_id)\
+        .where(PlanMember.user_id == user_id, Event.date >= start, Event.date < end)\
+        .order_by(Event.date, Event.ID)
+
+
+def dashboard_query(user_id: str, start: datetime, end: datetime) -> sqlalchemy.Select:
+    """
+    Build a query of the plans of a user with their events in a date window and the user's own runs of those
+    events eagerly loaded, three statements no matter how many plans or events there are
+
+    :param user_id: User ID
+    :param start: Start of the event window, inclusive
+    :param end: End of the event window, exclusive
+    :return: Select statement of plans ordered by plan ID
+    """
+
+    return user_plans_query(user_id).options(
+        selectinload(Plan.child_events.and_(Event.date >= start, Event.date < end))
+        .selectinload(Event.run.and_(Run.usr_id == user_id)))
+
+
+def plan_tree_query(plan_id: str, depth: int = 2) -> sqlalchemy.Select:
+    """
+    Build a query of a plan with its events and their runs eagerly loaded, one statement per level
+
+    :param plan_id: Plan ID
+    :param depth: 0 for the plan only, 1 to add its events, 2 to add their runs
+    :return: Select statement of the plan
+    """
+
+    query = sqlalchemy.select(Plan).where(Plan.ID == plan_id)
+
+    # levels past the depth are left empty instead of lazy loading later
+    if depth < 1:
+        return query.options(noload(Plan.child_events))
+
+    if depth < 2:
+        return query.options(selectinload(Plan.child_events).noload(Event.run))
+
+    return query.options(selectinload(Plan.child_events).selectinload(Event.run))
+
+
+def event_runs_query(event_id: str, limit: Optional[int] = None,
+                     after: Optional[tuple[Optional[datetime], str]] = None, status: Optional[str] = None,
+                     user_id: Optional[str] = None) -> sqlalchemy.Select:
+    """
+    Build a query selecting the response columns of the runs of an event, ordered by date then ID, with runs without
+    a date last
+
+    :param event_id: Event ID to get runs from
+    :param limit: Maximum amount of rows, or None for all
+    :param after: Only select runs after this (date, run ID) pair, the date is None after a run without a date
+    :param status: Only select runs with this status
+    :param user_id: Only select runs of this user
+    :return: Select statement
+    """
+
+    query = sqlalchemy.select(Run.ID, Run.date, Run.status).where(Run.event_id == event_id)
+
+    if after is not None:
+        after_date, after_id = after
+
+        # a row comparison never matches NULL, so runs without a date are selected on their own
+        if after_date is None:
+            query = query.where(Run.date.is_(None), Run.ID > after_id)
+        else:
+            query = query.where(sqlalchemy.or_(sqlalchemy.tuple_(Run.date, Run.ID) > after, Run.date.is_(None)))
+
+    if status is not None:
+        query = query.where(Run.status == status)
+
+    if user_id is not None:
+        query = query.where(Run.usr_id == user_id)
+
+    return query.order_by(Run.date.is_(None), Run.date, Run.ID).limit(limit)
+
+
+def plan_activity_query(plan_id: str) -> sqlalchemy.Select:
+    """
+    Build a query selecting every event of a plan joined to its runs, one row per run and one row for each event
+    without runs, ordered by event date then run date
+
+    :param plan_id: Plan ID to export
+    :return: Select statement
+    """
+
+    return sqlalchemy.select(Event.ID.label("event_id"), Event.name.label("event_name"),
+                             Event.date.label("event_date"), Event.distance, Event.distance_unit,
+                             Run.ID.label("run_id"), Run.usr_id.label("user_id"), Run.date.label("run_date"),
+                             Run.status)\
+        .outerjoin(Run, Run.event_id == Event.ID)\
+        .where(Event.plan_id == plan_id)\
+        .order_by(Event.date, Event.ID, Run.date, Run.ID)
+
+
+def distance_in_meters(distance, unit) -> sqlalchemy.ColumnElement:
+    """
+    Build a SQL expression converting a distance to meters, unknown units convert to NULL
+
+    :param distance: Distance column
+    :param unit: Unit column
+    :return: Expression of the distance in meters
+    """
+
+    factor = sqlalchemy.case(UNIT_METERS, value=sqlalchemy.func.lower(sqlalchemy.func.trim(unit)), else_=None)
+    return distance * factor
+
+
+def plan_progress_query(plan_id: str, unit: str = "km") -> sqlalchemy.Select:
+    """
+    Build one grouped query of the progress of every member of a plan: completed events, completed distance and the
+    percentage of the plan distance. An event counts once per user however many completed runs it has
+
+    :param plan_id: Plan ID to get progress for
+    :param unit: Unit of the returned distances, a key of UNIT_METERS
+    :return: Select statement ordered by completed distance, furthest first
+    """
+
+    # distinct events each user completed in this plan
+    completed = sqlalchemy.select(Run.usr_id.label("user_id"), Run.event_id)\
+        .join(Event, Event.ID == Run.event_id)\
+        .where(Event.plan_id == plan_id, run_completed())\
+        .distinct().subquery()
+
+    total_events = sqlalchemy.select(sqlalchemy.func.count(Event.ID)).where(Event.plan_id == plan_id)\
+        .scalar_subquery()
+
+    completed_meters = sqlalchemy.func.coalesce(
+        sqlalchemy.func.sum(distance_in_meters(Event.distance, Event.distance_unit)), 0.0)
+    plan_meters = distance_in_meters(Plan.distance, Plan.distance_unit)
+
+    return sqlalchemy.select(
+        User.ID.label("user_id"), User.username,
+        sqlalchemy.func.count(Event.ID).label("completed_events"),
+        total_events.label("total_events"),
+        (completed_meters / UNIT_METERS[unit]).label("completed_distance"),
+        (plan_meters / UNIT_METERS[unit]).label("plan_distance"),
+        (completed_meters * 100 / sqlalchemy.func.nullif(plan_meters, 0)).label("percent_complete"))\
+        .select_from(PlanMember)\
+        .join(Plan, Plan.ID == PlanMember.plan_id)\
+        .join(User, User.ID == PlanMember.user_id)\
+        .outerjoin(completed, completed.c.user_id == PlanMember.user_id)\
+        .outerjoin(Event, Event.ID == completed.c.event_id)\
+        .where(PlanMember.plan_id == plan_id)\
+        .group_by(User.ID, User.username, Plan.distance, Plan.distance_unit)\
+        .order_by(sqlalchemy.desc("completed_distance"), User.ID)
+
+
+def invalidate_plan_responses(event_ids: list[str], run_ids: list[str]):
+    """
+    Invalidate the cached responses of the events and runs deleted with a plan
+
+    :param event_ids: IDs of the plan's events
+    :param run_ids: IDs of the runs of those events
+    """
+
+    for event_id in event_ids:
+        response_cache.invalidate("event", event_id)
+
+    for run_id in run_ids:
+        response_cache.invalidate("run", run_id)
+
+
+class PlanCommands(generic_db.DBCommands):
+    """Database commands for a plan object"""
 
     def create_plan(self, name: str, description: str, date: datetime, distance: float, distance_unit: str) -> Optional[
         Plan]:
@@ -231,6 +755,7 @@ class PlanCommands:
 
         return created_plan
 
+    @generic_db.replica_read
     def retrieve_plan(self, plan_id: str) -> Optional[Plan]:
         """
         Get a plan by its ID
@@ -240,58 +765,172 @@ class PlanCommands:
         """
 
         # get plan from db
-        with Session(self.engine) as session:
+        with Session(self.read_engine) as session:
             p: Optional[Plan] = session.get(Plan, plan_id)
 
             logging.debug(f"Retrieved plan: %s", p)
             return p
 
-    def get_user_ids_in_plan(self, plan_id: str) -> Optional[list[str]]:
+    def get_user_ids_in_plan(self, plan_id: str, limit: Optional[int] = None, after: Optional[str] = None) -> \
+            Optional[list[str]]:
         """
-        Get the user IDs in a plan
+        Get the user IDs in a plan, ordered by user ID
 
         :param plan_id: Plan ID to retrieve from
+        :param limit: Maximum amount of IDs to return, or None for all
+        :param after: Only return IDs after this user ID, used to page through large plans
         :return: List of user IDs, or None if the plan does not exist
         """
 
-        p: Optional[Plan] = self.retrieve_plan(plan_id)
+        with Session(self.engine) as session:
+            # check for valid plan
+            if session.get(Plan, plan_id) is None:
+                return None
+
+            return list(session.scalars(member_id_query(plan_id, limit, after)))
 
-        # check for no response
-        if p is None:
-            return None
+    def is_user_in_plan(self, plan_id: str, user_id: str) -> bool:
+        """
+        Check if a user is a member of a plan
+
+        :param plan_id: Plan ID to check
+        :param user_id: User ID to check
+        :return: If the user is in the plan
+        """
 
-        # return the ids
-        return sep_users(p.users)
+        with Session(self.engine) as session:
+            return session.get(PlanMember, (plan_id, user_id)) is not None
 
-    def get_user_objects_in_plan(self, plan_id: str) -> Optional[list[User]]:
+    def get_plans_for_user(self, user_id: str, limit: Optional[int] = None, after: Optional[str] = None) -> \
+            list[Plan]:
         """
-        Get the user objects in the plan
+        Get the plans a user is a member of, ordered by plan ID
 
-        :param plan_id: Plan ID to get users from
-        :return: Users in the plan
+        :param user_id: User ID to look up
+        :param limit: Maximum amount of plans to return, or None for all
+        :param after: Only return plans after this plan ID, used to page through results
+        :return: List of plans
         """
 
-        p: Optional[Plan] = self.retrieve_plan(plan_id)
+        with Session(self.engine) as session:
+            plans = list(session.scalars(user_plans_query(user_id, limit, after)))
 
-        # check for no response
-        if p is None:
-            return None
+        logging.debug(f"Retrieved plans for user {user_id}: {plans}")
+        return plans
 
-        users = []
+    def get_plan_tree(self, plan_id: str, depth: int = 2) -> Optional[Plan]:
+        """
+        Get a plan with its events and their runs loaded, in at most three statements
+
+        :param plan_id: Plan ID to get
+        :param depth: 0 for the plan only, 1 to add its events, 2 to add their runs
+        :return: Plan with child_events and their run collections loaded up to the depth, or None if not found
+        """
 
         with Session(self.engine) as session:
+            return session.scalar(plan_tree_query(plan_id, depth))
+
+    def get_dashboard_plans(self, user_id: str, start: datetime, end: datetime) -> list[Plan]:
+        """
+        Get the plans of a user with their events in a date window and the user's runs of each event loaded
+
+        :param user_id: User ID to look up
+        :param start: Start of the event window, inclusive
+        :param end: End of the event window, exclusive
+        :return: List of plans from dashboard_query
+        """
+
+        with Session(self.engine) as session:
+            return list(session.scalars(dashboard_query(user_id, start, end)))
+
+    def get_user_objects_in_plan(self, plan_id: str, limit: Optional[int] = None, after: Optional[str] = None) -> \
+            Optional[list[User]]:
+        """
+        Get the user objects in the plan, ordered by user ID
+
+        :param plan_id: Plan ID to get users from
+        :param limit: Maximum amount of users to return, or None for all
+        :param after: Only return users after this user ID, used to page through large plans
+        :return: Users in the plan, or None if the plan does not exist
+        """
 
-            # get all users
-            for user_id in sep_users(p.users):
-                curr_user: Optional[User] = session.get(User, user_id)
+        with Session(self.engine) as session:
+            # check for valid plan
+            if session.get(Plan, plan_id) is None:
+                return None
 
-                # verify user
-                if curr_user is not None:
-                    users.append(curr_user)
+            # load every member in a single query
+            users = list(session.scalars(member_query(plan_id, User, limit, after)))
 
         logging.debug(f"Retrieved users in plan: {users}")
         return users
 
+    def get_plan_members(self, plan_id: str, limit: Optional[int] = None, after: Optional[str] = None) -> \
+            Optional[list[sqlalchemy.Row]]:
+        """
+        Get the public columns (ID, username, email) of the users in a plan, ordered by user ID
+
+        :param plan_id: Plan ID to get users from
+        :param limit: Maximum amount of users to return, or None for all
+        :param after: Only return users after this user ID, used to page through large plans
+        :return: Rows of user columns, or None if the plan does not exist
+        """
+
+        with Session(self.engine) as session:
+            # check for valid plan
+            if session.get(Plan, plan_id) is None:
+                return None
+
+            return session.execute(member_query(plan_id, (User.ID, User.username, User.email), limit, after)).all()
+
+    def get_plan_progress(self, plan_id: str, unit: str = "km") -> Optional[list[sqlalchemy.Row]]:
+        """
+        Get the progress of every member of a plan, computed in the database
+
+        :param plan_id: Plan ID to get progress for
+        :param unit: Unit of the returned distances, a key of UNIT_METERS
+        :return: Rows of plan_progress_query, or None if the plan does not exist
+        """
+
+        with Session(self.engine) as session:
+            # check for valid plan
+            if session.get(Plan, plan_id) is None:
+                return None
+
+            return session.execute(plan_progress_query(plan_id, unit)).all()
+
+    def get_leaderboard(self, plan_id: str, limit: int = 10, unit: str = "km") -> Optional[list[sqlalchemy.Row]]:
+        """
+        Get the top members of a plan from the incrementally maintained leaderboard
+
+        :param plan_id: Plan ID to get the leaderboard of
+        :param limit: Amount of members to return
+        :param unit: Unit of the returned distances, a key of UNIT_METERS
+        :return: Rows of leaderboard_query, or None if the plan does not exist
+        """
+
+        with Session(self.engine) as session:
+            # check for valid plan
+            if session.get(Plan, plan_id) is None:
+                return None
+
+            return session.execute(leaderboard_query(plan_id, limit, unit)).all()
+
+    def stream_plan_activity(self, plan_id: str, batch_size: int = 1000) -> Iterator[list[sqlalchemy.Row]]:
+        """
+        Stream the events and runs of a plan from a server side cursor, holding one batch in memory at a time
+
+        :param plan_id: Plan ID to export
+        :param batch_size: Amount of rows fetched per batch
+        :return: Iterator of row batches from plan_activity_query
+        """
+
+        with Session(self.engine) as session:
+            result = session.execute(plan_activity_query(plan_id).execution_options(yield_per=batch_size))
+
+            for batch in result.partitions():
+                yield batch
+
     def add_users_to_plan(self, plan_id: str, users: Union[list[User], list[str]]) -> Optional[Plan]:
         """
         Add users to a plan
@@ -301,31 +940,21 @@ class PlanCommands:
         :return: Plan with users added
         """
 
-        p: Optional[Plan] = self.retrieve_plan(plan_id)
-
-        # check for no response
-        if p is None:
-            return None
-
-        # format as list of user ids
-        if type(users[0]) == User:
-            users = [user.ID for user in users]
-
-        # get user list and add users if not empty
-        user_list = []
-        if p.users:
-            user_list = sep_users(p.users)
-        user_list += users
-
-        # remove duplicates
-        user_list = list(set(user_list))
+        user_ids = format_user_ids(users)
 
         with Session(self.engine) as session:
-            # get plan
-            curr_plan = session.get(Plan, plan_id)
+            # check for valid plan
+            if session.get(Plan, plan_id) is None:
+                return None
 
-            # update plan with user list
-            curr_plan.users = join_users(user_list)
+            # skip users that are already members
+            existing = set()
+            for chunk in generic_db.chunks(user_ids):
+                existing.update(session.scalars(sqlalchemy.select(PlanMember.user_id).where(
+                    PlanMember.plan_id == plan_id, PlanMember.user_id.in_(chunk))))
+
+            session.add_all([PlanMember(plan_id=plan_id, user_id=user_id) for user_id in user_ids
+                             if user_id not in existing])
             session.commit()
 
             return session.get(Plan, plan_id)
@@ -339,64 +968,50 @@ class PlanCommands:
         :return: Plan with users removed
         """
 
-        p: Optional[Plan] = self.retrieve_plan(plan_id)
-
-        # check for no response
-        if p is None:
-            return None
-
-        # format as list of user ids
-        if type(users[0]) == User:
-            users = [user.ID for user in users]
-
-        # get user list and remove users with list comprehension
-        user_list = sep_users(p.users)
-        user_list = [user for user in user_list if user not in users]
+        user_ids = format_user_ids(users)
 
         with Session(self.engine) as session:
-            # get plan
-            curr_plan = session.get(Plan, plan_id)
+            # check for valid plan
+            if session.get(Plan, plan_id) is None:
+                return None
 
-            # update plan with user list
-            curr_plan.users = join_users(user_list)
+            for chunk in generic_db.chunks(user_ids):
+                session.execute(sqlalchemy.delete(PlanMember).where(PlanMember.plan_id == plan_id,
+                                                                   PlanMember.user_id.in_(chunk)))
             session.commit()
 
             return session.get(Plan, plan_id)
 
     def modify_plan(self, plan_id: str, new_name: str, new_description: str, new_date: datetime, new_distance: float,
-                    new_distance_unit: str) -> Optional[Plan]:
+                    new_distance_unit: str, expected_version: Optional[int] = None) -> Optional[Plan]:
         """
         Modify a plan
 
-        :param new_user_list:
         :param plan_id: ID of the plan
         :param new_name: New name of the plan
+        :param new_description: New description of the plan
         :param new_date: New date of the plan
         :param new_distance: New distance of the plan
         :param new_distance_unit: New distance unit of the plan
-        :param new_user_list: New user list of the plan
+        :param expected_version: Only modify if the plan is still at this version, from If-Match
+        :raises StaleVersionError: If the plan was modified since expected_version
         :return: Modified plan object
         """
 
-        # get plan from db
-        with Session(self.engine) as session:
-            p: Optional[Plan] = session.get(Plan, plan_id)
+        # modify plan in one statement
+        with Session(self.engine, expire_on_commit=False) as session:
+            p: Optional[Plan] = generic_db.update_returning(session, Plan, plan_id, {
+                "name": new_name, "description": new_description, "date": new_date, "distance": new_distance,
+                "distance_unit": new_distance_unit}, expected_version)
 
             if p is None:
                 logging.debug(f"Could not find plan with ID {plan_id}")
                 return None
 
-            # modify plan
-            p.name = new_name
-            p.description = new_description
-            p.date = new_date
-            p.distance = new_distance
-            p.distance_unit = new_distance_unit
-
             session.commit()
 
             logging.debug(f"Modified plan: {p}")
-            return session.get(Plan, plan_id)
+            return p
 
     def delete_plan(self, plan_id: str) -> bool:
         """
@@ -414,9 +1029,343 @@ class PlanCommands:
                 logging.debug(f"Could not find plan with ID {plan_id}")
                 return False
 
-            # delete plan
+            # the events and runs are deleted with the plan
+            event_ids = session.scalars(sqlalchemy.select(Event.ID).where(Event.plan_id == plan_id)).all()
+            run_ids = session.scalars(sqlalchemy.select(Run.ID).join(Event, Event.ID == Run.event_id)
+                                      .where(Event.plan_id == plan_id)).all()
+
+            # delete plan, its memberships and its leaderboard
+            session.execute(sqlalchemy.delete(PlanMember).where(PlanMember.plan_id == plan_id))
+            session.execute(sqlalchemy.delete(PlanLeaderboard).where(PlanLeaderboard.plan_id == plan_id))
             session.delete(p)
             session.commit()
 
+        invalidate_plan_responses(event_ids, run_ids)
+
         logging.debug(f"Deleted plan: {p}")
         return True
+
+
+class AsyncPlanCommands(generic_db.AsyncDBCommands):
+    """Async database commands for a plan object, mirroring PlanCommands"""
+
+    async def create_plan(self, name: str, description: str, date: datetime, distance: float, distance_unit: str) -> \
+            Optional[Plan]:
+        """
+        Create a new plan
+
+        :param name: Name of the plan
+        :param description: Description of the plan
+        :param date: Date of the plan
+        :param distance: Distance of the plan
+        :param distance_unit: Distance unit of the plan
+        :return: New plan object
+        """
+
+        # create new plan object
+        plan_id = generic_db.create_id("PLAN")
+        new_plan = Plan(ID=plan_id, name=name, description=description, date=date,
+                        distance=distance, distance_unit=distance_unit, users="")
+
+        # add to db
+        async with AsyncSession(self.engine) as session:
+            session.add(new_plan)
+            await session.commit()
+
+            created_plan = await session.get(Plan, plan_id)
+
+        logging.debug(f"Created plan: {created_plan}")
+
+        return created_plan
+
+    @generic_db.replica_read
+    async def retrieve_plan(self, plan_id: str) -> Optional[Plan]:
+        """
+        Get a plan by its ID
+
+        :param plan_id: ID of the plan
+        :return: Plan object
+        """
+
+        async with AsyncSession(self.read_engine) as session:
+            p: Optional[Plan] = await session.get(Plan, plan_id)
+
+            logging.debug(f"Retrieved plan: %s", p)
+            return p
+
+    async def get_user_ids_in_plan(self, plan_id: str, limit: Optional[int] = None, after: Optional[str] = None) -> \
+            Optional[list[str]]:
+        """
+        Get the user IDs in a plan, ordered by user ID
+
+        :param plan_id: Plan ID to retrieve from
+        :param limit: Maximum amount of IDs to return, or None for all
+        :param after: Only return IDs after this user ID, used to page through large plans
+        :return: List of user IDs, or None if the plan does not exist
+        """
+
+        async with AsyncSession(self.engine) as session:
+            # check for valid plan
+            if await session.get(Plan, plan_id) is None:
+                return None
+
+            return list(await session.scalars(member_id_query(plan_id, limit, after)))
+
+    async def is_user_in_plan(self, plan_id: str, user_id: str) -> bool:
+        """
+        Check if a user is a member of a plan
+
+        :param plan_id: Plan ID to check
+        :param user_id: User ID to check
+        :return: If the user is in the plan
+        """
+
+        async with AsyncSession(self.engine) as session:
+            return await session.get(PlanMember, (plan_id, user_id)) is not None
+
+    async def get_plans_for_user(self, user_id: str, limit: Optional[int] = None, after: Optional[str] = None) -> \
+            list[Plan]:
+        """
+        Get the plans a user is a member of, ordered by plan ID
+
+        :param user_id: User ID to look up
+        :param limit: Maximum amount of plans to return, or None for all
+        :param after: Only return plans after this plan ID, used to page through results
+        :return: List of plans
+        """
+
+        async with AsyncSession(self.engine) as session:
+            plans = list(await session.scalars(user_plans_query(user_id, limit, after)))
+
+        logging.debug(f"Retrieved plans for user {user_id}: {plans}")
+        return plans
+
+    async def get_plan_tree(self, plan_id: str, depth: int = 2) -> Optional[Plan]:
+        """
+        Get a plan with its events and their runs loaded, in at most three statements
+
+        :param plan_id: Plan ID to get
+        :param depth: 0 for the plan only, 1 to add its events, 2 to add their runs
+        :return: Plan with child_events and their run collections loaded up to the depth, or None if not found
+        """
+
+        async with AsyncSession(self.engine) as session:
+            return await session.scalar(plan_tree_query(plan_id, depth))
+
+    async def get_dashboard_plans(self, user_id: str, start: datetime, end: datetime) -> list[Plan]:
+        """
+        Get the plans of a user with their events in a date window and the user's runs of each event loaded
+
+        :param user_id: User ID to look up
+        :param start: Start of the event window, inclusive
+        :param end: End of the event window, exclusive
+        :return: List of plans from dashboard_query
+        """
+
+        async with AsyncSession(self.engine) as session:
+            return list(await session.scalars(dashboard_query(user_id, start, end)))
+
+    async def get_user_objects_in_plan(self, plan_id: str, limit: Optional[int] = None,
+                                       after: Optional[str] = None) -> Optional[list[User]]:
+        """
+        Get the user objects in the plan, ordered by user ID
+
+        :param plan_id: Plan ID to get users from
+        :param limit: Maximum amount of users to return, or None for all
+        :param after: Only return users after this user ID, used to page through large plans
+        :return: Users in the plan, or None if the plan does not exist
+        """
+
+        async with AsyncSession(self.engine) as session:
+            # check for valid plan
+            if await session.get(Plan, plan_id) is None:
+                return None
+
+            # load every member in a single query
+            users = list(await session.scalars(member_query(plan_id, User, limit, after)))
+
+        logging.debug(f"Retrieved users in plan: {users}")
+        return users
+
+    async def get_plan_members(self, plan_id: str, limit: Optional[int] = None, after: Optional[str] = None) -> \
+            Optional[list[sqlalchemy.Row]]:
+        """
+        Get the public columns (ID, username, email) of the users in a plan, ordered by user ID
+
+        :param plan_id: Plan ID to get users from
+        :param limit: Maximum amount of users to return, or None for all
+        :param after: Only return users after this user ID, used to page through large plans
+        :return: Rows of user columns, or None if the plan does not exist
+        """
+
+        async with AsyncSession(self.engine) as session:
+            # check for valid plan
+            if await session.get(Plan, plan_id) is None:
+                return None
+
+            return (await session.execute(member_query(plan_id, (User.ID, User.username, User.email), limit,
+                                                       after))).all()
+
+    async def get_plan_progress(self, plan_id: str, unit: str = "km") -> Optional[list[sqlalchemy.Row]]:
+        """
+        Get the progress of every member of a plan, computed in the database
+
+        :param plan_id: Plan ID to get progress for
+        :param unit: Unit of the returned distances, a key of UNIT_METERS
+        :return: Rows of plan_progress_query, or None if the plan does not exist
+        """
+
+        async with AsyncSession(self.engine) as session:
+            # check for valid plan
+            if await session.get(Plan, plan_id) is None:
+                return None
+
+            return (await session.execute(plan_progress_query(plan_id, unit))).all()
+
+    async def get_leaderboard(self, plan_id: str, limit: int = 10, unit: str = "km") -> \
+            Optional[list[sqlalchemy.Row]]:
+        """
+        Get the top members of a plan from the incrementally maintained leaderboard
+
+        :param plan_id: Plan ID to get the leaderboard of
+        :param limit: Amount of members to return
+        :param unit: Unit of the returned distances, a key of UNIT_METERS
+        :return: Rows of leaderboard_query, or None if the plan does not exist
+        """
+
+        async with AsyncSession(self.engine) as session:
+            # check for valid plan
+            if await session.get(Plan, plan_id) is None:
+                return None
+
+            return (await session.execute(leaderboard_query(plan_id, limit, unit))).all()
+
+    async def stream_plan_activity(self, plan_id: str, batch_size: int = 1000) -> \
+            AsyncIterator[list[sqlalchemy.Row]]:
+        """
+        Stream the events and runs of a plan from a server side cursor, holding one batch in memory at a time
+
+        :param plan_id: Plan ID to export
+        :param batch_size: Amount of rows fetched per batch
+        :return: Iterator of row batches from plan_activity_query
+        """
+
+        async with AsyncSession(self.engine) as session:
+            result = await session.stream(plan_activity_query(plan_id).execution_options(yield_per=batch_size))
+
+            async for batch in result.partitions():
+                yield batch
+
+    async def add_users_to_plan(self, plan_id: str, users: Union[list[User], list[str]]) -> Optional[Plan]:
+        """
+        Add users to a plan
+
+        :param plan_id: Plan ID to modify
+        :param users: Users to add, or user IDs to add
+        :return: Plan with users added
+        """
+
+        user_ids = format_user_ids(users)
+
+        async with AsyncSession(self.engine) as session:
+            # check for valid plan
+            if await session.get(Plan, plan_id) is None:
+                return None
+
+            # skip users that are already members
+            existing = set()
+            for chunk in generic_db.chunks(user_ids):
+                existing.update(await session.scalars(sqlalchemy.select(PlanMember.user_id).where(
+                    PlanMember.plan_id == plan_id, PlanMember.user_id.in_(chunk))))
+
+            session.add_all([PlanMember(plan_id=plan_id, user_id=user_id) for user_id in user_ids
+                             if user_id not in existing])
+            await session.commit()
+
+            return await session.get(Plan, plan_id)
+
+    async def remove_users_from_plan(self, plan_id: str, users: Union[list[User], list[str]]) -> Optional[Plan]:
+        """
+        Remove users from a plan
+
+        :param plan_id: Plan ID to modify
+        :param users: Users to remove, or user IDs to remove
+        :return: Plan with users removed
+        """
+
+        user_ids = format_user_ids(users)
+
+        async with AsyncSession(self.engine) as session:
+            # check for valid plan
+            if await session.get(Plan, plan_id) is None:
+                return None
+
+            for chunk in generic_db.chunks(user_ids):
+                await session.execute(sqlalchemy.delete(PlanMember).where(PlanMember.plan_id == plan_id,
+                                                                         PlanMember.user_id.in_(chunk)))
+            await session.commit()
+
+            return await session.get(Plan, plan_id)
+
+    async def modify_plan(self, plan_id: str, new_name: str, new_description: str, new_date: datetime,
+                          new_distance: float, new_distance_unit: str, expected_version: Optional[int] = None) -> \
+            Optional[Plan]:
+        """
+        Modify a plan
+
+        :param plan_id: ID of the plan
+        :param new_name: New name of the plan
+        :param new_description: New description of the plan
+        :param new_date: New date of the plan
+        :param new_distance: New distance of the plan
+        :param new_distance_unit: New distance unit of the plan
+        :param expected_version: Only modify if the plan is still at this version, from If-Match
+        :raises StaleVersionError: If the plan was modified since expected_version
+        :return: Modified plan object
+        """
+
+        # modify plan in one statement
+        async with AsyncSession(self.engine, expire_on_commit=False) as session:
+            modified_plan: Optional[Plan] = await generic_db.async_update_returning(session, Plan, plan_id, {
+                "name": new_name, "description": new_description, "date": new_date, "distance": new_distance,
+                "distance_unit": new_distance_unit}, expected_version)
+
+            if modified_plan is None:
+                logging.debug(f"Could not find plan with ID {plan_id}")
+                return None
+
+            await session.commit()
+
+        logging.debug(f"Modified plan: {modified_plan}")
+        return modified_plan
+
+    async def delete_plan(self, plan_id: str) -> bool:
+        """
+        Delete a plan
+
+        :param plan_id: ID of the plan
+        :return: If the plan was deleted
+        """
+
+        async with AsyncSession(self.engine) as session:
+            p: Optional[Plan] = await session.get(Plan, plan_id)
+
+            if p is None:
+                logging.debug(f"Could not find plan with ID {plan_id}")
+                return False
+
+            # the events and runs are deleted with the plan
+            event_ids = (await session.scalars(sqlalchemy.select(Event.ID).where(Event.plan_id == plan_id))).all()
+            run_ids = (await session.scalars(sqlalchemy.select(Run.ID).join(Event, Event.ID == Run.event_id)
+                                             .where(Event.plan_id == plan_id))).all()
+
+            # delete plan, its memberships and its leaderboard
+            await session.execute(sqlalchemy.delete(PlanMember).where(PlanMember.plan_id == plan_id))
+            await session.execute(sqlalchemy.delete(PlanLeaderboard).where(PlanLeaderboard.plan_id == plan_id))
+            await session.delete(p)
+            await session.commit()
+
+        invalidate_plan_responses(event_ids, run_ids)
+
+        logging.debug(f"Deleted plan: {plan_id}")
+        return True
@@ -9,26 +9,84 @@ from datetime import datetime
 from typing import Optional
 
 import sqlalchemy.engine.base
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm.session import Session
 
 from api.src.main.db import generic_db
-from api.src.main.db.plan_db import Run, Event
+from api.src.main.db.cache import response_cache
+from api.src.main.db.plan_db import Run, Event, is_completed, leaderboard_row, leaderboard_upsert, run_completed, \
+    leaderboard_refresh, leaderboard_lock
 
 
-class RunCommands:
+def leaderboard_changes(runs: list[dict], events: dict[str, Event], counted: set[tuple[str, str]]) -> list[dict]:
+    """
+    Work out the leaderboard changes of inserting many runs, one per plan and user
+
+    :param runs: Runs being inserted
+    :param events: Events the completed runs belong to, by ID
+    :param counted: (event ID, user ID) pairs that already have a completed run
+    :return: Parameters for leaderboard_upsert
+    """
+
+    changes = {}
+
+    # the first completed run of a user counts for the event
+    for event_id, user_id in {(run["event_id"], run["usr_id"]) for run in runs if is_completed(run["status"])}:
+        if (event_id, user_id) in counted or event_id not in events:
+            continue
+
+        row = leaderboard_row(events[event_id], user_id, 1)
+        key = (row["plan_id"], user_id)
+
+        if key in changes:
+            changes[key]["completed_events"] += row["completed_events"]
+            changes[key]["completed_meters"] += row["completed_meters"]
+        else:
+            changes[key] = row
+
+    return list(changes.values())
+
+
+def leaderboard_locks(runs: list[dict], events: dict[str, Event]) -> list[dict]:
+    """
+    Work out the leaderboard entries to lock before inserting many runs, one per plan and user, in (plan, user) order
+    so two bulk inserts lock shared entries in the same order and cannot deadlock
+
+    :param runs: Runs being inserted
+    :param events: Events the completed runs belong to, by ID
+    :return: Parameters for leaderboard_lock
+    """
+
+    locks = {}
+
+    for run in runs:
+        event = events.get(run["event_id"])
+
+        if event is not None and is_completed(run["status"]):
+            locks.setdefault((event.plan_id, run["usr_id"]), {"event_id": event.ID, "user_id": run["usr_id"]})
+
+    return [locks[key] for key in sorted(locks)]
+
+
+class RunCommands(generic_db.DBCommands):
     """
     Class to handle the run commands
     """
 
-    def __init__(self, db_obj: generic_db.DBModificationObject):
-        """
-        Create a new RunCommands object
+    @staticmethod
+    def _refresh_leaderboard(session: Session, event_id: str, user_id: str):
         """
+        Recompute the leaderboard entry of a user in the plan of an event from their runs, holding the entry's lock so
+        concurrent changes of the same user count each other's runs
 
-        # add to db
-        Run.metadata.create_all(db_obj.engine)
+        :param session: Session of the run change, after the change was flushed
+        :param event_id: Event ID of the run
+        :param user_id: User ID of the run
+        """
 
-        self.engine: sqlalchemy.Engine = db_obj.engine
+        dialect_name = session.bind.dialect.name
+        session.execute(leaderboard_lock(dialect_name), [{"event_id": event_id, "user_id": user_id}])
+        session.execute(leaderboard_refresh(dialect_name, event_id, user_id))
 
     def create_run(self, event_id: str, user_id: str, date: datetime, status: str) -> Optional[Run]:
         """
@@ -53,10 +111,56 @@ class RunCommands:
 
             # add to db
             session.add(run)
+            session.flush()
+
+            if is_completed(status):
+                self._refresh_leaderboard(session, event_id, user_id)
+
             session.commit()
 
             return session.get(Run, run.ID)
 
+    def create_runs(self, runs: list[dict]) -> list[str]:
+        """
+        Insert many runs with a single executemany in one transaction, the referenced events and users are not checked
+
+        :param runs: Dictionaries with the event_id, usr_id, date and status of each run
+        :return: Created run IDs, in the same order as the runs
+        """
+
+        rows = [dict(run, ID=generic_db.create_id("RUN")) for run in runs]
+
+        if rows:
+            with Session(self.engine) as session:
+                events = {}
+                counted = set()
+
+                # events of the completed runs
+                event_ids = list({row["event_id"] for row in rows if is_completed(row["status"])})
+                for chunk in generic_db.chunks(event_ids):
+                    events.update((event.ID, event) for event in
+                                  session.scalars(sqlalchemy.select(Event).where(Event.ID.in_(chunk))))
+
+                # lock the entries before reading the completions that already count, so none is counted twice
+                locks = leaderboard_locks(rows, events)
+                if locks:
+                    session.execute(leaderboard_lock(session.bind.dialect.name), locks)
+
+                for chunk in generic_db.chunks(event_ids):
+                    counted.update(session.execute(sqlalchemy.select(Run.event_id, Run.usr_id).distinct()
+                                                   .where(Run.event_id.in_(chunk), run_completed())).tuples())
+
+                changes = leaderboard_changes(rows, events, counted)
+
+                session.execute(sqlalchemy.insert(Run), rows)
+                if changes:
+                    session.execute(leaderboard_upsert(session.bind.dialect.name), changes)
+                session.commit()
+
+        logging.debug("Created %d runs", len(rows))
+        return [row["ID"] for row in rows]
+
+    @generic_db.replica_read
     def get_run(self, run_id: str) -> Optional[Run]:
         """
         Get a run from the database
@@ -65,36 +169,40 @@ class RunCommands:
         :return: Run if successful
         """
 
-        with Session(self.engine) as session:
+        with Session(self.read_engine) as session:
             r: Optional[Run] = session.get(Run, run_id)
             logging.debug("Retrieved run: " + str(r))
             return r
 
-    def modify_run(self, run_id: str, date: datetime, status: str) -> Optional[Run]:
+    def modify_run(self, run_id: str, date: datetime, status: str, expected_version: Optional[int] = None) -> \
+            Optional[Run]:
         """
         Modify a run in the database
 
         :param run_id: Run ID to modify
         :param date: Date to change to
         :param status: Status to change to
+        :param expected_version: Only modify if the run is still at this version, from If-Match
+        :raises StaleVersionError: If the run was modified since expected_version
         :return: Modified run if successful
         """
 
-        with Session(self.engine) as session:
-            # get run
-            run: Optional[Run] = session.get(Run, run_id)
+        with Session(self.engine, expire_on_commit=False) as session:
+            # modify run in one statement, no row means no run
+            run: Optional[Run] = generic_db.update_returning(session, Run, run_id, {"date": date, "status": status},
+                                                             expected_version)
 
             if run is None:
                 return None
 
-            # modify run
-            run.date = date
-            run.status = status
+            # the previous status is not read, so recompute the user's entry from their runs
+            self._refresh_leaderboard(session, run.event_id, run.usr_id)
 
             # commit changes
             session.commit()
+            response_cache.invalidate("run", run_id, run.version)
 
-            return session.get(Run, run.ID)
+            return run
 
     def delete_run(self, run_id: str) -> bool:
         """
@@ -113,6 +221,178 @@ class RunCommands:
 
             # delete run
             session.delete(run)
+            session.flush()
+
+            if is_completed(run.status):
+                self._refresh_leaderboard(session, run.event_id, run.usr_id)
+
             session.commit()
+            response_cache.invalidate("run", run_id)
+
+            return True
+
+
+class AsyncRunCommands(generic_db.AsyncDBCommands):
+    """
+    Async class to handle the run commands, mirroring RunCommands
+    """
+
+    @staticmethod
+    async def _refresh_leaderboard(session: AsyncSession, event_id: str, user_id: str):
+        """
+        Recompute the leaderboard entry of a user in the plan of an event from their runs, holding the entry's lock so
+        concurrent changes of the same user count each other's runs
+
+        :param session: Session of the run change, after the change was flushed
+        :param event_id: Event ID of the run
+        :param user_id: User ID of the run
+        """
+
+        dialect_name = session.bind.dialect.name
+        await session.execute(leaderboard_lock(dialect_name), [{"event_id": event_id, "user_id": user_id}])
+        await session.execute(leaderboard_refresh(dialect_name, event_id, user_id))
+
+    async def create_run(self, event_id: str, user_id: str, date: datetime, status: str) -> Optional[Run]:
+        """
+        Create a new run
+
+        :param event_id: Event ID to add run to
+        :param user_id: User ID who completed run
+        :param date: Date completed on
+        :param status: Status of completion
+        :return: Created run if successful
+        """
+
+        async with AsyncSession(self.engine) as session:
+            # check for valid event
+            event: Optional[Event] = await session.get(Event, event_id)
+
+            if event is None:
+                return None
+
+            # create run
+            run_id = generic_db.create_id("RUN")
+            run: Run = Run(ID=run_id, event_id=event_id, usr_id=user_id, date=date, status=status)
+
+            # add to db
+            session.add(run)
+            await session.flush()
+
+            if is_completed(status):
+                await self._refresh_leaderboard(session, event_id, user_id)
+
+            await session.commit()
+
+            return await session.get(Run, run_id)
+
+    async def create_runs(self, runs: list[dict]) -> list[str]:
+        """
+        Insert many runs with a single executemany in one transaction, the referenced events and users are not checked
+
+        :param runs: Dictionaries with the event_id, usr_id, date and status of each run
+        :return: Created run IDs, in the same order as the runs
+        """
+
+        rows = [dict(run, ID=generic_db.create_id("RUN")) for run in runs]
+
+        if rows:
+            async with AsyncSession(self.engine) as session:
+                events = {}
+                counted = set()
+
+                # events of the completed runs
+                event_ids = list({row["event_id"] for row in rows if is_completed(row["status"])})
+                for chunk in generic_db.chunks(event_ids):
+                    events.update((event.ID, event) for event in
+                                  await session.scalars(sqlalchemy.select(Event).where(Event.ID.in_(chunk))))
+
+                # lock the entries before reading the completions that already count, so none is counted twice
+                locks = leaderboard_locks(rows, events)
+                if locks:
+                    await session.execute(leaderboard_lock(session.bind.dialect.name), locks)
+
+                for chunk in generic_db.chunks(event_ids):
+                    counted.update((await session.execute(sqlalchemy.select(Run.event_id, Run.usr_id).distinct()
+                                                          .where(Run.event_id.in_(chunk), run_completed()))).tuples())
+
+                changes = leaderboard_changes(rows, events, counted)
+
+                await session.execute(sqlalchemy.insert(Run), rows)
+                if changes:
+                    await session.execute(leaderboard_upsert(session.bind.dialect.name), changes)
+                await session.commit()
+
+        logging.debug("Created %d runs", len(rows))
+        return [row["ID"] for row in rows]
+
+    @generic_db.replica_read
+    async def get_run(self, run_id: str) -> Optional[Run]:
+        """
+        Get a run from the database
+
+        :param run_id: Run ID to get
+        :return: Run if successful
+        """
+
+        async with AsyncSession(self.read_engine) as session:
+            r: Optional[Run] = await session.get(Run, run_id)
+            logging.debug("Retrieved run: " + str(r))
+            return r
+
+    async def modify_run(self, run_id: str, date: datetime, status: str, expected_version: Optional[int] = None) -> \
+            Optional[Run]:
+        """
+        Modify a run in the database
+
+        :param run_id: Run ID to modify
+        :param date: Date to change to
+        :param status: Status to change to
+        :param expected_version: Only modify if the run is still at this version, from If-Match
+        :raises StaleVersionError: If the run was modified since expected_version
+        :return: Modified run if successful
+        """
+
+        async with AsyncSession(self.engine, expire_on_commit=False) as session:
+            # modify run in one statement, no row means no run
+            run: Optional[Run] = await generic_db.async_update_returning(session, Run, run_id,
+                                                                         {"date": date, "status": status},
+                                                                         expected_version)
+
+            if run is None:
+                return None
+
+            # the previous status is not read, so recompute the user's entry from their runs
+            await self._refresh_leaderboard(session, run.event_id, run.usr_id)
+
+            # commit changes
+            await session.commit()
+            response_cache.invalidate("run", run_id, run.version)
+
+            return run
+
+    async def delete_run(self, run_id: str) -> bool:
+        """
+        Delete a run from the database
+
+        :param run_id: Run ID to delete
+        :return: Deleted run if successful
+        """
+
+        async with AsyncSession(self.engine) as session:
+            # get run
+            run: Optional[Run] = await session.get(Run, run_id)
+
+            if run is None:
+                return False
+
+            # delete run
+            await session.delete(run)
+            await session.flush()
+
+            if is_completed(run.status):
+                await self._refresh_leaderboard(session, run.event_id, run.usr_id)
+
+            await session.commit()
+            response_cache.invalidate("run", run_id)
 
             return True
@@ -0,0 +1,181 @@
+"""
+tracing.py
+By: Zack Bamford
+
+Query tracing for the Commands layer: fingerprints of the statements a request runs, to flag the same statement
+repeated many times (N+1 queries), a log of slow statements with their parameters redacted, and a query budget for
+tests
+"""
+import logging
+import os
+import re
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+import sqlalchemy
+
+# bind parameter placeholders of the SQLite, psycopg2 and asyncpg drivers
+_PLACEHOLDER = re.compile(r"\?|%\(\w+\)s|%s|\$\d+|(?<!:):\w+")
+
+# literals written into the statement
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+# lists of placeholders, such as IN lists and multi-row VALUES, whose length depends on the input
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_ROWS = re.compile(r"\(\?\)(?:\s*,\s*\(\?\))+")
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(statement: str) -> str:
+    """
+    Normalize a statement so runs with different parameters, literals or list lengths compare equal
+
+    :param statement: SQL statement
+    :return: Statement with every value replaced by ?
+    """
+
+    statement = _LITERAL.sub("?", _PLACEHOLDER.sub("?", statement))
+    statement = _ROWS.sub("(?)", _LIST.sub("(?)", statement))
+    return " ".join(statement.split())
+
+
+def redact(parameters: Any) -> Any:
+    """
+    Replace bound parameters with their type names, so logs show the shape of a statement without user data
+
+    :param parameters: Parameters passed to the cursor
+    :return: Redacted parameters
+    """
+
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+
+    if isinstance(parameters, (list, tuple)):
+        # executemany passes a list of parameter sets
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return f"{len(parameters)} x {redact(parameters[0])}"
+
+        return [type(value).__name__ for value in parameters]
+
+    return type(parameters).__name__
+
+
+class QueryTrace:
+    """
+    Fingerprints and timings of the statements run in one request
+    """
+
+    def __init__(self):
+        self.counts: Counter[str] = Counter()
+        self.seconds: dict[str, float] = {}
+
+    def record(self, statement: str, seconds: float):
+        """
+        Record an executed statement
+
+        :param statement: SQL statement
+        :param seconds: Time spent executing it
+        """
+
+        key = fingerprint(statement)
+        self.counts[key] += 1
+        self.seconds[key] = self.seconds.get(key, 0.0) + seconds
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    def repeated(self, threshold: int) -> list[tuple[str, int]]:
+        """
+        Get the statements run at least threshold times
+
+        :param threshold: Amount of runs to flag
+        :return: List of fingerprints and their amount of runs, most repeated first
+        """
+
+        return [(key, count) for key, count in self.counts.most_common() if count >= threshold]
+
+
+# every request records a QueryTrace when set, off by default as fingerprinting costs time on every statement
+TRACE_QUERIES = os.environ.get("DB_TRACE_QUERIES", "").lower() in ("1", "true", "yes")
+
+# runs of one statement in a request before it is flagged
+REPEAT_THRESHOLD = int(os.environ.get("DB_REPEAT_THRESHOLD", 5))
+
+# statements slower than this are logged, 0 disables the log
+SLOW_QUERY_SECONDS = float(os.environ.get("DB_SLOW_QUERY_MS", 0)) / 1000
+
+
+def log_slow_query(statement: str, parameters: Any, seconds: float):
+    """
+    Log a statement slower than DB_SLOW_QUERY_MS, with its parameters redacted
+
+    :param statement: SQL statement
+    :param parameters: Parameters passed to the cursor
+    :param seconds: Time spent executing it
+    """
+
+    if 0 < SLOW_QUERY_SECONDS <= seconds:
+        logger.warning(f"Slow query ({seconds * 1000:.1f} ms): {' '.join(statement.split())} "
+                       f"parameters={redact(parameters)}")
+
+
+def report_repeats(trace: QueryTrace, request: str, threshold: int = REPEAT_THRESHOLD) -> list[tuple[str, int]]:
+    """
+    Log the statements a request repeated at least threshold times
+
+    :param trace: Trace of the request
+    :param request: Method and route of the request, for the log
+    :param threshold: Amount of runs to flag
+    :return: Flagged fingerprints and their amount of runs
+    """
+
+    repeated = trace.repeated(threshold)
+
+    for key, count in repeated:
+        logger.warning(f"{request} ran the same statement {count} times, a possible N+1 query: {key}")
+
+    return repeated
+
+
+@contextmanager
+def assert_query_budget(max_queries: int, max_repeats: Optional[int] = None,
+                        engines: Optional[list[sqlalchemy.Engine]] = None) -> Iterator[QueryTrace]:
+    """
+    Fail if the code inside the context runs more statements than its budget, for use in tests.
+    Raises AssertionError, so it works under unittest and pytest alike.
+
+    :param max_queries: Maximum amount of statements
+    :param max_repeats: Maximum runs of any one statement, or None to not check
+    :param engines: Engines to watch, defaults to the sync and async app engines
+    :return: Trace of the statements, filled as they run
+    """
+
+    if engines is None:
+        # imported here as generic_db depends on this module
+        from api.src.main.db import generic_db
+        engines = [generic_db.db_obj.engine, generic_db.async_db_obj.engine.sync_engine]
+
+    trace = QueryTrace()
+
+    def record(connection, cursor, statement, *args):
+        trace.record(statement, 0.0)
+
+    for engine in engines:
+        sqlalchemy.event.listen(engine, "before_cursor_execute", record)
+
+    try:
+        yield trace
+    finally:
+        for engine in engines:
+            sqlalchemy.event.remove(engine, "before_cursor_execute", record)
+
+    statements = "\n".join(f"  {count} x {key}" for key, count in trace.counts.most_common())
+
+    if trace.total > max_queries:
+        raise AssertionError(f"Ran {trace.total} statements, over the budget of {max_queries}:\n{statements}")
+
+    if max_repeats is not None and trace.repeated(max_repeats + 1):
+        raise AssertionError(f"Ran a statement more than {max_repeats} times:\n{statements}")
@@ -5,13 +5,21 @@ By: Zack Bamford
 Functions to modify and create users within the database
 """
 import logging
+import os
 from typing import Optional
 
 import sqlalchemy
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from sqlalchemy.orm import Mapped
 
 from api.src.main.db import generic_db
+from api.src.main.db.cache import TTLCache, response_cache
+
+# users behind authenticated requests, keyed by user ID and invalidated whenever a user is modified or deleted
+principal_cache: TTLCache = TTLCache(int(os.environ.get("AUTH_CACHE_SIZE", 10000)),
+                                     float(os.environ.get("AUTH_CACHE_TTL", 60)))
 
 
 class User(generic_db.Base):
@@ -26,6 +34,12 @@ class User(generic_db.Base):
     email: Mapped[str] = sqlalchemy.Column(sqlalchemy.String)
     password: Mapped[str] = sqlalchemy.Column(sqlalchemy.String)
 
+    # bumped by every modify, sent as the ETag
+    version: Mapped[int] = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=1, server_default="1")
+
+    # emails are unique regardless of case, and looked up on every login
+    __table_args__ = (sqlalchemy.Index("ix_users_email_lower", sqlalchemy.func.lower(email), unique=True),)
+
     class Config:
         orm_mode = True
 
@@ -54,19 +68,22 @@ class User(generic_db.Base):
         return self.username == other.username and self.email == other.email and self.password == other.password
 
 
-class UserCommands:
-    """Database commands for a user object"""
+def user_values(username: Optional[str], email: Optional[str], password: Optional[str]) -> dict:
+    """
+    Build the columns to update from the given fields, so a modify never writes back values it did not change
 
-    def __init__(self, db_obj: generic_db.DBModificationObject):
-        """
-        Create a new UserCommands object
+    :param username: New username, or None to keep it
+    :param email: New email, or None to keep it
+    :param password: New password, or None to keep it
+    :return: Dictionary of column names and new values
+    """
 
-        :param db_obj: DBModificationObject to use
-        """
-        # add to db
-        User.metadata.create_all(db_obj.engine)
+    values = {"username": username, "email": email, "password": password}
+    return {column: value for column, value in values.items() if value is not None}
 
-        self.engine: sqlalchemy.Engine = db_obj.engine
+
+class UserCommands(generic_db.DBCommands):
+    """Database commands for a user object"""
 
     def create_user(self, name: str, email: str, password: str) -> Optional[User]:
         """
@@ -75,7 +92,7 @@ class UserCommands:
         :param name: Name of the user
         :param email: Email of the user
         :param password: Password of the user
-        :return: User object or none if error
+        :return: User object or none if error (such as the email already being in use)
         """
 
         user = User(ID=generic_db.create_id("USER"), username=name, email=email, password=password)
@@ -83,7 +100,12 @@ class UserCommands:
         # add to session and commit
         with Session(self.engine) as session:
             session.add(user)
-            session.commit()
+
+            try:
+                session.commit()
+            except IntegrityError:
+                logging.debug("Could not create user, email already in use: %s", email)
+                return None
 
             created_user = session.get(User, user.ID)
 
@@ -91,6 +113,7 @@ class UserCommands:
 
         return created_user
 
+    @generic_db.replica_read
     def retrieve_user(self, user_id: str) -> Optional[User]:
         """
         Retrieve a user object from the database
@@ -99,55 +122,95 @@ class UserCommands:
         :return: User object or None if error
         """
 
-        with Session(self.engine) as session:
+        with Session(self.read_engine) as session:
             u: Optional[User] = session.get(User, user_id)
 
             logging.debug("Retrieved user: %s", u)
             return u
 
-    def modify_user(self, user_id: str, new_username: str, new_email: str, new_password: str) -> Optional[User]:
+    def retrieve_users(self, user_ids: list[str]) -> list[User]:
+        """
+        Retrieve many user objects from the database with set-based queries
+
+        :param user_ids: Existing user IDs
+        :return: Users that were found, IDs that do not exist are skipped
         """
-        Modify an existing user object
+
+        users = []
+
+        with Session(self.engine) as session:
+            # one query per chunk to respect the bind parameter limit
+            for chunk in generic_db.chunks(list(dict.fromkeys(user_ids))):
+                users += session.scalars(sqlalchemy.select(User).where(User.ID.in_(chunk)))
+
+        logging.debug("Retrieved %d users", len(users))
+        return users
+
+    def get_existing_user_ids(self, user_ids: list[str]) -> set[str]:
+        """
+        Check which user IDs exist with set-based queries, selecting only the ID column
+
+        :param user_ids: User IDs to check
+        :return: Set of the user IDs that exist
+        """
+
+        existing = set()
+
+        with Session(self.engine) as session:
+            # one query per chunk to respect the bind parameter limit
+            for chunk in generic_db.chunks(list(dict.fromkeys(user_ids))):
+                existing.update(session.scalars(sqlalchemy.select(User.ID).where(User.ID.in_(chunk))))
+
+        return existing
+
+    def modify_user(self, user_id: str, new_username: Optional[str] = None, new_email: Optional[str] = None,
+                    new_password: Optional[str] = None, expected_version: Optional[int] = None) -> Optional[User]:
+        """
+        Modify an existing user object, only writing the columns that are given
 
         :param user_id: Existing User ID
-        :param new_username: New username
-        :param new_email: New email
-        :param new_password: New password
-        :return: New user if successful, or None if error
+        :param new_username: New username, or None to keep it
+        :param new_email: New email, or None to keep it
+        :param new_password: New password, or None to keep it
+        :param expected_version: Only modify if the user is still at this version, from If-Match
+        :raises StaleVersionError: If the user was modified since expected_version
+        :return: New user if successful, or None if error (such as the new email already being in use)
         """
 
         # try and get user object
-        with Session(self.engine) as session:
-            u: Optional[User] = session.get(User, user_id)
+        with Session(self.engine, expire_on_commit=False) as session:
+            # write information in one statement, the unique email index rejects an email in use
+            try:
+                u: Optional[User] = generic_db.update_returning(session, User, user_id, user_values(
+                    new_username, new_email, new_password), expected_version)
+                session.commit()
+            except IntegrityError:
+                logging.debug("Could not modify user, email already in use: %s", new_email)
+                return None
 
             # check if user does exist
             if u is None:
                 return None
 
-            # write information
-            u.username = new_username
-            u.email = new_email
-            u.password = new_password
-
             logging.debug("Modified user: %s", u)
 
-            # commit
-            session.commit()
+            principal_cache.invalidate(user_id, u.version)
+            response_cache.invalidate("user", user_id, u.version)
 
             # return updated user object
-            return session.get(User, user_id)
+            return u
 
     def retrieve_user_by_email(self, email: str) -> Optional[User]:
         """
-        Retrieve a user by their email
+        Retrieve a user by their email, ignoring case
 
         :param email: Email to retrieve by
         :return: User if found, or none
         """
 
         with Session(self.engine) as session:
-            # get user
-            u: Optional[User] = session.query(User).filter(User.email == email).first()
+            # get user through the lower(email) index
+            u: Optional[User] = session.query(User).filter(sqlalchemy.func.lower(User.email) == email.lower()).first()
 
             logging.debug("Retrieved user by email: %s", u)
             return u
@@ -170,8 +233,182 @@ class UserCommands:
 
             logging.debug("Deleted user: %s", u)
 
-            # delete object
+            # imported here as plan_db depends on this module
+            from api.src.main.db.plan_db import PlanMember, PlanLeaderboard
+
+            # delete object, its plan memberships and leaderboard entries
+            session.execute(sqlalchemy.delete(PlanMember).where(PlanMember.user_id == user_id))
+            session.execute(sqlalchemy.delete(PlanLeaderboard).where(PlanLeaderboard.user_id == user_id))
             session.delete(u)
             session.commit()
+            principal_cache.invalidate(user_id)
+            response_cache.invalidate("user", user_id)
+
+            return True
+
+
+class AsyncUserCommands(generic_db.AsyncDBCommands):
+    """Async database commands for a user object, mirroring UserCommands"""
+
+    async def create_user(self, name: str, email: str, password: str) -> Optional[User]:
+        """
+        Create a new user
+
+        :param name: Name of the user
+        :param email: Email of the user
+        :param password: Password of the user
+        :return: User object or none if error (such as the email already being in use)
+        """
+
+        user_id = generic_db.create_id("USER")
+        user = User(ID=user_id, username=name, email=email, password=password)
+
+        # add to session and commit
+        async with AsyncSession(self.engine) as session:
+            session.add(user)
+
+            try:
+                await session.commit()
+            except IntegrityError:
+                logging.debug("Could not create user, email already in use: %s", email)
+                return None
+
+            created_user = await session.get(User, user_id)
+
+        logging.debug("Created user: %s", created_user)
+
+        return created_user
+
+    @generic_db.replica_read
+    async def retrieve_user(self, user_id: str) -> Optional[User]:
+        """
+        Retrieve a user object from the database
+
+        :param user_id: Existing user id
+        :return: User object or None if error
+        """
+
+        async with AsyncSession(self.read_engine) as session:
+            u: Optional[User] = await session.get(User, user_id)
+
+            logging.debug("Retrieved user: %s", u)
+            return u
+
+    async def retrieve_users(self, user_ids: list[str]) -> list[User]:
+        """
+        Retrieve many user objects from the database with set-based queries
+
+        :param user_ids: Existing user IDs
+        :return: Users that were found, IDs that do not exist are skipped
+        """
+
+        users = []
+
+        async with AsyncSession(self.engine) as session:
+            # one query per chunk to respect the bind parameter limit
+            for chunk in generic_db.chunks(list(dict.fromkeys(user_ids))):
+                users += await session.scalars(sqlalchemy.select(User).where(User.ID.in_(chunk)))
+
+        logging.debug("Retrieved %d users", len(users))
+        return users
+
+    async def get_existing_user_ids(self, user_ids: list[str]) -> set[str]:
+        """
+        Check which user IDs exist with set-based queries, selecting only the ID column
+
+        :param user_ids: User IDs to check
+        :return: Set of the user IDs that exist
+        """
+
+        existing = set()
+
+        async with AsyncSession(self.engine) as session:
+            # one query per chunk to respect the bind parameter limit
+            for chunk in generic_db.chunks(list(dict.fromkeys(user_ids))):
+                existing.update(await session.scalars(sqlalchemy.select(User.ID).where(User.ID.in_(chunk))))
+
+        return existing
+
+    async def modify_user(self, user_id: str, new_username: Optional[str] = None, new_email: Optional[str] = None,
+                          new_password: Optional[str] = None,
+                          expected_version: Optional[int] = None) -> Optional[User]:
+        """
+        Modify an existing user object, only writing the columns that are given
+
+        :param user_id: Existing User ID
+        :param new_username: New username, or None to keep it
+        :param new_email: New email, or None to keep it
+        :param new_password: New password, or None to keep it
+        :param expected_version: Only modify if the user is still at this version, from If-Match
+        :raises StaleVersionError: If the user was modified since expected_version
+        :return: New user if successful, or None if error (such as the new email already being in use)
+        """
+
+        async with AsyncSession(self.engine, expire_on_commit=False) as session:
+            # write information in one statement, the unique email index rejects an email in use
+            try:
+                u: Optional[User] = await generic_db.async_update_returning(session, User, user_id, user_values(
+                    new_username, new_email, new_password), expected_version)
+                await session.commit()
+            except IntegrityError:
+                logging.debug("Could not modify user, email already in use: %s", new_email)
+                return None
+
+            # check if user does exist
+            if u is None:
+                return None
+
+            logging.debug("Modified user: %s", u)
+
+            principal_cache.invalidate(user_id, u.version)
+            response_cache.invalidate("user", user_id, u.version)
+
+            # return updated user object
+            return u
+
+    async def retrieve_user_by_email(self, email: str) -> Optional[User]:
+        """
+        Retrieve a user by their email, ignoring case
+
+        :param email: Email to retrieve by
+        :return: User if found, or none
+        """
+
+        async with AsyncSession(self.engine) as session:
+            # get user through the lower(email) index
+            u: Optional[User] = (await session.scalars(
+                sqlalchemy.select(User).where(sqlalchemy.func.lower(User.email) == email.lower()))).first()
+
+            logging.debug("Retrieved user by email: %s", u)
+            return u
+
+    async def delete_user(self, user_id: str) -> bool:
+        """
+        Delete a user from the database
+
+        :param user_id: User ID to delete
+        :return: T/F on success
+        """
+
+        async with AsyncSession(self.engine) as session:
+            # get object
+            u: Optional[User] = await session.get(User, user_id)
+
+            # check if object exists
+            if u is None:
+                return False
+
+            logging.debug("Deleted user: %s", u)
+
+            # imported here as plan_db depends on this module
+            from api.src.main.db.plan_db import PlanMember, PlanLeaderboard
+
+            # delete object, its plan memberships and leaderboard entries
+            await session.execute(sqlalchemy.delete(PlanMember).where(PlanMember.user_id == user_id))
+            await session.execute(sqlalchemy.delete(PlanLeaderboard).where(PlanLeaderboard.user_id == user_id))
+            await session.delete(u)
+            await session.commit()
+            principal_cache.invalidate(user_id)
+            response_cache.invalidate("user", user_id)
 
-            return True
\ No newline at end of file
+            return True
@@ -0,0 +1,65 @@
+"""
+test_auth.py
+By: Zack Bamford
+
+File to test the authentication of requests
+"""
+import os
+from unittest import IsolatedAsyncioTestCase, mock
+
+# the token secret is required to import the auth module
+os.environ.setdefault("SECRET_KEY", "test")
+
+from api.src.main.api import auth
+from api.src.main.db import generic_db
+from api.src.main.db.user_db import AsyncUserCommands, UserCommands, principal_cache
+
+
+class RecordingUserCommands(AsyncUserCommands):
+    """
+    User commands recording if each user lookup was allowed to read from a replica
+    """
+
+    def __init__(self):
+        super().__init__(generic_db.async_db_obj)
+        self.replica_allowed: list[bool] = []
+
+    async def retrieve_user(self, user_id: str):
+        self.replica_allowed.append(generic_db.replica_reads_allowed())
+        return await super().retrieve_user(user_id)
+
+
+class TestRetrieveUser(IsolatedAsyncioTestCase):
+    """
+    Test loading the user of a token
+    """
+
+    def setUp(self):
+        """
+        Create a user and its token
+
+        :return:
+        """
+
+        self.user = UserCommands(generic_db.db_obj).create_user("auth", f"auth.{id(self)}@example.com", "x")
+        self.token = auth.create_access_token({"sub": self.user.ID})
+        self.uc = RecordingUserCommands()
+
+    async def test_principal_from_primary(self):
+        """
+        Test a principal that will be cached is read from the primary, then served from the cache
+
+        :return:
+        """
+
+        self.assertEqual(self.user.ID, (await auth.retrieve_user(self.token, self.uc)).ID)
+        self.assertEqual(self.user.ID, (await auth.retrieve_user(self.token, self.uc)).ID)
+        self.assertEqual([False], self.uc.replica_allowed)
+
+        # without the cache the lookup may use a replica
+        principal_cache.invalidate(self.user.ID, self.user.version + 1)
+
+        with mock.patch.object(principal_cache, "ttl", 0):
+            await auth.retrieve_user(self.token, self.uc)
+
+        self.assertEqual([False, True], self.uc.replica_allowed)
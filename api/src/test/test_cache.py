@@ -0,0 +1,354 @@
+"""
+test_cache.py
+By: Zack Bamford
+
+File to test the in-process caches and the response cache
+"""
+import os
+import tempfile
+import time
+from unittest import TestCase, mock
+
+from api.src.main.db.cache import TTLCache, CacheBackend, MemoryBackend, SQLiteBackend, ResponseCache
+
+
+class TestTTLCache(TestCase):
+    """
+    Test the TTL cache
+    """
+
+    def test_get_and_set(self):
+        """
+        Test hits, misses and invalidation
+
+        :return:
+        """
+
+        cache = TTLCache(10, 60)
+
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", 1)
+        self.assertEqual(1, cache.get("a"))
+
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
+
+        stats = cache.as_dict()
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(2, stats["misses"])
+        self.assertAlmostEqual(1 / 3, stats["hit_rate"])
+
+    def test_versions(self):
+        """
+        Test a value loaded before a change is not cached over it
+
+        :return:
+        """
+
+        cache = TTLCache(10, 60)
+
+        # loaded at version 1, modified to version 2 before the value is cached
+        cache.set("a", "v1", 1)
+        cache.invalidate("a", 2)
+        cache.set("a", "v1", 1)
+        self.assertIsNone(cache.get("a"))
+
+        cache.set("a", "v2", 2)
+        self.assertEqual("v2", cache.get("a"))
+
+        # an older value does not replace a newer one, nor an older invalidation a newer value
+        cache.set("a", "v1", 1)
+        cache.invalidate("a", 1)
+        self.assertEqual("v2", cache.get("a"))
+
+        # nothing is cached over a deleted value
+        cache.invalidate("a")
+        cache.set("a", "v3", 3)
+        self.assertIsNone(cache.get("a"))
+
+        # the marker expires with the TTL
+        with mock.patch("api.src.main.db.cache.time.monotonic", return_value=time.monotonic() + 60):
+            cache.set("a", "v3", 3)
+            self.assertEqual("v3", cache.get("a"))
+
+    def test_lru_eviction(self):
+        """
+        Test the least recently used entry is evicted past the maximum size
+
+        :return:
+        """
+
+        cache = TTLCache(2, 60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        # use a, so b is the oldest
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(1, cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(3, cache.get("c"))
+        self.assertEqual(1, cache.as_dict()["evictions"])
+
+    def test_expiry(self):
+        """
+        Test entries expire after the TTL, and a TTL of 0 disables the cache
+
+        :return:
+        """
+
+        cache = TTLCache(10, 60)
+
+        with mock.patch("api.src.main.db.cache.time.monotonic", return_value=100):
+            cache.set("a", 1)
+
+        with mock.patch("api.src.main.db.cache.time.monotonic", return_value=159):
+            self.assertEqual(1, cache.get("a"))
+
+        with mock.patch("api.src.main.db.cache.time.monotonic", return_value=160):
+            self.assertIsNone(cache.get("a"))
+
+        self.assertEqual(0, cache.as_dict()["size"])
+
+        disabled = TTLCache(10, 0)
+        disabled.set("a", 1)
+        self.assertIsNone(disabled.get("a"))
+
+
+class TestMemoryBackend(TestCase):
+    """
+    Test the in-process response storage
+    """
+
+    def test_memory_budget(self):
+        """
+        Test the least recently used entries are evicted past the memory budget
+
+        :return:
+        """
+
+        # each entry is a 1 byte key and a 10 byte value
+        backend = MemoryBackend(25)
+        backend.set("a", b"0123456789", 60)
+        backend.set("b", b"0123456789", 60)
+
+        # use a, so b is the oldest
+        backend.get("a")
+        backend.set("c", b"0123456789", 60)
+
+        self.assertEqual(b"0123456789", backend.get("a"))
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual((2, 22), backend.usage())
+        self.assertEqual(1, backend.evictions)
+
+        # larger than the whole budget, nothing is evicted for it
+        backend.set("d", b"0" * 30, 60)
+        self.assertIsNone(backend.get("d"))
+        self.assertEqual((2, 22), backend.usage())
+
+        backend.delete("a")
+        self.assertEqual((1, 11), backend.usage())
+
+    def test_expiry(self):
+        """
+        Test entries expire after their TTL
+
+        :return:
+        """
+
+        backend = MemoryBackend(100)
+
+        with mock.patch("api.src.main.db.cache.time.monotonic", return_value=100):
+            backend.set("a", b"1", 10)
+
+        with mock.patch("api.src.main.db.cache.time.monotonic", return_value=110):
+            self.assertIsNone(backend.get("a"))
+
+        self.assertEqual((0, 0), backend.usage())
+
+
+class TestSQLiteBackend(TestCase):
+    """
+    Test the response storage shared between workers
+    """
+
+    def setUp(self):
+        """
+        Create the cache file in a temporary directory
+
+        :return:
+        """
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache.db")
+
+    def tearDown(self):
+        """
+        Remove the temporary directory
+
+        :return:
+        """
+
+        self.directory.cleanup()
+
+    def test_shared_entries(self):
+        """
+        Test entries written by one worker are read and deleted by another
+
+        :return:
+        """
+
+        writer, reader = SQLiteBackend(self.path, 100), SQLiteBackend(self.path, 100)
+
+        writer.set("a", b"1", 60)
+        self.assertEqual(b"1", reader.get("a"))
+
+        reader.delete("a")
+        self.assertIsNone(writer.get("a"))
+
+        writer.set("b", b"1", 60)
+        reader.clear()
+        self.assertEqual((0, 0), writer.usage())
+
+    def test_condition(self):
+        """
+        Test an entry is only replaced when the condition accepts the stored value
+
+        :return:
+        """
+
+        backend = SQLiteBackend(self.path, 100)
+
+        backend.set("a", b"2", 60)
+        backend.set("a", b"1", 60, lambda stored: stored < b"1")
+        self.assertEqual(b"2", backend.get("a"))
+
+        backend.set("a", b"3", 60, lambda stored: stored < b"3")
+        self.assertEqual(b"3", backend.get("a"))
+
+        # no stored value to check
+        backend.set("b", b"1", 60, lambda stored: False)
+        self.assertEqual(b"1", backend.get("b"))
+
+    def test_memory_budget(self):
+        """
+        Test the least recently used entries are evicted past the memory budget
+
+        :return:
+        """
+
+        backend = SQLiteBackend(self.path, 25)
+
+        with mock.patch("api.src.main.db.cache.time.time", return_value=100):
+            backend.set("a", b"0123456789", 60)
+
+        with mock.patch("api.src.main.db.cache.time.time", return_value=101):
+            backend.set("b", b"0123456789", 60)
+
+        # use a, so b is the oldest
+        with mock.patch("api.src.main.db.cache.time.time", return_value=102):
+            backend.get("a")
+
+        with mock.patch("api.src.main.db.cache.time.time", return_value=103):
+            backend.set("c", b"0123456789", 60)
+
+            self.assertEqual(b"0123456789", backend.get("a"))
+            self.assertIsNone(backend.get("b"))
+
+        self.assertEqual((2, 20), backend.usage())
+        self.assertEqual(1, backend.evictions)
+
+        # expired on read
+        with mock.patch("api.src.main.db.cache.time.time", return_value=200):
+            self.assertIsNone(backend.get("a"))
+
+
+class TestResponseCache(TestCase):
+    """
+    Test the response cache
+    """
+
+    def test_get_and_set(self):
+        """
+        Test the version is kept with the body and counted per kind
+
+        :return:
+        """
+
+        cache = ResponseCache(MemoryBackend(1000), {}, 60)
+
+        self.assertIsNone(cache.get("event", "a"))
+        cache.set("event", "a", 3, b'{"name":"a\nb"}')
+        self.assertEqual((3, b'{"name":"a\nb"}'), cache.get("event", "a"))
+
+        # kinds do not share IDs
+        self.assertIsNone(cache.get("run", "a"))
+
+        cache.invalidate("event", "a")
+        self.assertIsNone(cache.get("event", "a"))
+
+        stats = cache.as_dict()
+        self.assertEqual({"event": 1}, stats["hits"])
+        self.assertEqual({"event": 2, "run": 1}, stats["misses"])
+        self.assertAlmostEqual(1 / 4, stats["hit_rate"])
+
+        # the invalidation marker is kept until it expires
+        self.assertEqual(1, stats["entries"])
+
+    def test_ttls(self):
+        """
+        Test a TTL per kind, where 0 disables caching the kind
+
+        :return:
+        """
+
+        cache = ResponseCache(MemoryBackend(1000), {"user": 0, "run": 5}, 60)
+
+        self.assertEqual(60, cache.ttl("event"))
+        self.assertEqual(5, cache.ttl("run"))
+
+        cache.set("user", "a", 1, b"{}")
+        self.assertIsNone(cache.get("user", "a"))
+        self.assertEqual((0, 0), cache.backend.usage())
+
+    def test_stale_set(self):
+        """
+        Test a response loaded before a change is not cached over it
+
+        :return:
+        """
+
+        cache = ResponseCache(MemoryBackend(1000), {}, 60)
+
+        # loaded at version 1, modified to version 2 before the response is cached
+        cache.invalidate("event", "a", 2)
+        cache.set("event", "a", 1, b"old")
+        self.assertIsNone(cache.get("event", "a"))
+
+        cache.set("event", "a", 2, b"new")
+        self.assertEqual((2, b"new"), cache.get("event", "a"))
+
+        # an older response does not replace a newer one, nor an older invalidation a newer response
+        cache.set("event", "a", 1, b"old")
+        cache.invalidate("event", "a", 1)
+        self.assertEqual((2, b"new"), cache.get("event", "a"))
+
+        # nothing is cached over a deleted entity
+        cache.invalidate("event", "a")
+        cache.set("event", "a", 3, b"newer")
+        self.assertIsNone(cache.get("event", "a"))
+
+    def test_incomplete_backend(self):
+        """
+        Test a backend missing part of the storage interface cannot be created
+
+        :return:
+        """
+
+        class GetOnlyBackend(CacheBackend):
+            def get(self, key: str):
+                return None
+
+        with self.assertRaises(TypeError):
+            GetOnlyBackend()
@@ -0,0 +1,201 @@
+"""
+test_etags.py
+By: Zack Bamford
+
+File to test the response ETags
+"""
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+# the token secret is required to import the auth module
+os.environ.setdefault("SECRET_KEY", "test")
+
+from api.src.main.api.auth import create_access_token
+from api.src.main.api.etags import make_etag, etag_matches, etag_response, version_etag, if_match_version
+from api.src.main.api.routers import event_api, run_api, user_api
+from api.src.main.db import generic_db
+from api.src.main.db.event_db import EventCommands
+from api.src.main.db.plan_db import PlanCommands
+from api.src.main.db.run_db import RunCommands
+from api.src.main.db.tracing import assert_query_budget
+from api.src.main.db.user_db import UserCommands
+
+
+class TestETags(TestCase):
+    """
+    Test building and matching ETags
+    """
+
+    @staticmethod
+    def request(if_none_match: str = None, if_match: str = None) -> Request:
+        # minimal request with only the precondition headers
+        headers = [(name, value.encode()) for name, value in ((b"if-none-match", if_none_match),
+                                                              (b"if-match", if_match)) if value is not None]
+        return Request({"type": "http", "headers": headers})
+
+    def test_etag_matches(self):
+        """
+        Test comparing If-None-Match values
+
+        :return:
+        """
+
+        etag = make_etag(b"[]")
+
+        self.assertEqual(etag, make_etag(b"[]"))
+        self.assertNotEqual(etag, make_etag(b"[1]"))
+
+        self.assertTrue(etag_matches(etag, etag))
+        self.assertTrue(etag_matches(f'"other", W/{etag}', etag))
+        self.assertTrue(etag_matches("*", etag))
+        self.assertFalse(etag_matches('"other"', etag))
+        self.assertFalse(etag_matches(None, etag))
+
+    def test_etag_response(self):
+        """
+        Test unchanged content is answered with an empty 304
+
+        :return:
+        """
+
+        response = etag_response(self.request(), [{"ID": "x"}])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'[{"ID":"x"}]', response.body)
+
+        not_modified = etag_response(self.request(response.headers["ETag"]), [{"ID": "x"}])
+        self.assertEqual(304, not_modified.status_code)
+        self.assertEqual(b"", not_modified.body)
+        self.assertEqual(response.headers["ETag"], not_modified.headers["ETag"])
+
+        self.assertEqual(200, etag_response(self.request(response.headers["ETag"]), [{"ID": "y"}]).status_code)
+
+    def test_if_match_version(self):
+        """
+        Test reading the expected version from If-Match
+
+        :return:
+        """
+
+        self.assertEqual('"v3"', version_etag(3))
+        self.assertEqual(3, if_match_version(self.request(if_match=version_etag(3))))
+        self.assertIsNone(if_match_version(self.request()))
+        self.assertIsNone(if_match_version(self.request(if_match="*")))
+
+        # weak and foreign tags cannot match
+        for header in ('W/"v3"', '"abc"'):
+            with self.assertRaises(HTTPException) as context:
+                if_match_version(self.request(if_match=header))
+
+            self.assertEqual(412, context.exception.status_code)
+
+
+class TestETagEndpoints(TestCase):
+    """
+    Test revalidating cached entities and If-Match preconditions on the routes
+    """
+
+    ec: EventCommands = EventCommands(generic_db.db_obj)
+
+    def setUp(self):
+        """
+        Serve the event, run and user routes and create an event, a run and a user with a token
+
+        :return:
+        """
+
+        app = FastAPI()
+        app.include_router(event_api.router)
+        app.include_router(run_api.router)
+        app.include_router(user_api.router)
+        self.client = TestClient(app)
+
+        plan = PlanCommands(generic_db.db_obj).create_plan("x", "x", None, 1, "km")
+        self.event = self.ec.add_event("x", datetime(2026, 11, 1), 1, "km", plan.ID)
+        self.created_run = RunCommands(generic_db.db_obj).create_run(self.event.ID, "user", datetime(2026, 11, 1),
+                                                                     "done")
+        self.user = UserCommands(generic_db.db_obj).create_user("x", f"etag.{plan.ID}@example.com", "x")
+        self.auth = {"Authorization": f"Bearer {create_access_token({'sub': self.user.ID})}"}
+
+    def modify_event(self, name: str, headers: dict = None):
+        return self.client.post("/event/modify", params={"event_id": self.event.ID, "name": name,
+                                                         "date": "2026-11-01T00:00:00", "distance": 1, "unit": "km"},
+                                headers=headers or {})
+
+    def test_revalidate(self):
+        """
+        Test a matching If-None-Match gets a 304 from a cached response, and from the version alone on a miss
+
+        :return:
+        """
+
+        for path, params, headers in (("/event/get", {"event_id": self.event.ID}, {}),
+                                      ("/run/info", {"run_id": self.created_run.ID}, {}),
+                                      ("/user/info", {}, self.auth)):
+            response = self.client.get(path, params=params, headers=headers)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('"v1"', response.headers["ETag"])
+
+            # served from the cache without a statement
+            with assert_query_budget(0):
+                response = self.client.get(path, params=params, headers=dict(headers, **{"If-None-Match": '"v1"'}))
+
+            self.assertEqual(304, response.status_code)
+            self.assertEqual(b"", response.content)
+
+        # after a modify the cache misses, and the revalidation only reads the version
+        self.ec.modify_event(self.event.ID, "y", self.event.date, 1, "km")
+
+        with assert_query_budget(1):
+            response = self.client.get("/event/get", params={"event_id": self.event.ID},
+                                       headers={"If-None-Match": '"v2"'})
+
+        self.assertEqual(304, response.status_code)
+
+        # an old ETag gets the new body
+        response = self.client.get("/event/get", params={"event_id": self.event.ID}, headers={"If-None-Match": '"v1"'})
+        self.assertEqual((200, '"v2"', "y"), (response.status_code, response.headers["ETag"], response.json()["name"]))
+
+        self.assertEqual(404, self.client.get("/event/get", params={"event_id": "missing"},
+                                              headers={"If-None-Match": '"v1"'}).status_code)
+
+    def test_event_if_match(self):
+        """
+        Test /event/modify only applies to the version in If-Match
+
+        :return:
+        """
+
+        self.assertEqual(200, self.modify_event("y").status_code)
+
+        # the event is now at version 2
+        for if_match in ('"v1"', 'W/"v2"', "v2"):
+            self.assertEqual(412, self.modify_event("z", {"If-Match": if_match}).status_code)
+
+        self.assertEqual("y", self.ec.retrieve_event(self.event.ID).name)
+
+        response = self.modify_event("z", {"If-Match": '"v2"'})
+        self.assertEqual((200, '"v3"'), (response.status_code, response.headers["ETag"]))
+
+    def test_user_if_match(self):
+        """
+        Test /user/modify only applies to the version in If-Match
+
+        :return:
+        """
+
+        response = self.client.post("/user/modify", params={"username": "y"}, headers=self.auth)
+        self.assertEqual((200, '"v2"'), (response.status_code, response.headers["ETag"]))
+
+        response = self.client.post("/user/modify", params={"username": "z"}, headers=dict(self.auth, **{
+            "If-Match": '"v1"'}))
+        self.assertEqual(412, response.status_code)
+
+        response = self.client.post("/user/modify", params={"username": "z"}, headers=dict(self.auth, **{
+            "If-Match": '"v2"'}))
+        self.assertEqual((200, "z"), (response.status_code, response.json()["username"]))
+
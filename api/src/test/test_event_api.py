@@ -0,0 +1,182 @@
+"""
+test_event_api.py
+By: Zack Bamford
+
+File to test the event routes
+"""
+import json
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+# the token secret is required to import the auth module
+os.environ.setdefault("SECRET_KEY", "test")
+
+from api.src.main.api.routers import event_api
+from api.src.main.api.schedule import MAX_RECORD_SIZE
+from api.src.main.db import generic_db
+from api.src.main.db.event_db import EventCommands
+from api.src.main.db.plan_db import PlanCommands
+from api.src.main.db.run_db import RunCommands
+
+
+class TestScheduleImport(TestCase):
+    """
+    Test importing schedules over HTTP
+    """
+
+    ec: EventCommands = EventCommands(generic_db.db_obj)
+
+    def setUp(self):
+        """
+        Serve the event routes and create a plan
+
+        :return:
+        """
+
+        app = FastAPI()
+        app.include_router(event_api.router)
+        self.client = TestClient(app)
+
+        self.plan = PlanCommands(generic_db.db_obj).create_plan("x", "x", None, 1, "km")
+
+    def post(self, body: bytes, file_format: str):
+        return self.client.post("/event/import", params={"plan_id": self.plan.ID, "format": file_format},
+                                content=body)
+
+    def test_csv(self):
+        """
+        Test valid rows are created, with date-only dates, and rejected rows are numbered without the header
+
+        :return:
+        """
+
+        body = b"name,date,distance,distance_unit\n" \
+               b"Easy,2026-11-01,5,km\n" \
+               b"short\n" \
+               b"Long,2026-11-08T06:30:00,-1,km\n" \
+               b"Tempo,2026-11-15 07:00,8,km\n"
+
+        response = self.post(body, "csv")
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([2, 3], [error["row"] for error in response.json()["errors"]])
+        self.assertEqual("Expected 4 fields, got 1", response.json()["errors"][0]["error"])
+        self.assertIn("distance", response.json()["errors"][1]["error"])
+
+        # the valid rows are created together
+        created = [self.ec.retrieve_event(event_id) for event_id in response.json()["created"]]
+        self.assertEqual([("Easy", datetime(2026, 11, 1)), ("Tempo", datetime(2026, 11, 15, 7))],
+                         [(event.name, event.date) for event in created])
+        self.assertEqual({self.plan.ID}, {event.plan_id for event in created})
+
+    def test_json(self):
+        """
+        Test values that are not objects are rejected without echoing them as the error
+
+        :return:
+        """
+
+        body = json.dumps([{"name": "a", "date": "2026-11-01", "distance": 1, "distance_unit": "km"},
+                           "secret text"]).encode()
+
+        response = self.post(body, "json")
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, len(response.json()["created"]))
+        self.assertEqual(2, response.json()["errors"][0]["row"])
+        self.assertNotIn("secret text", response.json()["errors"][0]["error"])
+
+    def test_too_large(self):
+        """
+        Test a row past the size limit rejects the whole import
+
+        :return:
+        """
+
+        body = b'{"name": "a", "date": "2026-11-01", "distance": 1, "distance_unit": "km"}\n' \
+               + b'{"name": "' + b"x" * MAX_RECORD_SIZE + b'"}\n'
+
+        response = self.post(body, "ndjson")
+
+        self.assertEqual(413, response.status_code)
+        self.assertEqual([], PlanCommands(generic_db.db_obj).get_plan_tree(self.plan.ID).child_events)
+
+    def test_missing_plan(self):
+        """
+        Test importing into a plan that does not exist
+
+        :return:
+        """
+
+        self.assertEqual(404, self.client.post("/event/import", params={"plan_id": "missing"}, content=b"").status_code)
+
+
+class TestEventRuns(TestCase):
+    """
+    Test paging through the runs of an event over HTTP
+    """
+
+    def setUp(self):
+        """
+        Serve the event routes and create an event with dated and undated runs
+
+        :return:
+        """
+
+        app = FastAPI()
+        app.include_router(event_api.router)
+        self.client = TestClient(app)
+
+        plan = PlanCommands(generic_db.db_obj).create_plan("x", "x", None, 1, "km")
+        self.event = EventCommands(generic_db.db_obj).add_event("x", None, 1, "km", plan.ID)
+
+        rc = RunCommands(generic_db.db_obj)
+        start = datetime(2026, 11, 1)
+
+        # two runs share a date, so the ID breaks the tie
+        dated = [rc.create_run(self.event.ID, "user", start + timedelta(days=i // 2), "done") for i in range(5)]
+        undated = [rc.create_run(self.event.ID, "user", None, "planned") for _ in range(3)]
+        self.expected = [run.ID for run in sorted(dated, key=lambda run: (run.date, run.ID))] + \
+            sorted(run.ID for run in undated)
+
+    def test_pages(self):
+        """
+        Test following X-Next-Cursor returns every run once, in order, ending with the undated runs
+
+        :return:
+        """
+
+        for limit in (1, 2, 3, len(self.expected)):
+            seen = []
+            params = {"event_id": self.event.ID, "limit": limit}
+
+            while True:
+                response = self.client.get("/event/runs", params=params)
+                self.assertEqual(200, response.status_code)
+                self.assertLessEqual(len(response.json()), limit)
+                seen += [run["ID"] for run in response.json()]
+
+                if "X-Next-Cursor" not in response.headers:
+                    break
+
+                params["after"] = response.headers["X-Next-Cursor"]
+
+            self.assertEqual(self.expected, seen)
+
+    def test_invalid_cursor(self):
+        """
+        Test a cursor that was not made by the API, and a missing event
+
+        :return:
+        """
+
+        for cursor in ("not a cursor", "W10=", "WzEsIDJd"):
+            response = self.client.get("/event/runs", params={"event_id": self.event.ID, "after": cursor})
+            self.assertEqual(400, response.status_code)
+
+        self.assertEqual(404, self.client.get("/event/runs", params={"event_id": "missing"}).status_code)
+
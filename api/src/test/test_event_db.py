@@ -4,12 +4,16 @@ By: Zack Bamford
 
 File to test the event commands to the database
 """
-from datetime import datetime
-from unittest import TestCase
+from datetime import datetime, timedelta
+from unittest import TestCase, IsolatedAsyncioTestCase
 
+from api.src.main.api.pagination import encode_cursor, decode_cursor
 from api.src.main.db import generic_db
-from api.src.main.db.event_db import EventCommands
-from api.src.main.db.plan_db import PlanCommands, Event, Plan
+from api.src.main.db.cache import response_cache
+from api.src.main.db.event_db import EventCommands, AsyncEventCommands
+from api.src.main.db.run_db import RunCommands
+from api.src.main.db.plan_db import PlanCommands, Event, Plan, AsyncPlanCommands
+from api.src.main.db.user_db import UserCommands
 
 
 class TestEventCommands(TestCase):
@@ -19,6 +23,7 @@ class TestEventCommands(TestCase):
 
     pc: PlanCommands = PlanCommands(generic_db.db_obj)
     ec: EventCommands = EventCommands(generic_db.db_obj)
+    rc: RunCommands = RunCommands(generic_db.db_obj)
 
     dt = datetime.now()
 
@@ -92,14 +97,23 @@ class TestEventCommands(TestCase):
             created_event = self.ec.add_event(event.name, event.date, event.distance, event.distance_unit,
                                               created_plan.ID)
 
+            response_cache.set("event", created_event.ID, created_event.version, b"{}")
+
             # modify event
             modified_event = self.ec.modify_event(created_event.ID, self.UPDATE_EVENT.name, self.UPDATE_EVENT.date,
                                                   self.UPDATE_EVENT.distance, self.UPDATE_EVENT.distance_unit)
 
+            # the cached response is dropped
+            self.assertIsNone(response_cache.get("event", created_event.ID))
+
             # check db
             retrieved_event = self.ec.retrieve_event(modified_event.ID)
             self.assertTrue(retrieved_event.equals_no_id(modified_event))
 
+        # missing event
+        self.assertIsNone(self.ec.modify_event(self.INVALID_EVENT.ID, self.UPDATE_EVENT.name, self.UPDATE_EVENT.date,
+                                               self.UPDATE_EVENT.distance, self.UPDATE_EVENT.distance_unit))
+
     def test_delete_event(self):
         """
         Test deleting an event
@@ -116,8 +130,164 @@ class TestEventCommands(TestCase):
             created_event = self.ec.add_event(event.name, event.date, event.distance, event.distance_unit,
                                               created_plan.ID)
 
+            created_run = self.rc.create_run(created_event.ID, "user", self.dt, "done")
+
+            response_cache.set("event", created_event.ID, created_event.version, b"{}")
+            response_cache.set("run", created_run.ID, created_run.version, b"{}")
+
             # delete event
             self.ec.delete_event(created_event.ID)
 
             # check db
             self.assertIsNone(self.ec.retrieve_event(created_event.ID))
+
+            # the cached responses of the event and its runs are dropped
+            self.assertIsNone(response_cache.get("event", created_event.ID))
+            self.assertIsNone(response_cache.get("run", created_run.ID))
+
+    def test_add_events(self):
+        """
+        Test adding many events to a plan at once
+
+        :return:
+        """
+
+        created_plan = self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description, self.VALID_PLAN.date,
+                                           self.VALID_PLAN.distance, self.VALID_PLAN.distance_unit)
+
+        event_ids = self.ec.add_events(created_plan.ID, [{"name": event.name, "date": event.date,
+                                                          "distance": event.distance,
+                                                          "distance_unit": event.distance_unit}
+                                                         for event in self.VALID_EVENTS])
+
+        # IDs are returned in order
+        for event_id, event in zip(event_ids, self.VALID_EVENTS):
+            retrieved_event = self.ec.retrieve_event(event_id)
+            self.assertTrue(retrieved_event.equals_no_id(event))
+            self.assertEqual(created_plan.ID, retrieved_event.plan_id)
+
+        self.assertEqual([], self.ec.add_events(created_plan.ID, []))
+
+    def test_get_runs(self):
+        """
+        Test paging through the runs of an event with filters
+
+        :return:
+        """
+
+        created_plan = self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description, self.VALID_PLAN.date,
+                                           self.VALID_PLAN.distance, self.VALID_PLAN.distance_unit)
+        created_event = self.ec.add_event(self.VALID_EVENT.name, self.VALID_EVENT.date, self.VALID_EVENT.distance,
+                                          self.VALID_EVENT.distance_unit, created_plan.ID)
+
+        # two runs share a date, so the ID breaks the tie, and runs without a date come last
+        runs = [self.rc.create_run(created_event.ID, f"user{i % 2}", self.dt + timedelta(days=i // 2),
+                                   "done" if i % 3 else "planned") for i in range(5)]
+        undated = [self.rc.create_run(created_event.ID, "user0", None, "planned") for _ in range(2)]
+        expected = sorted(runs, key=lambda run: (run.date, run.ID)) + sorted(undated, key=lambda run: run.ID)
+
+        # page through two runs at a time
+        pages, after = [], None
+        while True:
+            page = self.ec.get_runs(created_event.ID, 2, after)
+            pages += [row.ID for row in page]
+            if len(page) < 2:
+                break
+            after = decode_cursor(encode_cursor(page[-1].date, page[-1].ID))
+
+        self.assertEqual([run.ID for run in expected], pages)
+
+        # filters
+        self.assertEqual([run.ID for run in expected if run.usr_id == "user1"],
+                         [row.ID for row in self.ec.get_runs(created_event.ID, user_id="user1")])
+        self.assertEqual([run.ID for run in expected if run.status == "planned"],
+                         [row.ID for row in self.ec.get_runs(created_event.ID, status="planned")])
+
+        # missing event
+        self.assertIsNone(self.ec.get_runs(self.INVALID_EVENT.ID))
+
+    def test_get_calendar(self):
+        """
+        Test getting the events of a user's plans within a window
+
+        :return:
+        """
+
+        uc = UserCommands(generic_db.db_obj)
+        user = uc.retrieve_user_by_email("calendar@example.com") or uc.create_user("x", "calendar@example.com", "x")
+
+        plans = [self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description, self.VALID_PLAN.date,
+                                     self.VALID_PLAN.distance, self.VALID_PLAN.distance_unit) for _ in range(3)]
+        self.pc.add_users_to_plan(plans[0].ID, [user.ID])
+        self.pc.add_users_to_plan(plans[1].ID, [user.ID])
+
+        start = datetime(2023, 3, 1)
+        events = [self.ec.add_event(self.VALID_EVENT.name, start + timedelta(days=days), self.VALID_EVENT.distance,
+                                    self.VALID_EVENT.distance_unit, plan.ID)
+                  for plan, days in ((plans[0], 3), (plans[1], 1), (plans[0], 10), (plans[2], 2), (plans[1], -1))]
+
+        # only the member plans, inside the window, in date order
+        calendar = self.ec.get_calendar(user.ID, start, start + timedelta(days=10))
+        self.assertEqual([events[1].ID, events[0].ID], [row.ID for row in calendar])
+        self.assertEqual(plans[1].name, calendar[0].plan_name)
+
+        self.assertEqual([], self.ec.get_calendar(self.INVALID_EVENT.ID, start, start + timedelta(days=10)))
+
+
+class TestAsyncEventCommands(IsolatedAsyncioTestCase):
+    """
+    Test the async event database commands
+    """
+
+    pc: AsyncPlanCommands = AsyncPlanCommands(generic_db.async_db_obj)
+    ec: AsyncEventCommands = AsyncEventCommands(generic_db.async_db_obj)
+
+    dt = datetime.now()
+
+    VALID_PLAN = Plan(ID="x", name="x", date=dt, distance=21, distance_unit="ft")
+    VALID_EVENT = Event(ID="x", name="x", date=dt, distance=21, distance_unit="ft", plan_id="x")
+    UPDATE_EVENT = Event(ID="a", name="b", date=dt, distance=5, distance_unit="km", plan_id="g")
+
+    async def test_event_lifecycle(self):
+        """
+        Test adding, modifying and deleting an event
+
+        :return:
+        """
+
+        created_plan = await self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description,
+                                                 self.VALID_PLAN.date, self.VALID_PLAN.distance,
+                                                 self.VALID_PLAN.distance_unit)
+
+        # add
+        created_event = await self.ec.add_event(self.VALID_EVENT.name, self.VALID_EVENT.date,
+                                                self.VALID_EVENT.distance, self.VALID_EVENT.distance_unit,
+                                                created_plan.ID)
+        self.assertTrue(created_event.equals_no_id(self.VALID_EVENT))
+        self.assertEqual(created_plan.ID, created_event.plan_id)
+        self.assertIsNone(await self.ec.add_event(self.VALID_EVENT.name, self.VALID_EVENT.date,
+                                                  self.VALID_EVENT.distance, self.VALID_EVENT.distance_unit, " "))
+
+        # bulk add
+        event_ids = await self.ec.add_events(created_plan.ID, [{"name": self.VALID_EVENT.name,
+                                                                "date": self.VALID_EVENT.date,
+                                                                "distance": self.VALID_EVENT.distance,
+                                                                "distance_unit": self.VALID_EVENT.distance_unit}])
+        self.assertTrue((await self.ec.retrieve_event(event_ids[0])).equals_no_id(self.VALID_EVENT))
+
+        # calendar, the plan has no members
+        self.assertEqual([], await self.ec.get_calendar(" ", self.dt - timedelta(days=1), self.dt + timedelta(days=1)))
+
+        # runs
+        self.assertEqual([], await self.ec.get_all_run_ids(created_event.ID))
+        self.assertEqual([], await self.ec.get_runs(created_event.ID, 10))
+        self.assertIsNone(await self.ec.get_runs(" ", 10))
+
+        # modify
+        modified_event = await self.ec.modify_event(created_event.ID, self.UPDATE_EVENT.name, self.UPDATE_EVENT.date,
+                                                    self.UPDATE_EVENT.distance, self.UPDATE_EVENT.distance_unit)
+        self.assertTrue((await self.ec.retrieve_event(created_event.ID)).equals_no_id(modified_event))
+
+        # delete
+        self.assertTrue(await self.ec.delete_event(created_event.ID))
+        self.assertIsNone(await self.ec.retrieve_event(created_event.ID))
@@ -0,0 +1,78 @@
+"""
+test_export.py
+By: Zack Bamford
+
+File to test serializing streamed exports
+"""
+import csv
+import gzip
+import io
+import json
+from collections import namedtuple
+from datetime import datetime
+from unittest import IsolatedAsyncioTestCase
+
+from api.src.main.api.export import ndjson_chunks, csv_chunks, gzip_chunks
+
+Row = namedtuple("Row", ["run_id", "date", "distance"])
+
+
+async def batches(*row_batches):
+    # stands in for a streamed query
+    for batch in row_batches:
+        yield batch
+
+
+async def collect(chunks) -> bytes:
+    return b"".join([chunk async for chunk in chunks])
+
+
+class TestExport(IsolatedAsyncioTestCase):
+    """
+    Test the export serializers
+    """
+
+    ROWS = [Row("a", datetime(2023, 1, 1), 5.0), Row("b", None, None), Row("c", datetime(2023, 1, 2, 8), 1.5)]
+
+    async def test_ndjson(self):
+        """
+        Test one JSON object per row
+
+        :return:
+        """
+
+        output = await collect(ndjson_chunks(batches(self.ROWS[:2], self.ROWS[2:])))
+        lines = [json.loads(line) for line in output.decode().splitlines()]
+
+        self.assertEqual(3, len(lines))
+        self.assertEqual({"run_id": "a", "date": "2023-01-01T00:00:00", "distance": 5.0}, lines[0])
+        self.assertIsNone(lines[1]["date"])
+
+    async def test_csv(self):
+        """
+        Test the header and one line per row
+
+        :return:
+        """
+
+        output = await collect(csv_chunks(batches(self.ROWS[:2], self.ROWS[2:]), list(Row._fields)))
+        lines = list(csv.reader(io.StringIO(output.decode())))
+
+        self.assertEqual([list(Row._fields), ["a", "2023-01-01T00:00:00", "5.0"], ["b", "", ""],
+                          ["c", "2023-01-02T08:00:00", "1.5"]], lines)
+
+        # empty export still has a header
+        self.assertEqual("run_id,date,distance", (await collect(csv_chunks(batches(), list(Row._fields)))).decode()
+                         .strip())
+
+    async def test_gzip(self):
+        """
+        Test the gzipped stream decompresses to the plain stream
+
+        :return:
+        """
+
+        plain = await collect(ndjson_chunks(batches(self.ROWS)))
+        compressed = await collect(gzip_chunks(ndjson_chunks(batches(self.ROWS))))
+
+        self.assertEqual(plain, gzip.decompress(compressed))
@@ -0,0 +1,276 @@
+"""
+test_generic_db.py
+By: Zack Bamford
+
+File to test the engine setup in generic_db
+"""
+import contextvars
+import os
+import tempfile
+import uuid
+from unittest import TestCase, mock
+
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from api.src.main.db import generic_db
+from api.src.main.db.plan_db import PlanCommands, Plan
+
+
+class TestGenericDB(TestCase):
+    """
+    Test the engine setup
+    """
+
+    def setUp(self):
+        """
+        Create a temporary directory for file databases
+
+        :return:
+        """
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_url = f"sqlite:///{os.path.join(self.temp_dir.name, 'test.db')}"
+
+    def tearDown(self):
+        """
+        Remove the temporary directory
+
+        :return:
+        """
+
+        self.temp_dir.cleanup()
+
+    def test_engine_options(self):
+        """
+        Test reading the pool settings from env vars
+
+        :return:
+        """
+
+        # defaults
+        with mock.patch.dict(os.environ, {}, clear=True):
+            options = generic_db.engine_options(generic_db.TimedQueuePool)
+
+        self.assertEqual(5, options["pool_size"])
+        self.assertFalse(options["pool_pre_ping"])
+        self.assertFalse(options["echo"])
+
+        # overrides
+        with mock.patch.dict(os.environ, {"DB_POOL_SIZE": "20", "DB_MAX_OVERFLOW": "0", "DB_POOL_TIMEOUT": "2.5",
+                                          "DB_POOL_RECYCLE": "1800", "DB_POOL_PRE_PING": "true"}):
+            options = generic_db.engine_options(generic_db.TimedQueuePool)
+
+        self.assertEqual(20, options["pool_size"])
+        self.assertEqual(0, options["max_overflow"])
+        self.assertEqual(2.5, options["pool_timeout"])
+        self.assertEqual(1800, options["pool_recycle"])
+        self.assertTrue(options["pool_pre_ping"])
+
+    def test_sqlite_pragmas(self):
+        """
+        Test the pragmas are applied to SQLite file databases
+
+        :return:
+        """
+
+        engine = sqlalchemy.create_engine(self.db_url)
+
+        with mock.patch.dict(os.environ, {"DB_SQLITE_CACHE_SIZE": "-2048"}):
+            generic_db.set_sqlite_pragmas(engine)
+
+        with engine.connect() as connection:
+            self.assertEqual("wal", connection.exec_driver_sql("PRAGMA journal_mode").scalar())
+            self.assertEqual(1, connection.exec_driver_sql("PRAGMA synchronous").scalar())
+            self.assertEqual(-2048, connection.exec_driver_sql("PRAGMA cache_size").scalar())
+
+        engine.dispose()
+
+    def test_pool_stats(self):
+        """
+        Test counting checkouts and timeouts
+
+        :return:
+        """
+
+        engine = sqlalchemy.create_engine(self.db_url, poolclass=generic_db.TimedQueuePool, pool_size=1,
+                                          max_overflow=0, pool_timeout=0.01)
+        stats = generic_db.PoolStats()
+        generic_db.track_pool(engine, stats)
+
+        with engine.connect():
+            # the only connection is checked out, so this one times out
+            with self.assertRaises(sqlalchemy.exc.TimeoutError):
+                engine.connect()
+
+            self.assertEqual(1, stats.as_dict(engine.pool)["checked_out"])
+
+        result = stats.as_dict(engine.pool)
+        self.assertEqual(2, result["checkouts"])
+        self.assertEqual(1, result["timeouts"])
+        self.assertGreater(result["max_wait_ms"], 0)
+
+        # stats survive the pool being recreated
+        engine.dispose()
+        engine.connect().close()
+        self.assertEqual(3, stats.as_dict(engine.pool)["checkouts"])
+
+        engine.dispose()
+
+    def test_lazy_engine(self):
+        """
+        Test the engine is only created on first use
+
+        :return:
+        """
+
+        with mock.patch.dict(os.environ, {"DB_URL": self.db_url}):
+            db_obj = generic_db.DBModificationObject()
+            self.assertEqual({"checkouts", "timeouts", "avg_wait_ms", "max_wait_ms"}, set(db_obj.pool_stats()))
+
+            # first use creates the engine once
+            engine = db_obj.engine
+            self.assertIs(engine, db_obj.engine)
+            self.assertEqual(self.db_url, str(engine.url))
+            self.assertIn("size", db_obj.pool_stats())
+
+        engine.dispose()
+
+    def test_read_replicas(self):
+        """
+        Test reads go round-robin to the replicas, skipping one that fails, and a request reads its own writes
+
+        :return:
+        """
+
+        # a separate file stands in for a replica that has not caught up with the primary
+        replica_url = f"sqlite:///{os.path.join(self.temp_dir.name, 'replica.db')}"
+        failing_url = f"sqlite:///{os.path.join(self.temp_dir.name, 'missing', 'replica.db')}"
+
+        with mock.patch.dict(os.environ, {"DB_URL": self.db_url, "DB_READ_URL": f"{replica_url}, {failing_url}"}):
+            db_obj = generic_db.DBModificationObject()
+
+        generic_db.Base.metadata.create_all(db_obj.engine)
+        generic_db.Base.metadata.create_all(db_obj.replicas.engine(0))
+
+        pc = PlanCommands(db_obj)
+        plan = pc.create_plan("x", "x", None, 1, "km")
+
+        # the first replica has no copy yet
+        self.assertIsNone(pc.retrieve_plan(plan.ID))
+
+        # the second replica cannot connect, so it is ejected and the read retried on the primary
+        self.assertEqual(plan.ID, pc.retrieve_plan(plan.ID).ID)
+        self.assertEqual([False, True], [replica["ejected"] for replica in db_obj.replicas.as_dict()["replicas"]])
+
+        # only the healthy replica is left
+        self.assertIsNone(pc.retrieve_plan(plan.ID))
+        self.assertEqual([2, 1], [replica["reads"] for replica in db_obj.replicas.as_dict()["replicas"]])
+
+        # every replica ejected, reads go to the primary
+        with mock.patch.object(db_obj.replicas, "ejected_until", [float("inf")] * 2):
+            self.assertEqual(plan.ID, pc.retrieve_plan(plan.ID).ID)
+            self.assertEqual(1, db_obj.replicas.as_dict()["primary_reads"])
+
+        def request():
+            generic_db.start_request()
+            self.assertIsNone(pc.retrieve_plan(plan.ID))
+
+            # after committing on the primary the request reads from it
+            pc.modify_plan(plan.ID, "y", "y", None, 1, "km")
+            self.assertEqual("y", pc.retrieve_plan(plan.ID).name)
+
+        # run in a copy of the context, as each request runs in its own
+        contextvars.copy_context().run(request)
+        self.assertIsNone(pc.retrieve_plan(plan.ID))
+
+        db_obj.engine.dispose()
+        db_obj.replicas.engine(0).dispose()
+        db_obj.replicas.engine(1).dispose()
+
+    def test_create_id(self):
+        """
+        Test random and time-ordered IDs share the prefix format, and time-ordered IDs sort in creation order
+
+        :return:
+        """
+
+        self.assertRegex(generic_db.create_id("RUN"), r"^RUN_[0-9A-F]{32}$")
+
+        generate = generic_db.UUID7Generator()
+        ids = [generate() for _ in range(10000)]
+
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual({7}, {value.version for value in ids})
+        self.assertEqual({uuid.RFC_4122}, {value.variant for value in ids})
+
+        # a clock going back keeps counting on the last timestamp
+        with mock.patch("api.src.main.db.generic_db.time.time_ns", return_value=0):
+            self.assertLess(ids[-1], generate())
+
+        with mock.patch.dict(os.environ, {"DB_ID_FORMAT": "uuid7"}):
+            self.assertIs(generic_db.ID_FORMATS["uuid7"], generic_db.id_generator())
+
+        with mock.patch.dict(os.environ, {"DB_ID_FORMAT": "sequential"}), self.assertRaises(ValueError):
+            generic_db.id_generator()
+
+    def test_update_returning(self):
+        """
+        Test updating a row in one statement, and the UPDATE then SELECT fallback
+
+        :return:
+        """
+
+        engine = generic_db.db_obj.engine
+        plan = PlanCommands(generic_db.db_obj).create_plan("x", "x", None, 1, "km")
+
+        statements = []
+
+        def record(connection, cursor, statement, *args):
+            statements.append(statement)
+
+        sqlalchemy.event.listen(engine, "before_cursor_execute", record)
+
+        try:
+            for returning in (True, False):
+                statements.clear()
+
+                with mock.patch.object(engine.dialect, "update_returning", returning), \
+                        Session(engine, expire_on_commit=False) as session:
+                    updated = generic_db.update_returning(session, Plan, plan.ID, {"name": f"{returning}"})
+                    missing = generic_db.update_returning(session, Plan, " ", {"name": f"{returning}"})
+                    session.commit()
+
+                self.assertEqual(f"{returning}", updated.name)
+                self.assertEqual("km", updated.distance_unit)
+                self.assertIsNone(missing)
+
+                # one statement per update, plus the SELECT of the updated row without RETURNING
+                self.assertEqual(2 if returning else 3, len(statements))
+        finally:
+            sqlalchemy.event.remove(engine, "before_cursor_execute", record)
+
+    def test_update_returning_version(self):
+        """
+        Test every update bumps the version and an expected version guards the update
+
+        :return:
+        """
+
+        plan = PlanCommands(generic_db.db_obj).create_plan("x", "x", None, 1, "km")
+        self.assertEqual(1, plan.version)
+
+        with Session(generic_db.db_obj.engine, expire_on_commit=False) as session:
+            self.assertEqual(2, generic_db.update_returning(session, Plan, plan.ID, {"name": "y"}, 1).version)
+
+            # the row moved on
+            with self.assertRaises(generic_db.StaleVersionError):
+                generic_db.update_returning(session, Plan, plan.ID, {"name": "z"}, 1)
+
+            # a missing row is not stale
+            self.assertIsNone(generic_db.update_returning(session, Plan, " ", {"name": "z"}, 1))
+            session.commit()
+
+        self.assertEqual(2, PlanCommands(generic_db.db_obj).get_version(Plan, plan.ID))
+        self.assertIsNone(PlanCommands(generic_db.db_obj).get_version(Plan, " "))
@@ -0,0 +1,166 @@
+"""
+test_metrics.py
+By: Zack Bamford
+
+File to test the request metrics
+"""
+from unittest import TestCase, IsolatedAsyncioTestCase, mock
+
+import sqlalchemy
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from api.src.main.api.metrics import Counter, Histogram, MetricsMiddleware, RequestMetrics
+from api.src.main.api.routers import ops_api
+from api.src.main.db import generic_db
+
+
+class TestMetrics(TestCase):
+    """
+    Test rendering metrics in the Prometheus text format
+    """
+
+    def test_counter(self):
+        """
+        Test counting per label set, escaping label values
+
+        :return:
+        """
+
+        counter = Counter("requests_total", "Requests", ("route",))
+        counter.inc("/a")
+        counter.inc("/a")
+        counter.inc('/"b"')
+
+        self.assertEqual('# HELP requests_total Requests\n'
+                         '# TYPE requests_total counter\n'
+                         'requests_total{route="/a"} 2\n'
+                         'requests_total{route="/\\"b\\""} 1', counter.render())
+
+    def test_histogram(self):
+        """
+        Test buckets are cumulative and include their upper bound
+
+        :return:
+        """
+
+        histogram = Histogram("latency_seconds", "Latency", ("route",), (0.1, 1.0))
+
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, "/a")
+
+        self.assertEqual(['latency_seconds_bucket{route="/a",le="0.1"} 2',
+                          'latency_seconds_bucket{route="/a",le="1.0"} 3',
+                          'latency_seconds_bucket{route="/a",le="+Inf"} 4',
+                          'latency_seconds_sum{route="/a"} 2.65',
+                          'latency_seconds_count{route="/a"} 4'], histogram.samples())
+
+
+class TestMetricsMiddleware(IsolatedAsyncioTestCase):
+    """
+    Test recording the metrics of requests
+    """
+
+    def setUp(self):
+        """
+        Wrap a small app with routes that query the database and fail
+
+        :return:
+        """
+
+        app = FastAPI()
+
+        @app.get("/query")
+        async def query():
+            async with generic_db.async_db_obj.engine.connect() as connection:
+                await connection.execute(sqlalchemy.text("SELECT 1"))
+                await connection.execute(sqlalchemy.text("SELECT 2"))
+
+            return {}
+
+        @app.get("/missing")
+        async def missing():
+            raise HTTPException(status_code=404)
+
+        self.metrics = RequestMetrics()
+        self.app = MetricsMiddleware(app, self.metrics)
+
+    async def get(self, path: str):
+        # minimal HTTP request straight through the ASGI interface
+        scope = {"type": "http", "method": "GET", "path": path, "raw_path": path.encode(), "query_string": b"",
+                 "headers": [], "root_path": "", "scheme": "http", "server": ("test", 80), "http_version": "1.1"}
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            pass
+
+        await self.app(scope, receive, send)
+
+    async def test_request_metrics(self):
+        """
+        Test status codes per route template, and the statements of each request
+
+        :return:
+        """
+
+        await self.get("/query")
+        await self.get("/query")
+        await self.get("/missing")
+        await self.get("/nowhere")
+
+        self.assertEqual({("GET", "/query", 200): 2, ("GET", "/missing", 404): 1, ("GET", "unmatched", 404): 1},
+                         self.metrics.requests.values)
+        self.assertEqual(2, self.metrics.latency.values[("GET", "/query")][-1])
+        self.assertEqual(0, self.metrics.in_flight.values[()])
+
+        # two statements per request to /query
+        self.assertEqual(4, self.metrics.queries.values[("GET", "/query")][-2])
+        self.assertEqual(0, self.metrics.queries.values[("GET", "/missing")][-2])
+        self.assertGreater(self.metrics.query_time.values[("GET", "/query")][-2], 0)
+
+        self.assertIn('http_requests_total{method="GET",route="/query",status="200"} 2', self.metrics.render())
+
+
+class TestOpsRoutes(TestCase):
+    """
+    Test the metrics and statistics routes are only served with the ops token
+    """
+
+    ROUTES = ["/metrics", "/db/pool", "/auth/hashing", "/auth/cache", "/cache/responses"]
+
+    def setUp(self):
+        """
+        Serve the ops routes
+
+        :return:
+        """
+
+        app = FastAPI()
+        app.include_router(ops_api.router)
+        self.client = TestClient(app)
+
+    def test_token(self):
+        """
+        Test requests without the token are rejected
+
+        :return:
+        """
+
+        with mock.patch.object(ops_api, "OPS_TOKEN", "secret"):
+            for route in self.ROUTES:
+                self.assertEqual(401, self.client.get(route).status_code)
+                self.assertEqual(401, self.client.get(route, headers={"Authorization": "Bearer wrong"}).status_code)
+                self.assertEqual(200, self.client.get(route, headers={"Authorization": "Bearer secret"}).status_code)
+
+    def test_disabled(self):
+        """
+        Test the routes are hidden when no token is set
+
+        :return:
+        """
+
+        with mock.patch.object(ops_api, "OPS_TOKEN", ""):
+            for route in self.ROUTES:
+                self.assertEqual(404, self.client.get(route, headers={"Authorization": "Bearer "}).status_code)
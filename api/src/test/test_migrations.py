@@ -0,0 +1,138 @@
+"""
+test_migrations.py
+By: Zack Bamford
+
+File to test the database migrations
+"""
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from api.src.main.db import generic_db, migrations
+from api.src.main.db.event_db import EventCommands
+from api.src.main.db.plan_db import PlanCommands, Plan, PlanLeaderboard
+from api.src.main.db.run_db import RunCommands
+from api.src.main.db.user_db import UserCommands
+
+
+class TestMigrations(TestCase):
+    """
+    Test the database migrations
+    """
+
+    pc: PlanCommands = PlanCommands(generic_db.db_obj)
+    uc: UserCommands = UserCommands(generic_db.db_obj)
+
+    dt = datetime.now()
+
+    def test_migrate_plan_users(self):
+        """
+        Test moving legacy plan user strings into the membership table, skipping users that no longer exist
+
+        :return:
+        """
+
+        user_ids = [self.uc.create_user(name, f"{name}.legacy@example.com", "x").ID for name in ("a", "b", "c")]
+
+        # insert a plan in the legacy format, naming a deleted user
+        with Session(generic_db.db_obj.engine) as session:
+            session.add(Plan(ID="PLAN_LEGACY", name="x", description="x", date=self.dt, distance=21,
+                             distance_unit="ft", users="#".join(user_ids + [user_ids[0], "GHOST"])))
+            session.commit()
+
+        migrations.run_migrations(generic_db.db_obj.engine)
+
+        # check memberships and cleared string
+        self.assertEqual(sorted(user_ids), sorted(self.pc.get_user_ids_in_plan("PLAN_LEGACY")))
+        self.assertEqual("", self.pc.retrieve_plan("PLAN_LEGACY").users)
+
+        # running again does nothing
+        self.assertEqual(0, migrations.migrate_plan_users(generic_db.db_obj.engine))
+        self.assertEqual(sorted(user_ids), sorted(self.pc.get_user_ids_in_plan("PLAN_LEGACY")))
+
+    def test_create_indexes(self):
+        """
+        Test recreating a missing index on an existing table
+
+        :return:
+        """
+
+        engine = generic_db.db_obj.engine
+
+        with engine.begin() as connection:
+            connection.execute(sqlalchemy.text("DROP INDEX IF EXISTS ix_runs_usr_id"))
+
+        migrations.create_indexes(engine)
+
+        # running twice is safe
+        migrations.create_indexes(engine)
+
+        index_names = [index["name"] for index in sqlalchemy.inspect(engine).get_indexes("runs")]
+        self.assertIn("ix_runs_usr_id", index_names)
+
+    def test_rebuild_leaderboard(self):
+        """
+        Test repairing a leaderboard that drifted from the runs
+
+        :return:
+        """
+
+        engine = generic_db.db_obj.engine
+        ec = EventCommands(generic_db.db_obj)
+        rc = RunCommands(generic_db.db_obj)
+
+        created_plan = self.pc.create_plan("x", "x", self.dt, 21, "ft")
+        user_ids = [self.uc.create_user(name, f"{name}.{created_plan.ID}@example.com", "x").ID for name in ("a", "b")]
+        created_event = ec.add_event("x", self.dt, 2, "km", created_plan.ID)
+        rc.create_run(created_event.ID, user_ids[0], self.dt, "done")
+
+        # a run left behind by a deleted user
+        rc.create_run(created_event.ID, "GHOST", self.dt, "done")
+
+        # corrupt one entry and add one without runs
+        with Session(engine) as session:
+            session.execute(sqlalchemy.update(PlanLeaderboard).where(PlanLeaderboard.plan_id == created_plan.ID,
+                                                                     PlanLeaderboard.user_id == user_ids[0])
+                            .values(completed_meters=1))
+            session.add(PlanLeaderboard(plan_id=created_plan.ID, user_id=user_ids[1], completed_events=1,
+                                        completed_meters=1))
+            session.commit()
+
+        self.assertEqual(3, migrations.rebuild_leaderboard(engine, created_plan.ID))
+        self.assertEqual(0, migrations.rebuild_leaderboard(engine, created_plan.ID))
+
+        # only existing users are left
+        with Session(engine) as session:
+            rows = session.execute(sqlalchemy.select(PlanLeaderboard.user_id, PlanLeaderboard.completed_events,
+                                                     PlanLeaderboard.completed_meters)
+                                   .where(PlanLeaderboard.plan_id == created_plan.ID)).all()
+
+        self.assertEqual([(user_ids[0], 1, 2000)], [tuple(row) for row in rows])
+
+    def test_add_version_columns(self):
+        """
+        Test adding the version column to tables made before it existed
+
+        :return:
+        """
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(temp_dir, 'old.db')}")
+            generic_db.Base.metadata.create_all(engine)
+
+            # an old events table with a row
+            with engine.begin() as connection:
+                connection.execute(sqlalchemy.text("ALTER TABLE events DROP COLUMN version"))
+                connection.execute(sqlalchemy.text("INSERT INTO events (\"ID\", name) VALUES ('a', 'a')"))
+
+            self.assertEqual(["events"], migrations.add_version_columns(engine))
+            self.assertEqual([], migrations.add_version_columns(engine))
+
+            with engine.connect() as connection:
+                self.assertEqual(1, connection.scalar(sqlalchemy.text("SELECT version FROM events")))
+
+            engine.dispose()
@@ -0,0 +1,117 @@
+"""
+test_passwords.py
+By: Zack Bamford
+
+File to test the password hashing pool
+"""
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from api.src.main.api.passwords import PasswordHasher, HasherBusyError, hash_rounds
+
+
+class TestPasswordHasher(IsolatedAsyncioTestCase):
+    """
+    Test hashing and verifying passwords
+    """
+
+    def setUp(self):
+        """
+        Create a small hasher with a low cost to keep the tests fast
+
+        :return:
+        """
+
+        self.hasher = PasswordHasher(rounds=4, workers=1, max_queue=2)
+
+    def tearDown(self):
+        """
+        Stop the worker processes
+
+        :return:
+        """
+
+        self.hasher.shutdown()
+
+    async def test_hash_and_verify(self):
+        """
+        Test a hash verifies against its own password only
+
+        :return:
+        """
+
+        hashed = await self.hasher.hash("correct horse battery")
+
+        self.assertEqual(4, hash_rounds(hashed))
+        self.assertTrue(await self.hasher.verify("correct horse battery", hashed))
+        self.assertFalse(await self.hasher.verify("wrong password", hashed))
+
+        stats = self.hasher.stats.as_dict()
+        self.assertEqual(1, stats["hash"]["count"])
+        self.assertEqual(2, stats["verify"]["count"])
+        self.assertEqual(0, stats["queued"])
+
+    async def test_needs_rehash(self):
+        """
+        Test detecting hashes made with a lower cost, keeping stronger ones
+
+        :return:
+        """
+
+        hashed = await self.hasher.hash("correct horse battery")
+        self.assertFalse(self.hasher.needs_rehash(hashed))
+
+        self.hasher.rounds = 5
+        self.assertTrue(self.hasher.needs_rehash(hashed))
+
+        self.hasher.rounds = 3
+        self.assertFalse(self.hasher.needs_rehash(hashed))
+
+    async def test_malformed_hash(self):
+        """
+        Test a stored hash that is not bcrypt fails the check instead of raising
+
+        :return:
+        """
+
+        for hashed in ("plain text", "$2b$xx$abc", ""):
+            self.assertIsNone(hash_rounds(hashed))
+            self.assertFalse(self.hasher.needs_rehash(hashed))
+            self.assertFalse(await self.hasher.verify("correct horse battery", hashed))
+
+    async def test_queue_limit(self):
+        """
+        Test work past the queue limit is rejected
+
+        :return:
+        """
+
+        results = await asyncio.gather(*[self.hasher.hash("correct horse battery") for _ in range(3)],
+                                       return_exceptions=True)
+
+        rejected = [result for result in results if isinstance(result, HasherBusyError)]
+        self.assertEqual(1, len(rejected))
+
+        stats = self.hasher.stats.as_dict()
+        self.assertEqual(1, stats["rejected"])
+        self.assertEqual(2, stats["max_queued"])
+
+    async def test_verify_dummy(self):
+        """
+        Test the dummy check spends a verification and never matches
+
+        :return:
+        """
+
+        with self.assertRaises(RuntimeError):
+            await self.hasher.verify_dummy("correct horse battery")
+
+        await self.hasher.start()
+
+        self.assertFalse(await self.hasher.verify_dummy("correct horse battery"))
+        self.assertFalse(await self.hasher.verify_dummy("correct horse battery"))
+
+        # the dummy hash is made once at start and checked on every call
+        stats = self.hasher.stats.as_dict()
+        self.assertEqual(1, stats["hash"]["count"])
+        self.assertEqual(2, stats["verify"]["count"])
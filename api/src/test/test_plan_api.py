@@ -0,0 +1,97 @@
+"""
+test_plan_api.py
+By: Zack Bamford
+
+File to test the plan routes
+"""
+import csv
+import gzip
+import io
+import json
+from datetime import datetime
+from unittest import TestCase
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.src.main.api.routers import plan_api
+from api.src.main.db import generic_db
+from api.src.main.db.event_db import EventCommands
+from api.src.main.db.plan_db import PlanCommands
+from api.src.main.db.run_db import RunCommands
+
+
+class TestPlanExport(TestCase):
+    """
+    Test streaming a plan export over HTTP
+    """
+
+    HEADER = ["event_id", "event_name", "event_date", "distance", "distance_unit", "run_id", "user_id", "run_date",
+              "status"]
+
+    def setUp(self):
+        """
+        Serve the plan routes and create a plan with an event with two runs and an event without runs
+
+        :return:
+        """
+
+        app = FastAPI()
+        app.include_router(plan_api.router)
+        self.client = TestClient(app)
+
+        ec = EventCommands(generic_db.db_obj)
+        rc = RunCommands(generic_db.db_obj)
+
+        self.plan = PlanCommands(generic_db.db_obj).create_plan("x", "x", None, 1, "km")
+        self.event = ec.add_event("a", datetime(2026, 11, 1), 5, "km", self.plan.ID)
+        self.empty_event = ec.add_event("b", datetime(2026, 11, 2), 3, "mi", self.plan.ID)
+        self.runs = sorted([rc.create_run(self.event.ID, "user", datetime(2026, 11, 1, hour), "done")
+                            for hour in (6, 7)], key=lambda run: run.date)
+
+    def export(self, **params) -> tuple[dict, bytes]:
+        # read the raw stream, so a compressed body is not decoded by the client
+        with self.client.stream("GET", "/plan/export", params=dict(params, plan_id=self.plan.ID)) as response:
+            self.assertEqual(200, response.status_code)
+            return dict(response.headers), b"".join(response.iter_raw())
+
+    def test_ndjson(self):
+        """
+        Test one JSON object per line, with a line for the event without runs
+
+        :return:
+        """
+
+        headers, body = self.export()
+        lines = [json.loads(line) for line in body.decode().splitlines()]
+
+        self.assertEqual("application/x-ndjson", headers["content-type"])
+        self.assertEqual(f'attachment; filename="{self.plan.ID}.ndjson"', headers["content-disposition"])
+        self.assertEqual([run.ID for run in self.runs] + [None], [line["run_id"] for line in lines])
+        self.assertEqual(self.HEADER, list(lines[0]))
+        self.assertEqual("2026-11-01T06:00:00", lines[0]["run_date"])
+
+    def test_csv_gzip(self):
+        """
+        Test a compressed CSV with a header line
+
+        :return:
+        """
+
+        headers, body = self.export(format="csv", gzip=True)
+        rows = list(csv.reader(io.StringIO(gzip.decompress(body).decode())))
+
+        self.assertEqual("gzip", headers["content-encoding"])
+        self.assertTrue(headers["content-type"].startswith("text/csv"))
+        self.assertEqual(self.HEADER, rows[0])
+        self.assertEqual([run.ID for run in self.runs] + [""], [row[5] for row in rows[1:]])
+        self.assertEqual([self.event.ID, self.event.ID, self.empty_event.ID], [row[0] for row in rows[1:]])
+
+    def test_missing_plan(self):
+        """
+        Test exporting a plan that does not exist
+
+        :return:
+        """
+
+        self.assertEqual(404, self.client.get("/plan/export", params={"plan_id": "missing"}).status_code)
@@ -5,14 +5,45 @@ By: Zack Bamford
 File to test the plan commands to the database
 """
 
-from datetime import datetime
-from unittest import TestCase
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Iterator
+from unittest import TestCase, IsolatedAsyncioTestCase
+
+import sqlalchemy
+from sqlalchemy.orm import Session
 
 import api.src.main.db.generic_db as generic_db
-from api.src.main.db.plan_db import PlanCommands, Plan
+from api.src.main.db import migrations
+from api.src.main.db.cache import response_cache
+from api.src.main.db.event_db import EventCommands
+from api.src.main.db.plan_db import PlanCommands, Plan, AsyncPlanCommands
+from api.src.main.db.run_db import RunCommands
 from api.src.main.db.user_db import User, UserCommands
 
 
+@contextmanager
+def count_statements(engine: sqlalchemy.Engine) -> Iterator[list[str]]:
+    """
+    Record the SQL statements sent to the database
+
+    :param engine: Engine to watch
+    :return: List filled with each statement as it runs
+    """
+
+    statements = []
+
+    def record(connection, cursor, statement, *args):
+        statements.append(statement)
+
+    sqlalchemy.event.listen(engine, "before_cursor_execute", record)
+
+    try:
+        yield statements
+    finally:
+        sqlalchemy.event.remove(engine, "before_cursor_execute", record)
+
+
 class TestPlanCommands(TestCase):
     """
     Test the plan database commands
@@ -44,6 +75,17 @@ class TestPlanCommands(TestCase):
     USERS_TO_REMOVE = ["a", "b"]
     USERS_TO_ADD = ["d", "e"]
 
+    def setUp(self):
+        """
+        Emails are unique, so start every test without users
+
+        :return:
+        """
+
+        with Session(generic_db.db_obj.engine) as session:
+            session.execute(sqlalchemy.delete(User))
+            session.commit()
+
     def test_create_plan(self):
         """
         Test creating a plan
@@ -116,6 +158,308 @@ class TestPlanCommands(TestCase):
                     self.assertTrue(True)
                     break
 
+    def test_is_user_in_plan(self):
+        """
+        Test checking plan membership
+
+        :return:
+        """
+
+        user_id = self.uc.create_user(self.VALID_USER.username, self.VALID_USER.email, self.VALID_USER.password).ID
+        created_plan = self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description, self.VALID_PLAN.date,
+                                           self.VALID_PLAN.distance, self.VALID_PLAN.distance_unit)
+
+        self.assertFalse(self.pc.is_user_in_plan(created_plan.ID, user_id))
+
+        # add and check
+        self.pc.add_users_to_plan(created_plan.ID, [user_id])
+        self.assertTrue(self.pc.is_user_in_plan(created_plan.ID, user_id))
+
+        # remove and check
+        self.pc.remove_users_from_plan(created_plan.ID, [user_id])
+        self.assertFalse(self.pc.is_user_in_plan(created_plan.ID, user_id))
+
+    def test_get_user_ids_in_plan_paginated(self):
+        """
+        Test paging through the user IDs in a plan
+
+        :return:
+        """
+
+        created_plan = self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description, self.VALID_PLAN.date,
+                                           self.VALID_PLAN.distance, self.VALID_PLAN.distance_unit)
+
+        # add duplicates to make sure they are only stored once
+        ids = [f"USER_{i}" for i in range(5)]
+        self.pc.add_users_to_plan(created_plan.ID, ids + ids[:2])
+
+        # walk the pages
+        collected_ids = []
+        page = self.pc.get_user_ids_in_plan(created_plan.ID, limit=2)
+        while page:
+            self.assertLessEqual(len(page), 2)
+            collected_ids += page
+            page = self.pc.get_user_ids_in_plan(created_plan.ID, limit=2, after=page[-1])
+
+        self.assertEqual(sorted(ids), collected_ids)
+
+        # invalid plan
+        self.assertIsNone(self.pc.get_user_ids_in_plan(self.INVALID_PLAN.ID))
+
+    def test_get_plan_members(self):
+        """
+        Test paging through the public columns of the users in a plan
+
+        :return:
+        """
+
+        ids = [self.uc.create_user(user.username, user.email, user.password).ID for user in self.VALID_USERS]
+        created_plan = self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description, self.VALID_PLAN.date,
+                                           self.VALID_PLAN.distance, self.VALID_PLAN.distance_unit)
+        self.pc.add_users_to_plan(created_plan.ID, ids)
+
+        # first page
+        first_page = self.pc.get_plan_members(created_plan.ID, limit=1)
+        self.assertEqual([min(ids)], [row.ID for row in first_page])
+        self.assertEqual({"ID", "username", "email"}, set(first_page[0]._mapping.keys()))
+
+        # second page
+        second_page = self.pc.get_plan_members(created_plan.ID, limit=1, after=first_page[0].ID)
+        self.assertEqual([max(ids)], [row.ID for row in second_page])
+
+        # full objects
+        self.assertEqual(sorted(ids), [user.ID for user in self.pc.get_user_objects_in_plan(created_plan.ID)])
+
+        # invalid plan
+        self.assertIsNone(self.pc.get_plan_members(self.INVALID_PLAN.ID))
+
+    def test_get_plans_for_user(self):
+        """
+        Test retrieving the plans a user is a member of
+
+        :return:
+        """
+
+        user_id = self.uc.create_user(self.VALID_USER.username, self.VALID_USER.email, self.VALID_USER.password).ID
+
+        plan_ids = []
+        for plan in self.VALID_PLANS:
+            created_plan = self.pc.create_plan(plan.name, plan.description, plan.date, plan.distance,
+                                               plan.distance_unit)
+            self.pc.add_users_to_plan(created_plan.ID, [user_id])
+            plan_ids.append(created_plan.ID)
+
+        # check all plans are returned in order
+        plans = self.pc.get_plans_for_user(user_id)
+        self.assertEqual(sorted(plan_ids), [plan.ID for plan in plans])
+
+        # check paging
+        self.assertEqual([plans[1].ID], [plan.ID for plan in self.pc.get_plans_for_user(user_id, after=plans[0].ID)])
+
+        # deleting a plan removes the membership
+        self.pc.delete_plan(plan_ids[0])
+        self.assertEqual([plan_ids[1]], [plan.ID for plan in self.pc.get_plans_for_user(user_id)])
+
+    def test_get_plan_progress(self):
+        """
+        Test the per member progress with mixed units
+
+        :return:
+        """
+
+        ec = EventCommands(generic_db.db_obj)
+        rc = RunCommands(generic_db.db_obj)
+
+        ids = [self.uc.create_user(user.username, user.email, user.password).ID for user in self.VALID_USERS]
+        created_plan = self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description, self.VALID_PLAN.date,
+                                           10, "mi")
+        self.pc.add_users_to_plan(created_plan.ID, ids)
+
+        events = [ec.add_event("x", self.VALID_PLAN.date, distance, unit, created_plan.ID)
+                  for distance, unit in ((5, "km"), (2, "MI"), (1000, "ft"))]
+
+        # repeated and incomplete runs do not count twice
+        rc.create_run(events[0].ID, ids[0], self.VALID_PLAN.date, "done")
+        rc.create_run(events[0].ID, ids[0], self.VALID_PLAN.date, "Done")
+        rc.create_run(events[1].ID, ids[0], self.VALID_PLAN.date, "completed")
+        rc.create_run(events[2].ID, ids[0], self.VALID_PLAN.date, "skipped")
+
+        progress = self.pc.get_plan_progress(created_plan.ID, "m")
+
+        # furthest first, members without runs are included
+        self.assertEqual(ids, [row.user_id for row in progress])
+        self.assertEqual([2, 0], [row.completed_events for row in progress])
+        self.assertEqual([3, 3], [row.total_events for row in progress])
+        self.assertAlmostEqual(5000 + 2 * 1609.344, progress[0].completed_distance)
+        self.assertAlmostEqual(16093.44, progress[0].plan_distance)
+        self.assertAlmostEqual((5000 + 2 * 1609.344) / 16093.44 * 100, progress[0].percent_complete)
+        self.assertEqual(0, progress[1].completed_distance)
+
+        # other units
+        self.assertAlmostEqual(10, self.pc.get_plan_progress(created_plan.ID, "mi")[0].plan_distance)
+
+        # invalid plan
+        self.assertIsNone(self.pc.get_plan_progress(self.INVALID_PLAN.ID))
+
+    def test_stream_plan_activity(self):
+        """
+        Test streaming the events and runs of a plan in batches
+
+        :return:
+        """
+
+        ec = EventCommands(generic_db.db_obj)
+        rc = RunCommands(generic_db.db_obj)
+
+        created_plan = self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description, self.VALID_PLAN.date,
+                                           self.VALID_PLAN.distance, self.VALID_PLAN.distance_unit)
+        events = [ec.add_event("x", datetime(2023, 1, day), 5, "km", created_plan.ID) for day in (2, 1)]
+        runs = [rc.create_run(events[0].ID, "x", datetime(2023, 1, 2), "done") for _ in range(3)]
+
+        batches = list(self.pc.stream_plan_activity(created_plan.ID, batch_size=2))
+
+        # the event without runs comes first by date, then one row per run
+        self.assertEqual([2, 2], [len(batch) for batch in batches])
+        rows = [row for batch in batches for row in batch]
+        self.assertEqual((events[1].ID, None), (rows[0].event_id, rows[0].run_id))
+        self.assertEqual(sorted(run.ID for run in runs), [row.run_id for row in rows[1:]])
+
+        # invalid plan
+        self.assertEqual([], list(self.pc.stream_plan_activity(self.INVALID_PLAN.ID)))
+
+    def test_get_dashboard_plans(self):
+        """
+        Test the dashboard loads plans, upcoming events and the user's runs in a fixed amount of statements
+
+        :return:
+        """
+
+        ec = EventCommands(generic_db.db_obj)
+        rc = RunCommands(generic_db.db_obj)
+
+        user_id = self.uc.create_user(self.VALID_USER.username, self.VALID_USER.email, self.VALID_USER.password).ID
+        start = datetime(2023, 5, 1)
+        end = start + timedelta(days=30)
+
+        for plan_count in (1, 4):
+            for _ in range(plan_count):
+                plan = self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description, start,
+                                           self.VALID_PLAN.distance, self.VALID_PLAN.distance_unit)
+                self.pc.add_users_to_plan(plan.ID, [user_id])
+
+                for days in (10, 2, 45):
+                    event = ec.add_event("x", start + timedelta(days=days), 5, "km", plan.ID)
+                    rc.create_run(event.ID, user_id, event.date, "done")
+                    rc.create_run(event.ID, "other", event.date, "done")
+
+            with count_statements(generic_db.db_obj.engine) as statements:
+                plans = self.pc.get_dashboard_plans(user_id, start, end)
+
+            # plans, events and runs, however many plans there are
+            self.assertEqual(3, len(statements))
+
+        self.assertEqual(5, len(plans))
+        for plan in plans:
+            self.assertEqual([start + timedelta(days=2), start + timedelta(days=10)],
+                             [event.date for event in plan.child_events])
+            self.assertEqual([[user_id], [user_id]], [[run.usr_id for run in event.run]
+                                                      for event in plan.child_events])
+
+        self.assertEqual([], self.pc.get_dashboard_plans(self.INVALID_PLAN.ID, start, end))
+
+    def test_get_plan_tree(self):
+        """
+        Test loading a plan with its events and runs in one statement per level
+
+        :return:
+        """
+
+        ec = EventCommands(generic_db.db_obj)
+        rc = RunCommands(generic_db.db_obj)
+
+        created_plan = self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description, self.VALID_PLAN.date,
+                                           self.VALID_PLAN.distance, self.VALID_PLAN.distance_unit)
+        events = [ec.add_event("x", datetime(2023, 1, day), 5, "km", created_plan.ID) for day in (3, 1, 2)]
+        runs = {event.ID: sorted(rc.create_run(event.ID, "x", datetime(2023, 1, 1), "done").ID for _ in range(3))
+                for event in events}
+
+        for depth in (0, 1, 2):
+            with count_statements(generic_db.db_obj.engine) as statements:
+                plan = self.pc.get_plan_tree(created_plan.ID, depth)
+
+                # every loaded level is usable after the session closed, without more statements
+                loaded_events = plan.child_events
+                loaded_runs = {event.ID: [run.ID for run in event.run] for event in loaded_events}
+
+            self.assertEqual(depth + 1, len(statements))
+
+            if depth == 0:
+                self.assertEqual([], loaded_events)
+            else:
+                self.assertEqual([events[1].ID, events[2].ID, events[0].ID], [event.ID for event in loaded_events])
+                self.assertEqual(runs if depth == 2 else {event_id: [] for event_id in runs}, loaded_runs)
+
+        # invalid plan
+        self.assertIsNone(self.pc.get_plan_tree(self.INVALID_PLAN.ID))
+
+    def test_get_leaderboard(self):
+        """
+        Test the leaderboard follows run and event changes and matches a rebuild from the runs
+
+        :return:
+        """
+
+        ec = EventCommands(generic_db.db_obj)
+        rc = RunCommands(generic_db.db_obj)
+
+        ids = [self.uc.create_user(user.username, user.email, user.password).ID for user in self.VALID_USERS]
+        created_plan = self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description, self.VALID_PLAN.date,
+                                           self.VALID_PLAN.distance, self.VALID_PLAN.distance_unit)
+        self.pc.add_users_to_plan(created_plan.ID, ids)
+
+        events = [ec.add_event("x", self.VALID_PLAN.date, distance, unit, created_plan.ID)
+                  for distance, unit in ((5, "km"), (2, "mi"))]
+
+        # repeated completed runs count once
+        first = rc.create_run(events[0].ID, ids[0], self.VALID_PLAN.date, "done")
+        rc.create_run(events[0].ID, ids[0], self.VALID_PLAN.date, "Done")
+        skipped = rc.create_run(events[1].ID, ids[1], self.VALID_PLAN.date, "skipped")
+        rc.create_runs([{"event_id": events[1].ID, "usr_id": ids[0], "date": self.VALID_PLAN.date,
+                         "status": "completed"}] * 2)
+
+        leaderboard = self.pc.get_leaderboard(created_plan.ID, unit="m")
+        self.assertEqual([(ids[0], 2)], [(row.user_id, row.completed_events) for row in leaderboard])
+        self.assertAlmostEqual(5000 + 2 * 1609.344, leaderboard[0].completed_distance)
+
+        # completing a run, the other completed run still counts after a delete
+        rc.modify_run(skipped.ID, self.VALID_PLAN.date, "done")
+        rc.delete_run(first.ID)
+        self.assertEqual([(ids[0], 2), (ids[1], 1)], [(row.user_id, row.completed_events)
+                                                      for row in self.pc.get_leaderboard(created_plan.ID)])
+
+        # undoing a run
+        rc.modify_run(skipped.ID, self.VALID_PLAN.date, "skipped")
+        self.assertEqual([(ids[0], 2), (ids[1], 0)], [(row.user_id, row.completed_events)
+                                                      for row in self.pc.get_leaderboard(created_plan.ID)])
+        rc.modify_run(skipped.ID, self.VALID_PLAN.date, "done")
+
+        # the event distance changes for everyone who completed it
+        ec.modify_event(events[1].ID, "x", self.VALID_PLAN.date, 10, "km")
+        self.assertEqual([ids[0], ids[1]], [row.user_id for row in self.pc.get_leaderboard(created_plan.ID)])
+        self.assertAlmostEqual(15, self.pc.get_leaderboard(created_plan.ID, 1)[0].completed_distance)
+
+        self.assertEqual(0, migrations.rebuild_leaderboard(generic_db.db_obj.engine, created_plan.ID))
+
+        # deleting an event removes it for everyone
+        ec.delete_event(events[1].ID)
+        self.assertEqual([(ids[0], 1)], [(row.user_id, row.completed_events)
+                                         for row in self.pc.get_leaderboard(created_plan.ID)
+                                         if row.completed_events])
+
+        self.assertEqual(0, migrations.rebuild_leaderboard(generic_db.db_obj.engine, created_plan.ID))
+
+        # invalid plan
+        self.assertIsNone(self.pc.get_leaderboard(self.INVALID_PLAN.ID))
 
     def test_remove_users_from_plan(self):
         """
@@ -160,6 +504,11 @@ class TestPlanCommands(TestCase):
         retrieved_plan = self.pc.retrieve_plan(created_plan.ID)
         self.assertTrue(retrieved_plan.equals_no_id(self.UPDATE_PLAN))
 
+        # missing plan
+        self.assertIsNone(self.pc.modify_plan(self.INVALID_PLAN.ID, self.UPDATE_PLAN.name, self.UPDATE_PLAN.description,
+                                              self.UPDATE_PLAN.date, self.UPDATE_PLAN.distance,
+                                              self.UPDATE_PLAN.distance_unit))
+
     def test_delete_plan(self):
         """
         Test deleting a valid plan
@@ -167,14 +516,114 @@ class TestPlanCommands(TestCase):
         :return:
         """
 
+        ec = EventCommands(generic_db.db_obj)
+        rc = RunCommands(generic_db.db_obj)
+
+        # an event of another plan keeps its cached response
+        other_plan = self.pc.create_plan("x", "x", None, 1, "km")
+        other_event = ec.add_event("x", None, 1, "km", other_plan.ID)
+        response_cache.set("event", other_event.ID, other_event.version, b"{}")
+
         # try and delete and check
         for plan in self.VALID_PLANS:
             # add to db
             created_plan = self.pc.create_plan(plan.name, plan.description, plan.date, plan.distance,
                                                plan.distance_unit)
+            created_event = ec.add_event("x", plan.date, 1, "km", created_plan.ID)
+            created_run = rc.create_run(created_event.ID, "user", plan.date, "done")
+
+            response_cache.set("event", created_event.ID, created_event.version, b"{}")
+            response_cache.set("run", created_run.ID, created_run.version, b"{}")
 
             # delete
             self.assertTrue(self.pc.delete_plan(created_plan.ID))
 
             # check
             self.assertIsNone(self.pc.retrieve_plan(created_plan.ID))
+
+            # the cached responses of the plan's events and runs are dropped
+            self.assertIsNone(response_cache.get("event", created_event.ID))
+            self.assertIsNone(response_cache.get("run", created_run.ID))
+
+        self.assertIsNotNone(response_cache.get("event", other_event.ID))
+
+
+class TestAsyncPlanCommands(IsolatedAsyncioTestCase):
+    """
+    Test the async plan database commands
+    """
+
+    pc: AsyncPlanCommands = AsyncPlanCommands(generic_db.async_db_obj)
+    uc: UserCommands = UserCommands(generic_db.db_obj)
+
+    dt = datetime.now()
+
+    VALID_USER = User(ID="x", username="x", email="async_plan@example.com", password="x")
+
+    VALID_PLAN = Plan(ID="x", name="x", description="x", date=dt, distance=21, distance_unit="ft")
+    UPDATE_PLAN = Plan(ID="a", name="b", description="c", date=dt, distance=5, distance_unit="km")
+
+    async def test_plan_lifecycle(self):
+        """
+        Test creating, modifying and deleting a plan
+
+        :return:
+        """
+
+        # create
+        created_plan = await self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description,
+                                                 self.VALID_PLAN.date, self.VALID_PLAN.distance,
+                                                 self.VALID_PLAN.distance_unit)
+        self.assertTrue(created_plan.equals_no_id(self.VALID_PLAN))
+        self.assertTrue((await self.pc.retrieve_plan(created_plan.ID)).equals_no_id(self.VALID_PLAN))
+        self.assertEqual([], (await self.pc.get_plan_tree(created_plan.ID)).child_events)
+
+        # modify
+        await self.pc.modify_plan(created_plan.ID, self.UPDATE_PLAN.name, self.UPDATE_PLAN.description,
+                                  self.UPDATE_PLAN.date, self.UPDATE_PLAN.distance, self.UPDATE_PLAN.distance_unit)
+        self.assertTrue((await self.pc.retrieve_plan(created_plan.ID)).equals_no_id(self.UPDATE_PLAN))
+
+        # delete
+        self.assertTrue(await self.pc.delete_plan(created_plan.ID))
+        self.assertIsNone(await self.pc.retrieve_plan(created_plan.ID))
+        self.assertFalse(await self.pc.delete_plan(created_plan.ID))
+
+    async def test_plan_members(self):
+        """
+        Test adding, listing and removing plan members
+
+        :return:
+        """
+
+        user = self.uc.retrieve_user_by_email(self.VALID_USER.email) or \
+            self.uc.create_user(self.VALID_USER.username, self.VALID_USER.email, self.VALID_USER.password)
+        created_plan = await self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description,
+                                                 self.VALID_PLAN.date, self.VALID_PLAN.distance,
+                                                 self.VALID_PLAN.distance_unit)
+
+        # add
+        await self.pc.add_users_to_plan(created_plan.ID, [user, user])
+        self.assertTrue(await self.pc.is_user_in_plan(created_plan.ID, user.ID))
+        self.assertEqual([user.ID], await self.pc.get_user_ids_in_plan(created_plan.ID))
+        self.assertEqual([user.ID], [u.ID for u in await self.pc.get_user_objects_in_plan(created_plan.ID)])
+        self.assertEqual([user.ID], [row.ID for row in await self.pc.get_plan_members(created_plan.ID)])
+        self.assertIn(created_plan.ID, [plan.ID for plan in await self.pc.get_plans_for_user(user.ID)])
+
+        # progress, the plan has no events
+        progress = await self.pc.get_plan_progress(created_plan.ID)
+        self.assertEqual([(user.ID, 0, 0)], [(row.user_id, row.completed_events, row.total_events)
+                                               for row in progress])
+
+        # dashboard, the plan has no events
+        dashboard = {plan.ID: plan for plan in await self.pc.get_dashboard_plans(user.ID, self.dt, self.dt)}
+        self.assertEqual([], dashboard[created_plan.ID].child_events)
+
+        # remove
+        await self.pc.remove_users_from_plan(created_plan.ID, [user.ID])
+        self.assertFalse(await self.pc.is_user_in_plan(created_plan.ID, user.ID))
+
+        # export, the plan has no events
+        self.assertEqual([], [batch async for batch in self.pc.stream_plan_activity(created_plan.ID)])
+
+        # invalid plan
+        self.assertIsNone(await self.pc.get_plan_members(" "))
@@ -0,0 +1,77 @@
+"""
+test_run_api.py
+By: Zack Bamford
+
+File to test the run routes
+"""
+from unittest import TestCase, mock
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.src.main.api.routers import run_api
+from api.src.main.db import generic_db
+from api.src.main.db.event_db import EventCommands
+from api.src.main.db.plan_db import PlanCommands
+from api.src.main.db.run_db import RunCommands
+from api.src.main.db.user_db import UserCommands
+
+
+class TestBulkCreateRuns(TestCase):
+    """
+    Test creating many runs in one request
+    """
+
+    rc: RunCommands = RunCommands(generic_db.db_obj)
+
+    def setUp(self):
+        """
+        Serve the run routes and create an event and a user
+
+        :return:
+        """
+
+        app = FastAPI()
+        app.include_router(run_api.router)
+        self.client = TestClient(app)
+
+        plan = PlanCommands(generic_db.db_obj).create_plan("x", "x", None, 1, "km")
+        self.ec = EventCommands(generic_db.db_obj)
+        self.event = self.ec.add_event("x", None, 1, "km", plan.ID)
+        self.user = UserCommands(generic_db.db_obj).create_user("x", f"bulk.{plan.ID}@example.com", "x")
+
+    def run_json(self, event_id: str, user_id: str, status: str = "done") -> dict:
+        return {"event_id": event_id, "usr_id": user_id, "date": "2026-11-01T06:00:00", "status": status}
+
+    def test_results_in_order(self):
+        """
+        Test each run gets its created ID or its error at its own index
+
+        :return:
+        """
+
+        runs = [self.run_json(self.event.ID, self.user.ID, "first"), self.run_json("missing", self.user.ID),
+                self.run_json(self.event.ID, "missing"), self.run_json(self.event.ID, self.user.ID, "second")]
+
+        response = self.client.post("/run/bulk_create", json=runs)
+
+        self.assertEqual(200, response.status_code)
+        results = response.json()
+
+        self.assertEqual([{"ID": None, "error": "Event not found"}, {"ID": None, "error": "User not found"}],
+                         results[1:3])
+        self.assertEqual(["first", "second"], [self.rc.get_run(results[i]["ID"]).status for i in (0, 3)])
+        self.assertIsNone(results[0]["error"])
+
+    def test_too_many(self):
+        """
+        Test a request over the size limit is rejected before anything is created
+
+        :return:
+        """
+
+        with mock.patch.object(run_api, "MAX_BULK_SIZE", 2):
+            response = self.client.post("/run/bulk_create", json=[self.run_json(self.event.ID, self.user.ID)] * 3)
+
+        self.assertEqual(413, response.status_code)
+        self.assertEqual([], self.ec.get_runs(self.event.ID))
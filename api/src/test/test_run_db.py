@@ -4,13 +4,22 @@ By: Zack Bamford
 
 File to test the run commands
 """
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from unittest import TestCase
+from unittest import TestCase, IsolatedAsyncioTestCase, mock
 
-from api.src.main.db import generic_db
-from api.src.main.db.event_db import EventCommands
-from api.src.main.db.plan_db import Run, Event, Plan, PlanCommands
-from api.src.main.db.run_db import RunCommands
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from api.src.main.db import generic_db, migrations
+from api.src.main.db.event_db import EventCommands, AsyncEventCommands
+from api.src.main.db.plan_db import Run, Event, Plan, PlanCommands, PlanLeaderboard
+from api.src.main.db.run_db import RunCommands, AsyncRunCommands
+from api.src.main.db.user_db import UserCommands
 
 
 class TestRunCommands(TestCase):
@@ -54,6 +63,32 @@ class TestRunCommands(TestCase):
             # check db
             self.assertTrue(self.rc.get_run(created_run.ID).equals_no_id(run))
 
+    def test_create_runs(self):
+        """
+        Test creating many runs at once
+
+        :return:
+        """
+
+        created_plan = self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description, self.VALID_PLAN.date,
+                                           self.VALID_PLAN.distance, self.VALID_PLAN.distance_unit)
+
+        created_event = self.ec.add_event(self.VALID_EVENT.name, self.VALID_EVENT.date,
+                                          self.VALID_EVENT.distance, self.VALID_EVENT.distance_unit, created_plan.ID)
+
+        # set-based check of the referenced event
+        self.assertEqual({created_event.ID}, self.ec.get_existing_event_ids([created_event.ID, " ", created_event.ID]))
+
+        run_ids = self.rc.create_runs([{"event_id": created_event.ID, "usr_id": run.usr_id, "date": run.date,
+                                        "status": run.status} for run in self.VALID_RUNS])
+
+        # IDs are returned in order
+        self.assertEqual(len(self.VALID_RUNS), len(set(run_ids)))
+        for run_id, run in zip(run_ids, self.VALID_RUNS):
+            self.assertTrue(self.rc.get_run(run_id).equals_no_id(run))
+
+        self.assertEqual([], self.rc.create_runs([]))
+
     def test_get_run(self):
         """
         Test getting a run
@@ -98,6 +133,9 @@ class TestRunCommands(TestCase):
             # check db
             self.assertTrue(self.rc.get_run(created_run.ID).equals_no_id(created_run))
 
+        # missing run
+        self.assertIsNone(self.rc.modify_run(" ", self.dt, "modified"))
+
     def test_delete_run(self):
 
         created_plan = self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description, self.VALID_PLAN.date,
@@ -117,3 +155,161 @@ class TestRunCommands(TestCase):
             self.assertIsNone(self.rc.get_run(created_run.ID))
 
 
+class TestLeaderboardConcurrency(TestCase):
+    """
+    Test run changes running at the same time keep the leaderboard in step with the runs
+    """
+
+    def setUp(self):
+        """
+        Create a file database, as the debug database cannot be written from two connections at once, and slow every
+        statement down so concurrent changes overlap
+
+        :return:
+        """
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+        with mock.patch.dict(os.environ, {"DB_URL": f"sqlite:///{os.path.join(self.temp_dir.name, 'test.db')}"}):
+            self.db_obj = generic_db.DBModificationObject()
+            generic_db.Base.metadata.create_all(self.db_obj.engine)
+
+        @sqlalchemy.event.listens_for(self.db_obj.engine, "after_cursor_execute")
+        def slow(*args):
+            time.sleep(0.02)
+
+        self.rc = RunCommands(self.db_obj)
+        self.plan = PlanCommands(self.db_obj).create_plan("x", "x", None, 1, "km")
+        uc = UserCommands(self.db_obj)
+        self.a, self.b, self.c = [uc.create_user(name, f"{name}@example.com", "x").ID for name in ("a", "b", "c")]
+        ec = EventCommands(self.db_obj)
+        self.events = [ec.add_event("x", None, 1, "km", self.plan.ID) for _ in range(2)]
+
+    def tearDown(self):
+        """
+        Remove the database
+
+        :return:
+        """
+
+        self.db_obj.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def concurrently(self, *calls):
+        # start every call at the same time
+        barrier = threading.Barrier(len(calls))
+
+        def run(call):
+            barrier.wait()
+            return call()
+
+        with ThreadPoolExecutor(len(calls)) as executor:
+            return list(executor.map(run, calls))
+
+    def completed_events(self, user_id: str) -> int:
+        with Session(self.db_obj.engine) as session:
+            return session.scalar(sqlalchemy.select(PlanLeaderboard.completed_events)
+                                  .where(PlanLeaderboard.plan_id == self.plan.ID, PlanLeaderboard.user_id == user_id))
+
+    def test_concurrent_creates(self):
+        """
+        Test two completed runs of one event count once, and runs of two events count twice
+
+        :return:
+        """
+
+        event_id = self.events[0].ID
+        self.concurrently(lambda: self.rc.create_run(event_id, self.a, None, "done"),
+                          lambda: self.rc.create_run(event_id, self.a, None, "done"))
+        self.assertEqual(1, self.completed_events(self.a))
+
+        self.concurrently(*[lambda event=event: self.rc.create_run(event.ID, self.b, None, "done")
+                            for event in self.events])
+        self.assertEqual(2, self.completed_events(self.b))
+
+        # bulk inserts lock the same entries
+        self.concurrently(*[lambda: self.rc.create_runs([{"event_id": event_id, "usr_id": self.c, "date": None,
+                                                          "status": "done"}]) for _ in range(2)])
+        self.assertEqual(1, self.completed_events(self.c))
+
+        self.assertEqual(0, migrations.rebuild_leaderboard(self.db_obj.engine, self.plan.ID))
+
+    def test_concurrent_delete_and_create(self):
+        """
+        Test deleting a completed run while another is created leaves the event counted once
+
+        :return:
+        """
+
+        event_id = self.events[0].ID
+        run = self.rc.create_run(event_id, self.a, None, "done")
+
+        self.concurrently(lambda: self.rc.delete_run(run.ID),
+                          lambda: self.rc.create_run(event_id, self.a, None, "done"))
+        self.assertEqual(1, self.completed_events(self.a))
+
+
+class TestAsyncRunCommands(IsolatedAsyncioTestCase):
+    """
+    Test the async run commands
+    """
+
+    rc: AsyncRunCommands = AsyncRunCommands(generic_db.async_db_obj)
+    ec: AsyncEventCommands = AsyncEventCommands(generic_db.async_db_obj)
+    pc: PlanCommands = PlanCommands(generic_db.db_obj)
+
+    dt = datetime.now()
+
+    VALID_RUN = Run(ID="x", event_id="x", usr_id="j", date=dt, status="x")
+    VALID_EVENT = Event(ID="x", plan_id="x", name="x", date=dt, distance=21, distance_unit="ft")
+    VALID_PLAN = Plan(ID="x", name="x", description="x", date=dt, distance=21, distance_unit="ft", users="x")
+
+    async def test_run_lifecycle(self):
+        """
+        Test creating, modifying and deleting a run
+
+        :return:
+        """
+
+        created_plan = self.pc.create_plan(self.VALID_PLAN.name, self.VALID_PLAN.description, self.VALID_PLAN.date,
+                                           self.VALID_PLAN.distance, self.VALID_PLAN.distance_unit)
+        created_event = await self.ec.add_event(self.VALID_EVENT.name, self.VALID_EVENT.date,
+                                                self.VALID_EVENT.distance, self.VALID_EVENT.distance_unit,
+                                                created_plan.ID)
+
+        # create
+        created_run = await self.rc.create_run(created_event.ID, self.VALID_RUN.usr_id, self.VALID_RUN.date,
+                                               self.VALID_RUN.status)
+        self.assertTrue(created_run.equals_no_id(self.VALID_RUN))
+        self.assertEqual([created_run], await self.ec.get_all_run_ids(created_event.ID))
+
+        # bulk create
+        self.assertEqual({created_event.ID}, await self.ec.get_existing_event_ids([created_event.ID, " "]))
+        run_ids = await self.rc.create_runs([{"event_id": created_event.ID, "usr_id": self.VALID_RUN.usr_id,
+                                              "date": self.VALID_RUN.date, "status": self.VALID_RUN.status}] * 2)
+        self.assertTrue((await self.rc.get_run(run_ids[1])).equals_no_id(self.VALID_RUN))
+
+        # modify
+        modified_run = await self.rc.modify_run(created_run.ID, self.VALID_RUN.date, "modified")
+        self.assertEqual("modified", (await self.rc.get_run(created_run.ID)).status)
+        self.assertEqual(modified_run, await self.rc.get_run(created_run.ID))
+
+        # delete
+        self.assertTrue(await self.rc.delete_run(created_run.ID))
+        self.assertIsNone(await self.rc.get_run(created_run.ID))
+
+        # completed runs of existing users keep the leaderboard in step with the runs
+        uc = UserCommands(generic_db.db_obj)
+        user_ids = [uc.create_user(name, f"{name}.{created_plan.ID}@example.com", "x").ID for name in ("j", "l")]
+        completed_run = await self.rc.create_run(created_event.ID, user_ids[0], self.VALID_RUN.date, "done")
+        planned_run = await self.rc.create_run(created_event.ID, user_ids[0], self.VALID_RUN.date, "planned")
+        await self.rc.create_runs([{"event_id": created_event.ID, "usr_id": user_ids[1], "date": self.VALID_RUN.date,
+                                    "status": "done"}])
+        await self.rc.modify_run(planned_run.ID, self.VALID_RUN.date, "done")
+        await self.rc.delete_run(completed_run.ID)
+        await self.ec.modify_event(created_event.ID, self.VALID_EVENT.name, self.VALID_EVENT.date, 42,
+                                   self.VALID_EVENT.distance_unit)
+        self.assertEqual(0, migrations.rebuild_leaderboard(generic_db.db_obj.engine, created_plan.ID))
+
+        await self.ec.delete_event(created_event.ID)
+        self.assertEqual(0, migrations.rebuild_leaderboard(generic_db.db_obj.engine, created_plan.ID))
@@ -0,0 +1,99 @@
+"""
+test_schedule.py
+By: Zack Bamford
+
+File to test the streaming schedule parsers
+"""
+from unittest import IsolatedAsyncioTestCase
+
+from api.src.main.api.schedule import text_lines, csv_records, json_records, ndjson_records, MAX_RECORD_SIZE, \
+    RecordTooLargeError, RowError
+
+
+async def split(data: bytes, size: int):
+    # stands in for a request body arriving in chunks
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+async def collect(records) -> list:
+    return [record async for record in records]
+
+
+class TestScheduleParsers(IsolatedAsyncioTestCase):
+    """
+    Test parsing schedules split over chunks
+    """
+
+    async def test_text_lines(self):
+        """
+        Test lines and multi byte characters spanning chunks
+
+        :return:
+        """
+
+        data = "\ufeffone\r\ntwo é\nthree".encode("utf-8")
+
+        for size in (1, 2, 5, len(data)):
+            self.assertEqual(["one", "two é", "three"], await collect(text_lines(split(data, size))))
+
+    async def test_csv_records(self):
+        """
+        Test records keyed by the header, with row errors for the wrong amount of fields
+
+        :return:
+        """
+
+        data = b'name, date\n"Long, easy",2024-01-01\n\nshort\n'
+
+        self.assertEqual([{"name": "Long, easy", "date": "2024-01-01"}, RowError("Expected 2 fields, got 1")],
+                         await collect(csv_records(split(data, 3))))
+
+    async def test_json_records(self):
+        """
+        Test objects of an array spanning chunks, and malformed arrays
+
+        :return:
+        """
+
+        data = b' [ {"name": "a", "tags": ["x", "]"]}, {"name": "b"} ] '
+
+        for size in (1, 4, len(data)):
+            self.assertEqual([{"name": "a", "tags": ["x", "]"]}, {"name": "b"}],
+                             await collect(json_records(split(data, size))))
+
+        self.assertEqual([], await collect(json_records(split(b"[]", 1))))
+        self.assertEqual([RowError("Expected a JSON array")], await collect(json_records(split(b'{"name": "a"}', 4))))
+        self.assertEqual([{"name": "a"}, RowError("Unterminated JSON array")],
+                         await collect(json_records(split(b'[{"name": "a"}', 4))))
+        self.assertEqual(1, len(await collect(json_records(split(b'[{"name": "a"', 4)))))
+
+        # a string in the array is a value, not an error
+        self.assertEqual([{"name": "a"}, "s"], await collect(json_records(split(b'[{"name": "a"}, "s"]', 4))))
+
+    async def test_ndjson_records(self):
+        """
+        Test one object per line with row errors for invalid lines
+
+        :return:
+        """
+
+        records = await collect(ndjson_records(split(b'{"name": "a"}\n{bad\n\n{"name": "b"}', 5)))
+
+        self.assertEqual({"name": "a"}, records[0])
+        self.assertTrue(records[1].message.startswith("Invalid JSON"))
+        self.assertEqual({"name": "b"}, records[2])
+
+    async def test_record_size(self):
+        """
+        Test a line or JSON value that never ends is rejected once it passes the size limit
+
+        :return:
+        """
+
+        big = b"x" * (MAX_RECORD_SIZE + 1)
+
+        for parser, data in ((csv_records, b"name\n" + big), (ndjson_records, big + b"\n"),
+                             (json_records, b'[{"name": "a"}, {"name": "' + big)):
+            with self.assertRaises(RecordTooLargeError):
+                await collect(parser(split(data, 4096)))
@@ -0,0 +1,183 @@
+"""
+test_tracing.py
+By: Zack Bamford
+
+File to test the query tracing, the slow query log and the query budgets of the endpoints
+"""
+from unittest import TestCase, mock
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.src.main.api.dependencies import user_commands
+from api.src.main.api.metrics import MetricsMiddleware, RequestMetrics
+from api.src.main.api.routers import plan_api
+from api.src.main.db import generic_db, tracing
+from api.src.main.db.plan_db import PlanCommands
+from api.src.main.db.tracing import fingerprint, redact, assert_query_budget, QueryTrace
+from api.src.main.db.user_db import UserCommands
+
+
+class TestTracing(TestCase):
+    """
+    Test fingerprinting, redacting and tracing statements
+    """
+
+    uc: UserCommands = UserCommands(generic_db.db_obj)
+
+    def test_fingerprint(self):
+        """
+        Test statements with different values or list lengths share a fingerprint
+
+        :return:
+        """
+
+        self.assertEqual("SELECT a FROM t WHERE id IN (?) AND b = ? LIMIT ?",
+                         fingerprint("SELECT a FROM t\n WHERE id IN (?, ?, ?) AND b = 'it''s' LIMIT 10"))
+        self.assertEqual(fingerprint("SELECT a FROM t WHERE b = %(b_1)s AND c::int = $2"),
+                         fingerprint("SELECT a FROM t WHERE b = ? AND c::int = ?"))
+        self.assertEqual("INSERT INTO t (a, b) VALUES (?)",
+                         fingerprint("INSERT INTO t (a, b) VALUES (?, ?), (?, ?), (?, ?)"))
+
+        # identifiers keep their digits
+        self.assertEqual("SELECT anon_1.a FROM anon_1", fingerprint("SELECT anon_1.a FROM anon_1"))
+
+    def test_redact(self):
+        """
+        Test parameters are replaced with their types
+
+        :return:
+        """
+
+        self.assertEqual(["str", "int"], redact(("secret@example.com", 1)))
+        self.assertEqual({"email": "str"}, redact({"email": "secret@example.com"}))
+        self.assertEqual("2 x ['str']", redact([("a",), ("b",)]))
+
+    def test_repeated(self):
+        """
+        Test flagging statements run at least the threshold
+
+        :return:
+        """
+
+        trace = QueryTrace()
+
+        for user_id in ("a", "b", "c"):
+            trace.record(f"SELECT * FROM users WHERE id = '{user_id}'", 0.001)
+
+        trace.record("SELECT * FROM plans", 0.001)
+
+        self.assertEqual(4, trace.total)
+        self.assertEqual([("SELECT * FROM users WHERE id = ?", 3)], trace.repeated(3))
+        self.assertEqual(2, len(trace.repeated(1)))
+
+    def test_slow_query_log(self):
+        """
+        Test slow statements are logged without their parameter values
+
+        :return:
+        """
+
+        user = self.uc.create_user("slow", "slow.query@example.com", "x")
+
+        with mock.patch.object(tracing, "SLOW_QUERY_SECONDS", 1e-9), self.assertLogs(tracing.logger) as logs:
+            self.uc.retrieve_user(user.ID)
+
+        self.assertIn("Slow query", logs.output[0])
+        self.assertIn("['str']", logs.output[0])
+        self.assertNotIn(user.ID, logs.output[0])
+
+        # disabled by default
+        with mock.patch.object(tracing.logger, "warning") as warning:
+            self.uc.retrieve_user(user.ID)
+
+        warning.assert_not_called()
+
+    def test_assert_query_budget(self):
+        """
+        Test code over its budget fails
+
+        :return:
+        """
+
+        user = self.uc.create_user("budget", "budget@example.com", "x")
+
+        with assert_query_budget(1) as trace:
+            self.uc.retrieve_user(user.ID)
+
+        self.assertEqual(1, trace.total)
+
+        with self.assertRaises(AssertionError):
+            with assert_query_budget(2):
+                for _ in range(3):
+                    self.uc.retrieve_user(user.ID)
+
+        # within the total, but the same statement repeated
+        with self.assertRaisesRegex(AssertionError, "more than 1 times"):
+            with assert_query_budget(10, max_repeats=1):
+                for _ in range(3):
+                    self.uc.retrieve_user(user.ID)
+
+
+class TestEndpointQueries(TestCase):
+    """
+    Test the statements run by the endpoints stay within their budgets
+    """
+
+    def setUp(self):
+        """
+        Serve the plan routes and a route with an N+1 query, and create a plan and users
+
+        :return:
+        """
+
+        app = FastAPI()
+        app.include_router(plan_api.router)
+
+        @app.get("/users")
+        async def get_users(ids: str):
+            return [await user_commands.retrieve_user(user_id) for user_id in ids.split(",")]
+
+        app.add_middleware(MetricsMiddleware, metrics=RequestMetrics())
+        self.client = TestClient(app)
+
+        uc = UserCommands(generic_db.db_obj)
+        self.plan = PlanCommands(generic_db.db_obj).create_plan("x", "x", None, 1, "km")
+        self.user_ids = [uc.create_user(f"user{i}", f"user{i}.{self.plan.ID}@example.com", "x").ID
+                         for i in range(20)]
+
+    def test_plan_users(self):
+        """
+        Test adding and listing users takes the same statements for any amount of users
+
+        :return:
+        """
+
+        with assert_query_budget(6, max_repeats=3):
+            response = self.client.post("/plan/add_users", params={"plan_id": self.plan.ID}, json=self.user_ids)
+
+        self.assertEqual(200, response.status_code)
+
+        with assert_query_budget(2, max_repeats=1):
+            response = self.client.get("/plan/members", params={"plan_id": self.plan.ID})
+
+        self.assertEqual(20, len(response.json()))
+
+    def test_repeated_queries(self):
+        """
+        Test a request repeating a statement is flagged when tracing is on
+
+        :return:
+        """
+
+        with mock.patch.object(tracing, "TRACE_QUERIES", True), self.assertLogs(tracing.logger) as logs:
+            self.client.get("/users", params={"ids": ",".join(self.user_ids[:tracing.REPEAT_THRESHOLD])})
+
+        self.assertEqual(1, len(logs.output))
+        self.assertIn(f"GET /users ran the same statement {tracing.REPEAT_THRESHOLD} times", logs.output[0])
+
+        # below the threshold
+        with mock.patch.object(tracing, "TRACE_QUERIES", True), mock.patch.object(tracing.logger, "warning") as warning:
+            self.client.get("/users", params={"ids": ",".join(self.user_ids[:tracing.REPEAT_THRESHOLD - 1])})
+
+        warning.assert_not_called()
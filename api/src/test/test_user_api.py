@@ -0,0 +1,86 @@
+"""
+test_user_api.py
+By: Zack Bamford
+
+File to test the user routes
+"""
+import os
+from unittest import TestCase
+
+import sqlalchemy
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+# the token secret is required to import the auth module
+os.environ.setdefault("SECRET_KEY", "test")
+
+from api.src.main.api.auth import create_access_token
+from api.src.main.api.routers import user_api
+from api.src.main.db import generic_db
+from api.src.main.db.user_db import User, UserCommands, principal_cache
+
+
+class TestUserRoutes(TestCase):
+    """
+    Test the user routes
+    """
+
+    uc: UserCommands = UserCommands(generic_db.db_obj)
+
+    def setUp(self):
+        """
+        Serve the user routes and create a user with a token
+
+        :return:
+        """
+
+        app = FastAPI()
+        app.include_router(user_api.router)
+        self.client = TestClient(app)
+
+        self.user = self.uc.create_user("x", f"x.{id(self)}@example.com", "hash")
+        self.headers = {"Authorization": f"Bearer {create_access_token({'sub': self.user.ID})}"}
+
+    def test_modify_keeps_other_fields(self):
+        """
+        Test a modify only writes the given fields, not the cached copy of the others
+
+        :return:
+        """
+
+        # cache the user, then another worker changes the email and password
+        principal_cache.set(self.user.ID, self.user, self.user.version)
+
+        with Session(generic_db.db_obj.engine) as session:
+            session.execute(sqlalchemy.update(User).where(User.ID == self.user.ID)
+                            .values(email=f"new.{id(self)}@example.com", password="new", version=User.version + 1))
+            session.commit()
+
+        response = self.client.post("/user/modify", params={"username": "y"}, headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(("y", f"new.{id(self)}@example.com"), (response.json()["username"], response.json()["email"]))
+        self.assertEqual("new", self.uc.retrieve_user(self.user.ID).password)
+
+    def test_info_from_database(self):
+        """
+        Test /user/info serves the user in the database, not the cached copy of the token's user
+
+        :return:
+        """
+
+        # cache the user, then another worker changes the email
+        principal_cache.set(self.user.ID, self.user, self.user.version)
+
+        with Session(generic_db.db_obj.engine) as session:
+            session.execute(sqlalchemy.update(User).where(User.ID == self.user.ID)
+                            .values(email=f"new.{id(self)}@example.com", version=User.version + 1))
+            session.commit()
+
+        response = self.client.get("/user/info", headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(f"new.{id(self)}@example.com", response.json()["email"])
+        self.assertEqual(f'"v{self.user.version + 1}"', response.headers["ETag"])
+
@@ -5,11 +5,14 @@ By: Zack Bamford
 Tests for the user database commands
 """
 
-from unittest import TestCase
+from unittest import TestCase, IsolatedAsyncioTestCase
+
+import sqlalchemy
+from sqlalchemy.orm import Session
 
 import api.src.main.db.generic_db as generic_db
 
-from api.src.main.db.user_db import UserCommands, User
+from api.src.main.db.user_db import UserCommands, User, AsyncUserCommands, principal_cache
 
 
 class TestUserCommands(TestCase):
@@ -28,6 +31,17 @@ class TestUserCommands(TestCase):
 
     INVALID_USER = User(ID=" ", username="  ", email="   ", password="    ")
 
+    def setUp(self):
+        """
+        Emails are unique, so start every test without users
+
+        :return:
+        """
+
+        with Session(generic_db.db_obj.engine) as session:
+            session.execute(sqlalchemy.delete(User))
+            session.commit()
+
     def test_create_user(self):
         """
         Test creating a job
@@ -68,6 +82,64 @@ class TestUserCommands(TestCase):
         retrieved_job = self.uc.retrieve_user(self.INVALID_USER.ID)
         self.assertIsNone(retrieved_job)
 
+    def test_retrieve_users(self):
+        """
+        Test retrieving many users at once
+
+        :return:
+        """
+
+        ids = [self.uc.create_user(user.username, user.email, user.password).ID for user in self.VALID_USERS]
+
+        # pad with invalid IDs so more than one chunk is needed
+        padded_ids = ids + [f"{self.INVALID_USER.ID}{i}" for i in range(generic_db.MAX_BIND_PARAMS * 2)] + ids
+
+        retrieved = self.uc.retrieve_users(padded_ids)
+        self.assertEqual(sorted(ids), sorted(user.ID for user in retrieved))
+
+    def test_get_existing_user_ids(self):
+        """
+        Test checking which user IDs exist
+
+        :return:
+        """
+
+        created_user = self.uc.create_user(self.VALID_USER.username, self.VALID_USER.email, self.VALID_USER.password)
+
+        self.assertEqual({created_user.ID},
+                         self.uc.get_existing_user_ids([created_user.ID, "missing", created_user.ID]))
+        self.assertEqual(set(), self.uc.get_existing_user_ids([]))
+
+    def test_retrieve_user_by_email(self):
+        """
+        Test retrieving a user by email, ignoring case
+
+        :return:
+        """
+
+        created_user = self.uc.create_user(self.UPDATE_USER.username, self.UPDATE_USER.email,
+                                           self.UPDATE_USER.password)
+
+        self.assertEqual(created_user, self.uc.retrieve_user_by_email(self.UPDATE_USER.email.upper()))
+        self.assertIsNone(self.uc.retrieve_user_by_email(self.INVALID_USER.email))
+
+    def test_create_duplicate_email(self):
+        """
+        Test that an email can only be used once, ignoring case
+
+        :return:
+        """
+
+        self.assertIsNotNone(self.uc.create_user(self.UPDATE_USER.username, self.UPDATE_USER.email,
+                                                 self.UPDATE_USER.password))
+        self.assertIsNone(self.uc.create_user(self.UPDATE_USER.username, self.UPDATE_USER.email.upper(),
+                                              self.UPDATE_USER.password))
+
+        # modifying into a used email fails too
+        created_user = self.uc.create_user(self.VALID_USER.username, self.VALID_USER.email, self.VALID_USER.password)
+        self.assertIsNone(self.uc.modify_user(created_user.ID, created_user.username, self.UPDATE_USER.email,
+                                              created_user.password))
+
     def test_modify_user(self):
         """
         Test modifying a valid user
@@ -86,6 +158,23 @@ class TestUserCommands(TestCase):
         self.assertIsNotNone(modified_job)
         self.assertTrue(modified_job.equals_no_id(self.UPDATE_USER))
 
+    def test_modify_some_fields(self):
+        """
+        Test fields that are not given keep the values in the database
+
+        :return:
+        """
+
+        created_user = self.uc.create_user(self.VALID_USER.username, self.VALID_USER.email, self.VALID_USER.password)
+
+        # another request changes the email and password
+        self.uc.modify_user(created_user.ID, new_email=self.UPDATE_USER.email, new_password=self.UPDATE_USER.password)
+
+        # changing only the name keeps them
+        modified_user = self.uc.modify_user(created_user.ID, self.UPDATE_USER.username)
+        self.assertTrue(modified_user.equals_no_id(self.UPDATE_USER))
+        self.assertEqual(3, modified_user.version)
+
     def test_modify_invalid_user(self):
         """
         Test modifying an invalid user
@@ -116,6 +205,46 @@ class TestUserCommands(TestCase):
         # delete and check
         self.assertTrue(self.uc.delete_user(created_job.ID))
 
+    def test_principal_cache_invalidation(self):
+        """
+        Test modifying or deleting a user drops it from the principal cache
+
+        :return:
+        """
+
+        created_user = self.uc.create_user(self.VALID_USER.username, self.VALID_USER.email, self.VALID_USER.password)
+
+        # modify
+        principal_cache.set(created_user.ID, created_user, created_user.version)
+        modified_user = self.uc.modify_user(created_user.ID, self.UPDATE_USER.username, self.UPDATE_USER.email,
+                                            self.UPDATE_USER.password)
+        self.assertIsNone(principal_cache.get(created_user.ID))
+
+        # a copy loaded before the modify is not cached after it
+        principal_cache.set(created_user.ID, created_user, created_user.version)
+        self.assertIsNone(principal_cache.get(created_user.ID))
+
+        # delete
+        principal_cache.set(created_user.ID, modified_user, modified_user.version)
+        self.uc.delete_user(created_user.ID)
+        self.assertIsNone(principal_cache.get(created_user.ID))
+
+    def test_principal_cache_delete_race(self):
+        """
+        Test a user loaded before it was deleted is not cached after the delete
+
+        :return:
+        """
+
+        created_user = self.uc.create_user(self.VALID_USER.username, self.VALID_USER.email, self.VALID_USER.password)
+
+        # a request loads the user, then another deletes it before the first fills the cache
+        loaded_user = self.uc.retrieve_user(created_user.ID)
+        self.assertTrue(self.uc.delete_user(created_user.ID))
+        principal_cache.set(loaded_user.ID, loaded_user, loaded_user.version)
+
+        self.assertIsNone(principal_cache.get(created_user.ID))
+
     def test_delete_invalid_user(self):
         """
         Test deleting an invalid user
@@ -125,3 +254,60 @@ class TestUserCommands(TestCase):
 
         # try to delete and check
         self.assertFalse(self.uc.delete_user(self.INVALID_USER.ID))
+
+
+class TestAsyncUserCommands(IsolatedAsyncioTestCase):
+    """
+    Test the async user database commands
+    """
+
+    uc: AsyncUserCommands = AsyncUserCommands(generic_db.async_db_obj)
+
+    VALID_USER = User(ID="x", username="x", email="async@example.com", password="x")
+
+    UPDATE_USER = User(ID="a", username="b", email="async_update@example.com", password="d")
+
+    async def asyncSetUp(self):
+        """
+        Emails are unique, so start every test without users
+
+        :return:
+        """
+
+        with Session(generic_db.db_obj.engine) as session:
+            session.execute(sqlalchemy.delete(User))
+            session.commit()
+
+    async def test_user_lifecycle(self):
+        """
+        Test creating, retrieving, modifying and deleting a user
+
+        :return:
+        """
+
+        # create
+        created_user = await self.uc.create_user(self.VALID_USER.username, self.VALID_USER.email,
+                                                 self.VALID_USER.password)
+        self.assertTrue(created_user.equals_no_id(self.VALID_USER))
+
+        # duplicate email
+        self.assertIsNone(await self.uc.create_user(self.VALID_USER.username, self.VALID_USER.email.upper(),
+                                                    self.VALID_USER.password))
+
+        # retrieve
+        self.assertEqual(created_user, await self.uc.retrieve_user(created_user.ID))
+        self.assertEqual(created_user, await self.uc.retrieve_user_by_email(self.VALID_USER.email.upper()))
+        self.assertEqual([created_user], await self.uc.retrieve_users([created_user.ID, "missing"]))
+        self.assertEqual({created_user.ID}, await self.uc.get_existing_user_ids([created_user.ID, "missing"]))
+
+        # modify
+        modified_user = await self.uc.modify_user(created_user.ID, self.UPDATE_USER.username, self.UPDATE_USER.email,
+                                                  self.UPDATE_USER.password)
+        self.assertTrue(modified_user.equals_no_id(self.UPDATE_USER))
+
+        # delete, dropping the cached principal
+        principal_cache.set(created_user.ID, modified_user, modified_user.version)
+        self.assertTrue(await self.uc.delete_user(created_user.ID))
+        self.assertIsNone(principal_cache.get(created_user.ID))
+        self.assertIsNone(await self.uc.retrieve_user(created_user.ID))
+        self.assertFalse(await self.uc.delete_user(created_user.ID))